@@ -4,9 +4,31 @@ import socket
 import logging
 import json
 import os
+import random
 import uuid
 import subprocess
+import platform
+import shutil
+import signal
+import tempfile
+import re
+import threading
 import time
+import zlib
+import hashlib
+import bisect
+import itertools
+from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import msgpack
+except ImportError:  # msgpack не обязателен, без него используется JSON
+    msgpack = None
+try:
+    import zstandard
+except ImportError:  # zstandard не обязателен, без него сжатие zlib
+    zstandard = None
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO,
@@ -15,7 +37,124 @@ logging.basicConfig(level=logging.INFO,
 ZMQ_PORT = 5555
 UDP_PORT = 9998
 CONFIG_FILE = "config.json"
+DISCOVERY_WINDOW = 1.0           # сколько собирать ответы серверов на DISCOVER, секунд
+DISCOVERY_TTL = 6 * 3600         # сколько доверять найденному серверу без повторного поиска, секунд
+SERVER_SILENCE_LIMIT = 30        # сервер молчит дольше (и дольше трёх интервалов пингов) — ищем другой
 CERTS_BASE_DIR = "certs"
+OUTPUT_CHUNK_SIZE = 16 * 1024    # размер порции потокового вывода, байт
+OUTPUT_FLUSH_INTERVAL = 0.5      # максимальная задержка отправки порции, секунд
+OUTPUT_TAIL_LIMIT = 64 * 1024    # сколько последнего вывода хранить для command_result
+OUTPUT_HEAD_LIMIT = 16 * 1024    # сколько начала вывода хранить для command_result
+OUTPUT_INLINE_LIMIT = 256 * 1024 # вывод до стольких байт возвращается целиком, больше — сбрасывается на диск
+OUTPUT_SPILL_DIR = os.path.join(tempfile.gettempdir(), "fluxops-output")
+OUTPUT_SPILL_TTL = 3600          # сколько хранить сброшенный на диск вывод, секунд
+OUTPUT_FETCH_LIMIT = 1024 * 1024 # максимальный размер порции при запросе полного вывода, байт
+FILE_CREDIT_WINDOW = 16          # сколько порций раздаваемого файла сервер может слать без подтверждения
+FILE_IDLE_TIMEOUT = 600          # приём файла без новых порций дольше стольких секунд забывается, секунд
+OUTPUT_SEND_HWM = 1000           # лимит неотправленных сообщений в DEALER-сокете
+MAX_CONCURRENT_COMMANDS = 4      # команд, выполняемых одновременно (config.json: max_concurrent_commands)
+HOUSEKEEPING_WORKERS = 2         # потоков для сбора фактов и проверки принятых файлов, отдельно от команд
+DEFAULT_COMMAND_TIMEOUT = 3600   # таймаут команды, если сервер его не передал, секунд
+PING_INTERVAL = 5                # интервал пингов, пока сервер не сообщил свой
+HEARTBEAT_BACKOFF = 1.5          # во сколько раз растёт пауза между пингами в простое
+HEARTBEAT_JITTER = 0.2           # случайное сокращение паузы, чтобы пинги флота не совпадали
+RESULTS_ENDPOINT = "inproc://command-results"
+SEEN_REQUESTS_LIMIT = 10000      # сколько последних request_id помнить для отбрасывания повторов
+COMPRESS_THRESHOLD = 4096        # сообщения серверу больше стольких байт сжимаются
+FACTS_INTERVAL = 300             # как часто пересобирать факты о системе, секунд (config.json: facts_interval, 0 — не собирать)
+METRICS_FILE = "metrics.prom"    # метрики агента для textfile-коллектора (config.json: metrics_file, "" — отключить)
+METRICS_FLUSH_INTERVAL = 15      # как часто переписывать файл метрик, секунд
+LOG_SAMPLE_EVERY = 100           # в DEBUG логируется каждое N-е сообщение горячего пути
+
+# Запущенные процессы команд: request_id -> {"proc": Popen, "reason": None | "timeout" | "cancelled"}
+running_commands = {}
+running_lock = threading.Lock()
+
+# Формат сообщений, согласованный с сервером при регистрации
+wire_format = {"encoding": "json", "compression": "none"}
+
+# Метрики агента в текстовом формате Prometheus
+LATENCY_BUCKETS = (0.0001, 0.001, 0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+class Metrics:
+    """
+    Счётчики, показатели и гистограммы агента; пишутся из потоков пула, поэтому под замком.
+    Агент разворачивается без серверной части, поэтому это отдельная копия
+    server/metrics.py со своими корзинами (команды агента бывают долгими).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.histograms = {}  # (имя, метки) -> [счётчики по корзинам, сумма, количество]
+
+    def inc(self, name, value=1, labels=()):
+        with self.lock:
+            self.counters[(name, labels)] += value
+
+    def set(self, name, value, labels=()):
+        self.gauges[(name, labels)] = value
+
+    def observe(self, name, value, labels=()):
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[(name, labels)] = [[0] * len(LATENCY_BUCKETS), 0.0, 0]
+            index = bisect.bisect_left(LATENCY_BUCKETS, value)
+            if index < len(LATENCY_BUCKETS):
+                histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+    def render(self):
+        lines = []
+        typed = set()
+
+        def family(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                family(name, "counter")
+                lines.append(f"{name}{self._labels(labels)} {value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                family(name, "gauge")
+                lines.append(f"{name}{self._labels(labels)} {value}")
+            for (name, labels), (buckets, total, count) in sorted(self.histograms.items()):
+                family(name, "histogram")
+                cumulative = 0
+                for bound, bucket in zip(LATENCY_BUCKETS, buckets):
+                    cumulative += bucket
+                    lines.append(f"{name}_bucket{self._labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_bucket{self._labels(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{self._labels(labels)} {total}")
+                lines.append(f"{name}_count{self._labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename):
+        """Атомарно переписывает файл метрик: коллектор не увидит его наполовину записанным."""
+        with running_lock:
+            self.set("fluxops_agent_commands_running", len(running_commands))
+        temp_file = f"{filename}.tmp"
+        with open(temp_file, "w") as f:
+            f.write(self.render())
+        os.replace(temp_file, filename)
+
+metrics = Metrics()
+_log_sequence = itertools.count()
+
+def log_sampled():
+    """Истина для каждого LOG_SAMPLE_EVERY-го сообщения горячего пути, если включён DEBUG."""
+    return logging.root.isEnabledFor(logging.DEBUG) and next(_log_sequence) % LOG_SAMPLE_EVERY == 0
 
 def ensure_file_exists(file, default_content):
     if not os.path.exists(file):
@@ -67,56 +206,674 @@ def get_client_info():
             save_config(config)
     return config
 
-def discover_server():
-    """Автообнаружение сервера через UDP (блокирующий вариант)"""
-    logging.info("Запуск автообнаружения сервера через UDP...")
+def _cpu_model():
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or None
+
+def _memory_total():
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def _mount_points():
+    """Точки монтирования блочных устройств (без tmpfs, proc и т. п.)."""
+    try:
+        with open("/proc/mounts") as f:
+            mounts = [line.split()[1] for line in f if line.startswith("/dev/")]
+    except OSError:
+        mounts = []
+    return sorted(set(mounts)) or [os.path.abspath(os.sep)]
+
+def _ip_addresses():
+    addresses = set()
+    try:
+        addresses.update(info[4][0] for info in socket.getaddrinfo(socket.gethostname(), None))
+    except OSError:
+        pass
+    try:
+        # Адрес интерфейса маршрута по умолчанию: connect для UDP ничего не отправляет
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(("192.0.2.1", 9))
+            addresses.add(s.getsockname()[0])
+    except OSError:
+        pass
+    return sorted(addresses)
+
+def collect_facts():
+    """
+    Факты о системе — плоский словарь "раздел.имя" -> значение, чтобы серверу
+    можно было отправлять разницу по отдельным фактам. Занятость дисков
+    округляется до процента: иначе факты менялись бы при каждом сборе.
+    """
+    facts = {
+        "hostname": socket.gethostname(),
+        "os.system": platform.system(),
+        "os.release": platform.release(),
+        "os.machine": platform.machine(),
+        "python.version": platform.python_version(),
+        "cpu.count": os.cpu_count(),
+        "cpu.model": _cpu_model(),
+        "memory.total": _memory_total(),
+        "net.ips": _ip_addresses(),
+    }
+    try:
+        release = platform.freedesktop_os_release()
+        facts["os.distro"] = release.get("ID")
+        facts["os.distro_version"] = release.get("VERSION_ID")
+    except (OSError, AttributeError):
+        pass
+    for mount in _mount_points():
+        try:
+            usage = shutil.disk_usage(mount)
+        except OSError:
+            continue
+        facts[f"disk.{mount}.total"] = usage.total
+        facts[f"disk.{mount}.used_percent"] = round(usage.used * 100 / usage.total) if usage.total else 0
+    return facts
+
+class FactsTracker:
+    """
+    Факты, подтверждённые сервером, и их версия. Серверу отправляется только
+    разница с подтверждённым состоянием; base — версия, к которой она
+    применяется (0 — полный снимок). Если версии разошлись, сервер отвечает
+    facts_resync, и следующим отправляется полный снимок.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.acked = {}
+        self.version = 0
+        self.pending = None  # (version, facts) отправленной и ещё не подтверждённой разницы
+
+    def delta(self, facts):
+        """Сообщение facts с изменениями или None, если сервер уже знает всё."""
+        with self.lock:
+            changed = {key: value for key, value in facts.items()
+                       if key not in self.acked or self.acked[key] != value}
+            removed = [key for key in self.acked if key not in facts]
+            if self.version and not changed and not removed:
+                return None
+            version = self.version + 1
+            self.pending = (version, facts)
+            return {"type": "facts", "base": self.version, "version": version, "set": changed, "unset": removed}
+
+    def ack(self, version):
+        with self.lock:
+            if self.pending is not None and self.pending[0] == version:
+                self.version, self.acked = self.pending
+                self.pending = None
+
+    def reset(self):
+        with self.lock:
+            self.acked, self.version, self.pending = {}, 0, None
+
+def send_facts(context, tracker):
+    """Выполняется в потоке пула: собирает факты и отправляет изменения через основной цикл."""
+    try:
+        msg = tracker.delta(collect_facts())
+    except Exception as e:
+        logging.error(f"Ошибка сбора фактов о системе: {e}")
+        return
+    if msg is None:
+        return
+    results = context.socket(zmq.PUSH)
+    results.connect(RESULTS_ENDPOINT)
+    try:
+        results.send_multipart([b"result", encode_message(msg)])
+    finally:
+        results.close(linger=-1)
+
+def discover_servers(window=DISCOVERY_WINDOW):
+    """
+    Рассылает DISCOVER и собирает ответы серверов в течение window секунд.
+    Возвращает предложения, отсортированные по нагрузке; сервер старой версии
+    отвечает простым ACK без нагрузки и оказывается в конце списка.
+    """
     broadcast_address = "255.255.255.255"
-    timeout = 5
     udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-    udp_socket.settimeout(timeout)
+    offers = {}
     try:
-        udp_socket.sendto(b"DISCOVER", (broadcast_address, UDP_PORT))
+        udp_socket.sendto(b"DISCOVER v2", (broadcast_address, UDP_PORT))
         logging.info(f"Отправлен DISCOVER-запрос на порт {UDP_PORT}")
-        data, addr = udp_socket.recvfrom(1024)
-        if data.decode().strip() == "ACK":
-            server_ip = addr[0]
-            config = load_config()
-            config["server_ip"] = server_ip
-            config["port"] = ZMQ_PORT
-            save_config(config)
-            return server_ip
+        deadline = time.time() + window
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            udp_socket.settimeout(remaining)
+            try:
+                data, addr = udp_socket.recvfrom(1024)
+            except socket.timeout:
+                break
+            text = data.decode(errors="replace").strip()
+            if text == "ACK":
+                offer = {"port": ZMQ_PORT, "load": float("inf"), "version": 1}
+            else:
+                try:
+                    offer = json.loads(text)
+                except ValueError:
+                    continue
+                if offer.get("status") != "ACK":
+                    continue
+            offer["ip"] = addr[0]
+            offers[(offer["ip"], offer["port"])] = offer
     except Exception as e:
         logging.error(f"Ошибка в автообнаружении: {e}")
-    return None
+    finally:
+        udp_socket.close()
+    return sorted(offers.values(), key=lambda offer: offer["load"])
 
-def execute_command(command):
+def discover_server():
+    """Автообнаружение: выбирает наименее загруженный сервер и запоминает его в конфигурации."""
+    logging.info("Запуск автообнаружения сервера через UDP...")
+    offers = discover_servers()
+    if not offers:
+        return None
+    best = offers[0]
+    logging.info(f"Найдено серверов: {len(offers)}, выбран {best['ip']}:{best['port']} "
+                 f"(нагрузка {best['load']}, версия {best['version']})")
+    config = load_config()
+    config["server_ip"] = best["ip"]
+    config["port"] = best["port"]
+    config["discovered_at"] = time.time()
+    save_config(config)
+    return best["ip"], best["port"]
+
+def resolve_server(config):
     """
-    Выполняет команду и возвращает результат выполнения.
-    Если команда начинается с 'shell:', то выполняется интерактивно с построчным выводом.
+    Адрес сервера (ip, порт) без лишних широковещательных запросов.
+    server_ip без discovered_at задан вручную и используется всегда;
+    найденный автообнаружением — пока не старше DISCOVERY_TTL.
     """
+    cached = (config["server_ip"], config.get("port", ZMQ_PORT)) if config.get("server_ip") else None
+    if cached and time.time() - config.get("discovered_at", float("inf")) < DISCOVERY_TTL:
+        return cached
+    if cached and "discovered_at" not in config:
+        return cached
+    # Кэш устарел: ищем заново, а если никто не ответил — пробуем прежний сервер
+    return discover_server() or cached
+
+class Rediscovery:
+    """
+    Повторное автообнаружение в фоновом потоке. Запускается, только если
+    сервер молчит дольше допустимого, и не чаще раза в SERVER_SILENCE_LIMIT.
+    """
+
+    def __init__(self):
+        self.thread = None
+        self.result = None
+        self.not_before = 0
+
+    def start(self, now):
+        if now < self.not_before or (self.thread is not None and self.thread.is_alive()):
+            return
+        self.not_before = now + SERVER_SILENCE_LIMIT
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        self.result = discover_server()
+
+    def take(self):
+        result, self.result = self.result, None
+        return result
+
+##############################################
+# Кодирование сообщений ROUTER/DEALER
+##############################################
+# Кадр в старом формате — просто JSON (начинается с '{'). Кадр в новом формате
+# начинается с байта заголовка 0b11EECC: EE — кодек тела, CC — сжатие.
+FRAME_MARKER = 0xC0
+ENCODINGS = {"json": 0, "msgpack": 1}
+COMPRESSIONS = {"none": 0, "zlib": 1, "zstd": 2}
+
+def supported_encodings():
+    return (["msgpack"] if msgpack is not None else []) + ["json"]
+
+def supported_compressions():
+    return (["zstd"] if zstandard is not None else []) + ["zlib", "none"]
+
+def encode_message(msg):
+    """Кодирует сообщение в согласованном формате; тело больше COMPRESS_THRESHOLD сжимается."""
+    encoding, compression = wire_format["encoding"], wire_format["compression"]
+    if encoding == "json" and compression == "none":
+        return json.dumps(msg).encode()
+    body = msgpack.packb(msg, use_bin_type=True) if encoding == "msgpack" else json.dumps(msg).encode()
+    compressed = 0
+    if compression != "none" and len(body) >= COMPRESS_THRESHOLD:
+        if compression == "zstd":
+            body = zstandard.ZstdCompressor().compress(body)
+        else:
+            body = zlib.compress(body)
+        compressed = COMPRESSIONS[compression]
+    return bytes([FRAME_MARKER | ENCODINGS[encoding] << 2 | compressed]) + body
+
+def decode_message(data):
+    """Декодирует кадр любого поддерживаемого формата (формат описан в самом кадре)."""
+    if not data or data[0] & FRAME_MARKER != FRAME_MARKER:
+        return json.loads(data.decode())
+    header, body = data[0], data[1:]
+    compressed = header & 0x03
+    if compressed == COMPRESSIONS["zlib"]:
+        body = zlib.decompress(body)
+    elif compressed == COMPRESSIONS["zstd"]:
+        body = zstandard.ZstdDecompressor().decompress(body)
+    if (header >> 2) & 0x03 == ENCODINGS["msgpack"]:
+        return msgpack.unpackb(body, raw=False)
+    return json.loads(body.decode())
+
+def send_message(dealer, msg):
+    dealer.send(encode_message(msg))
+
+def apply_wire_format(reg_reply):
+    """Переключается на формат, выбранный сервером в ответе на регистрацию."""
+    wire_format.update(encoding=reg_reply.get("encoding", "json"),
+                       compression=reg_reply.get("compression", "none"))
+
+def kill_process(proc):
+    """Завершает процесс команды вместе с порождёнными им процессами."""
     try:
-        if command.startswith("shell:"):
-            cmd = command[len("shell:"):].strip()
-            logging.info(f"Запуск интерактивного режима для команды: {cmd}")
-            proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            stdout_lines = []
-            # Читаем вывод построчно и логируем его
-            while True:
-                line = proc.stdout.readline()
-                if not line:
-                    break
-                stdout_lines.append(line)
-                logging.info(f"Вывод: {line.strip()}")
-            # Читаем оставшийся вывод ошибок
-            stderr_output = proc.stderr.read()
-            proc.wait()
-            return {"stdout": "".join(stdout_lines), "stderr": stderr_output, "returncode": proc.returncode}
+        if hasattr(os, "killpg"):
+            os.killpg(proc.pid, signal.SIGKILL)
         else:
-            result = subprocess.run(command, shell=True, text=True, capture_output=True)
-            return {"stdout": result.stdout, "stderr": result.stderr, "returncode": result.returncode}
+            proc.kill()
+    except (ProcessLookupError, PermissionError):
+        pass
+
+def stop_command(request_id, reason):
+    """Останавливает выполняющуюся команду (по таймауту или отмене с сервера)."""
+    with running_lock:
+        running = running_commands.get(request_id)
+        if running is None:
+            return False
+        running["reason"] = running["reason"] or reason
+    kill_process(running["proc"])
+    return True
+
+class OutputCapture:
+    """
+    Захват одного потока вывода команды (stdout или stderr) с ограниченной памятью.
+    Пока вывод не больше OUTPUT_INLINE_LIMIT, он целиком хранится в памяти.
+    Дальше весь вывод пишется во временный файл в OUTPUT_SPILL_DIR, а в памяти
+    остаются только начало (OUTPUT_HEAD_LIMIT) и кольцевой буфер хвоста
+    (OUTPUT_TAIL_LIMIT). Полный вывод сервер забирает по handle порциями (fetch_output).
+    Размер считается в байтах UTF-8, как и смещения в read_spilled_output.
+    """
+
+    def __init__(self, handle, stream):
+        self.handle = handle
+        self.stream = stream
+        self.size = 0
+        self.buffer = []  # весь вывод, пока он не сброшен на диск
+        self.head = ""
+        self.tail = deque()
+        self.tail_size = 0
+        self.spill = None
+
+    def write(self, text):
+        data = text.encode("utf-8", errors="replace")
+        self.size += len(data)
+        self.tail.append(text)
+        self.tail_size += len(text)
+        while self.tail_size - len(self.tail[0]) >= OUTPUT_TAIL_LIMIT:
+            self.tail_size -= len(self.tail.popleft())
+        if self.spill is not None:
+            self.spill.write(data)
+            return
+        self.buffer.append(text)
+        if self.size > OUTPUT_INLINE_LIMIT:
+            os.makedirs(OUTPUT_SPILL_DIR, exist_ok=True)
+            buffered = "".join(self.buffer)
+            self.head = buffered[:OUTPUT_HEAD_LIMIT]
+            self.spill = open(spill_path(self.handle, self.stream), "wb")
+            self.spill.write(buffered.encode("utf-8", errors="replace"))
+            self.buffer = []
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+
+    def result(self):
+        """Поля результата команды для этого потока."""
+        if self.spill is None:
+            return {self.stream: "".join(self.buffer), f"{self.stream}_size": self.size}
+        # Хвост обрезается точно по лимиту: первая порция кольцевого буфера может быть шире
+        tail = "".join(self.tail)[-OUTPUT_TAIL_LIMIT:]
+        return {self.stream: tail, f"{self.stream}_head": self.head, f"{self.stream}_size": self.size,
+                f"{self.stream}_spilled": True}
+
+def spill_path(handle, stream):
+    return os.path.join(OUTPUT_SPILL_DIR, f"{handle}.{stream}")
+
+def drain_pipe(pipe, capture, on_output=None):
+    """
+    Вычитывает канал до конца в capture. С on_output вывод читается построчно
+    и передаётся порциями не реже OUTPUT_FLUSH_INTERVAL (потоковый режим).
+    """
+    if on_output is None:
+        for data in iter(lambda: pipe.read(OUTPUT_CHUNK_SIZE), ""):
+            capture.write(data)
+        return
+    chunk = []
+    chunk_size = 0
+    last_flush = 0  # первая строка уходит сразу
+    for line in iter(lambda: pipe.readline(OUTPUT_CHUNK_SIZE), ""):
+        capture.write(line)
+        chunk.append(line)
+        chunk_size += len(line)
+        if chunk_size >= OUTPUT_CHUNK_SIZE or time.time() - last_flush >= OUTPUT_FLUSH_INTERVAL:
+            on_output("".join(chunk))
+            chunk, chunk_size, last_flush = [], 0, time.time()
+    if chunk:
+        on_output("".join(chunk))
+
+def execute_command(command, on_output=None, request_id=None, timeout=None):
+    """
+    Выполняет команду и возвращает результат выполнения.
+    stdout и stderr вычитываются одновременно (stderr — в отдельном потоке),
+    поэтому команда, заполнившая один из каналов, не блокирует агента.
+    Если команда начинается с 'shell:', то выполняется интерактивно с построчным выводом:
+    вывод порциями передаётся в on_output.
+    Большой вывод сбрасывается на диск (см. OutputCapture): тогда в результате
+    начало и хвост каждого потока и output_handle для запроса полного вывода.
+    По истечении timeout или при отмене процесс команды принудительно завершается.
+    """
+    request_id = request_id or uuid.uuid4().hex
+    shell_mode = command.startswith("shell:")
+    cmd = command[len("shell:"):].strip() if shell_mode else command
+    try:
+        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                text=True, errors="replace", start_new_session=True)
     except Exception as e:
         return {"error": str(e)}
+    with running_lock:
+        running_commands[request_id] = {"proc": proc, "reason": None}
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, stop_command, args=(request_id, "timeout"))
+        timer.daemon = True
+        timer.start()
+    handle = uuid.uuid4().hex
+    stdout_capture = OutputCapture(handle, "stdout")
+    stderr_capture = OutputCapture(handle, "stderr")
+    stderr_reader = threading.Thread(target=drain_pipe, args=(proc.stderr, stderr_capture), daemon=True)
+    stderr_reader.start()
+    try:
+        if shell_mode:
+            logging.info(f"Запуск интерактивного режима для команды: {cmd}")
+        drain_pipe(proc.stdout, stdout_capture, on_output if shell_mode else None)
+        stderr_reader.join()
+        proc.wait()
+        result = {"returncode": proc.returncode}
+        result.update(stdout_capture.result())
+        result.update(stderr_capture.result())
+        result["truncated"] = stdout_capture.spill is not None or stderr_capture.spill is not None
+        if result["truncated"]:
+            result["output_handle"] = handle
+    except Exception as e:
+        kill_process(proc)
+        result = {"error": str(e)}
+    finally:
+        if timer is not None:
+            timer.cancel()
+        stdout_capture.close()
+        stderr_capture.close()
+        with running_lock:
+            reason = running_commands.pop(request_id)["reason"]
+    if reason == "timeout":
+        result["timed_out"] = True
+    elif reason == "cancelled":
+        result["cancelled"] = True
+    return result
+
+def read_spilled_output(handle, stream="stdout", offset=0, length=OUTPUT_FETCH_LIMIT):
+    """
+    Порция сброшенного на диск вывода команды. Смещения в байтах; конец порции
+    сдвигается к границе символа UTF-8, поэтому следующий запрос идёт с next_offset.
+    """
+    if not re.fullmatch(r"[0-9a-f]{32}", str(handle)) or stream not in ("stdout", "stderr"):
+        return {"error": "Некорректный handle или поток"}
+    try:
+        with open(spill_path(handle, stream), "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            offset = max(0, min(int(offset), size))
+            f.seek(offset)
+            data = f.read(max(1, min(int(length), OUTPUT_FETCH_LIMIT)))
+    except FileNotFoundError:
+        return {"error": f"Вывод {handle} ({stream}) не найден или уже удалён"}
+    end = len(data)
+    if offset + end < size:
+        # Ищем начальный байт последнего символа и отрезаем символ, если он не поместился целиком
+        lead = end - 1
+        while lead > 0 and end - lead < 4 and data[lead] & 0xC0 == 0x80:
+            lead -= 1
+        if data[lead] >= 0xC0:
+            width = 2 if data[lead] < 0xE0 else 3 if data[lead] < 0xF0 else 4
+            if end - lead < width and lead > 0:
+                end = lead
+    return {"handle": handle, "stream": stream, "offset": offset, "size": size,
+            "data": data[:end].decode("utf-8", errors="replace"), "next_offset": offset + end,
+            "eof": offset + end >= size}
+
+def purge_spilled_output(now=None):
+    """Удаляет сброшенный на диск вывод старше OUTPUT_SPILL_TTL."""
+    now = now or time.time()
+    try:
+        names = os.listdir(OUTPUT_SPILL_DIR)
+    except FileNotFoundError:
+        return
+    for name in names:
+        path = os.path.join(OUTPUT_SPILL_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > OUTPUT_SPILL_TTL:
+                os.remove(path)
+        except OSError:
+            pass
+
+class FileReceiver:
+    """
+    Приём файла, раздаваемого сервером. Порции пишутся по порядку в dest.part,
+    поэтому после обрыва приём продолжается с последней целой порции. Рядом
+    в dest.part.json лежат sha256, размер и размер порции: продолжается только
+    приём того же файла, иначе dest.part начинается заново. Сервер
+    шлёт не дальше выданного кредита; кредит продлевается, когда израсходована
+    половина окна FILE_CREDIT_WINDOW.
+    """
+
+    def __init__(self, offer):
+        self.transfer_id = offer["transfer_id"]
+        self.dest = offer["dest"]
+        self.size = int(offer["size"])
+        self.sha256 = offer["sha256"]
+        self.chunk_size = int(offer["chunk_size"])
+        self.chunks = -(-self.size // self.chunk_size)
+        self.part = self.dest + ".part"
+        self.sidecar = self.part + ".json"
+        os.makedirs(os.path.dirname(os.path.abspath(self.dest)), exist_ok=True)
+        meta = {"sha256": self.sha256, "size": self.size, "chunk_size": self.chunk_size}
+        try:
+            with open(self.sidecar, "r") as f:
+                resume = json.load(f) == meta
+        except (OSError, ValueError):
+            resume = False
+        if not resume:
+            with open(self.sidecar, "w") as f:
+                json.dump(meta, f)
+        self.file = open(self.part, "r+b" if resume and os.path.exists(self.part) else "w+b")
+        have = os.fstat(self.file.fileno()).st_size
+        self.next = min(have // self.chunk_size, self.chunks)
+        self.file.truncate(self.next * self.chunk_size)
+        self.until = self.next + FILE_CREDIT_WINDOW
+        self.started_at = self.active_at = time.time()
+
+    def credit(self, resync=False):
+        return {"type": "file_credit", "transfer_id": self.transfer_id, "next": self.next,
+                "until": self.until, "resync": resync}
+
+    def write(self, index, data):
+        """Записывает порцию; возвращает кредит, если его пора продлить. Чужие и повторные порции пропускаются."""
+        if index != self.next:
+            return None
+        self.file.seek(index * self.chunk_size)
+        self.file.write(data)
+        self.next += 1
+        self.active_at = time.time()
+        metrics.inc("fluxops_agent_file_bytes_received_total", len(data))
+        if self.until - self.next <= FILE_CREDIT_WINDOW // 2 and not self.complete():
+            self.until = self.next + FILE_CREDIT_WINDOW
+            return self.credit()
+        return None
+
+    def complete(self):
+        return self.next >= self.chunks
+
+    def idle(self, now):
+        return now - self.active_at > FILE_IDLE_TIMEOUT
+
+    def close(self):
+        self.file.close()
+
+def finish_file(context, receiver):
+    """
+    Выполняется в потоке пула: сверяет контрольную сумму принятого файла,
+    переименовывает dest.part в dest и сообщает итог серверу (file_done).
+    """
+    receiver.close()
+    done = {"type": "file_done", "transfer_id": receiver.transfer_id, "ok": False}
+    try:
+        digest = hashlib.sha256()
+        with open(receiver.part, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        done["sha256"] = digest.hexdigest()
+        if done["sha256"] == receiver.sha256:
+            os.replace(receiver.part, receiver.dest)
+            done["ok"] = True
+            logging.info(f"Файл {receiver.dest} принят ({receiver.size} байт, "
+                         f"{time.time() - receiver.started_at:.1f} с)")
+        else:
+            os.remove(receiver.part)  # повреждённые данные докачивать бессмысленно
+            done["error"] = f"Контрольная сумма {receiver.dest} не совпала"
+    except OSError as e:
+        done["error"] = f"Не удалось сохранить {receiver.dest}: {e}"
+    if done["ok"] or "sha256" in done:
+        try:
+            os.remove(receiver.sidecar)
+        except OSError:
+            pass
+    if not done["ok"]:
+        logging.error(done["error"])
+    results = context.socket(zmq.PUSH)
+    results.connect(RESULTS_ENDPOINT)
+    try:
+        results.send_multipart([b"result", encode_message(done)])
+    finally:
+        results.close(linger=-1)
+
+def output_sender(sock, request_id):
+    """
+    Возвращает функцию отправки порций вывода команды серверу (command_output).
+    Отправка неблокирующая: если очередь сокета заполнена, порция отбрасывается,
+    а пропуск виден получателю по номеру seq.
+    """
+    seq = 0
+
+    def send(data):
+        nonlocal seq
+        frame = {"type": "command_output", "request_id": request_id, "seq": seq, "data": data}
+        seq += 1
+        try:
+            sock.send_multipart([b"output", encode_message(frame)], flags=zmq.NOBLOCK)
+        except zmq.Again:
+            metrics.inc("fluxops_agent_output_dropped_total")
+            logging.warning(f"Порция вывода {seq - 1} команды {request_id} отброшена: очередь отправки заполнена")
+
+    return send
+
+class Heartbeat:
+    """
+    Планировщик пингов. Любой отправленный серверу кадр уже подтверждает
+    живость, поэтому пинг нужен только после паузы в исходящем трафике.
+    В простое пауза растёт от половины интервала до интервала, заданного
+    сервером (heartbeat_interval), и случайно сокращается на HEARTBEAT_JITTER.
+    """
+
+    def __init__(self, interval=PING_INTERVAL):
+        self.interval = interval
+        self.delay = interval / 2
+        self.next_at = time.time() + self._jittered()
+
+    def _jittered(self):
+        return self.delay * random.uniform(1 - HEARTBEAT_JITTER, 1)
+
+    def set_interval(self, interval):
+        if interval and interval != self.interval:
+            logging.info(f"Сервер задал интервал пингов {interval} с")
+            self.interval = interval
+            self.delay = min(self.delay, interval)
+            self.next_at = min(self.next_at, time.time() + self._jittered())
+
+    def traffic(self, now):
+        """Отмечает отправку сообщения серверу: ближайший пинг откладывается."""
+        self.delay = self.interval / 2
+        self.next_at = now + self._jittered()
+
+    def pinged(self, now):
+        self.delay = min(self.delay * HEARTBEAT_BACKOFF, self.interval)
+        self.next_at = now + self._jittered()
+
+    def due(self, now):
+        return now >= self.next_at
+
+    def poll_timeout(self, now):
+        """Сколько миллисекунд можно ждать сообщений до следующего пинга."""
+        return max(0, int((self.next_at - now) * 1000))
+
+def run_command(context, msg):
+    """
+    Выполняется в потоке пула: запускает команду и передаёт вывод и результат
+    в основной цикл через inproc-сокет (ZeroMQ-сокеты нельзя делить между потоками).
+    """
+    cmd = msg["command"]
+    request_id = msg.get("request_id")
+    results = context.socket(zmq.PUSH)
+    results.setsockopt(zmq.SNDHWM, OUTPUT_SEND_HWM)
+    results.connect(RESULTS_ENDPOINT)
+    try:
+        if log_sampled():
+            logging.debug(f"Получена команда для выполнения [{request_id}]: {cmd}")
+        started = time.time()
+        result = execute_command(cmd, output_sender(results, request_id), request_id,
+                                 msg.get("timeout", DEFAULT_COMMAND_TIMEOUT))
+        metrics.observe("fluxops_agent_command_duration_seconds", time.time() - started)
+        if "error" in result:
+            outcome = "error"
+        elif result.get("timed_out"):
+            outcome = "timeout"
+        elif result.get("cancelled"):
+            outcome = "cancelled"
+        else:
+            outcome = "ok" if result.get("returncode") == 0 else "failed"
+        metrics.inc("fluxops_agent_commands_total", 1, (("outcome", outcome),))
+        res_msg = {"type": "command_result", "data": result, "command": cmd, "request_id": request_id}
+        results.send_multipart([b"result", encode_message(res_msg)])
+    finally:
+        results.close(linger=-1)
 
 def client():
     context = zmq.Context()
@@ -125,57 +882,217 @@ def client():
     client_info = get_client_info()
     identity = client_info["client_id"]
     dealer.setsockopt_string(zmq.IDENTITY, identity)
+    dealer.setsockopt(zmq.SNDHWM, OUTPUT_SEND_HWM)
     # Подключаемся к серверу (если IP сервера не указан, пробуем автообнаружение)
     config = load_config()
-    server_ip = config.get("server_ip") or discover_server()
-    if not server_ip:
+    server = resolve_server(config)
+    if not server:
         logging.critical("Сервер не обнаружен!")
         return 
-    dealer.connect(f"tcp://{server_ip}:{ZMQ_PORT}")
-    logging.info(f"Клиент {identity} подключён к серверу {server_ip}:{ZMQ_PORT}")
+    endpoint = f"tcp://{server[0]}:{server[1]}"
+    dealer.connect(endpoint)
+    logging.info(f"Клиент {identity} подключён к серверу {endpoint}")
+    # Заданный вручную сервер не меняем; найденный автообнаружением ищем заново, если он замолчал
+    static_server = "discovered_at" not in load_config()
+    rediscovery = Rediscovery()
+    last_heard = time.time()
 
-    # Отправляем сообщение регистрации
-    reg_msg = {"type": "register", "data": client_info}
+    # Отправляем сообщение регистрации (всегда в JSON) с поддерживаемыми форматами
+    reg_msg = {"type": "register",
+               "data": dict(client_info, encodings=supported_encodings(), compressions=supported_compressions())}
     dealer.send_json(reg_msg)
     reg_reply_parts = dealer.recv_multipart()
+    heartbeat = Heartbeat()
     if len(reg_reply_parts) >= 1:
-        reg_reply = json.loads(reg_reply_parts[-1].decode())
+        reg_reply = decode_message(reg_reply_parts[-1])
+        apply_wire_format(reg_reply)
+        heartbeat.set_interval(reg_reply.get("heartbeat_interval"))
         logging.info(f"Ответ сервера на регистрацию: {reg_reply}")
     else:
         logging.error("Неверный ответ на регистрацию.")
 
-    # Основной цикл: ожидание сообщений от сервера
+    # Результаты и вывод команд из потоков пула
+    results = context.socket(zmq.PULL)
+    results.bind(RESULTS_ENDPOINT)
+    max_workers = int(config.get("max_concurrent_commands", MAX_CONCURRENT_COMMANDS))
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    # Сбор фактов и проверка принятых файлов не занимают места команд и не ждут их
+    housekeeping = ThreadPoolExecutor(max_workers=HOUSEKEEPING_WORKERS)
+    submitted = {}  # request_id -> Future команд, переданных в пул
+    # Недавно принятые request_id: повторно доставленная пачка из очереди сервера не выполняется дважды
+    seen_requests = deque(maxlen=SEEN_REQUESTS_LIMIT)
+    seen_set = set()
+
+    def submit(msg):
+        request_id = msg.get("request_id")
+        if request_id in seen_set:
+            return
+        if len(seen_requests) == seen_requests.maxlen:
+            seen_set.discard(seen_requests[0])
+        seen_requests.append(request_id)
+        seen_set.add(request_id)
+        future = executor.submit(run_command, context, msg)
+        submitted[request_id] = future
+        future.add_done_callback(lambda f, rid=request_id: submitted.pop(rid, None))
+
+    receivers = {}  # transfer_id -> FileReceiver принимаемых файлов
+
+    def receive_file(receiver, reply=None):
+        """Отправляет серверу кредит или, если файл принят целиком, передаёт его на проверку."""
+        if receiver.complete():
+            del receivers[receiver.transfer_id]
+            housekeeping.submit(finish_file, context, receiver)
+        elif reply is not None:
+            send_message(dealer, reply)
+            heartbeat.traffic(time.time())
+
+    poller = zmq.Poller()
+    poller.register(dealer, zmq.POLLIN)
+    poller.register(results, zmq.POLLIN)
+    metrics_file = config.get("metrics_file", METRICS_FILE)
+    housekeeping_due = time.time()
+    facts = FactsTracker()
+    facts_interval = float(config.get("facts_interval", FACTS_INTERVAL))
+    # Первый снимок фактов — сразу после регистрации
+    facts_due = time.time() if facts_interval > 0 else float("inf")
+
+    # Основной цикл: ожидание сообщений от сервера и результатов команд
     while True:
-        if dealer.poll(5000):  # ждем до 5 секунд сообщения
+        socks = dict(poller.poll(heartbeat.poll_timeout(time.time())))
+        if results in socks:
+            kind, payload = results.recv_multipart()
+            if kind == b"output":
+                try:
+                    dealer.send(payload, flags=zmq.NOBLOCK)
+                except zmq.Again:
+                    metrics.inc("fluxops_agent_output_dropped_total")
+                    logging.warning("Порция вывода отброшена: очередь отправки серверу заполнена")
+            else:
+                dealer.send(payload)
+            metrics.inc("fluxops_agent_messages_total", 1, (("direction", "out"), ("type", kind.decode())))
+            heartbeat.traffic(time.time())
+        if dealer in socks:
+            last_heard = time.time()
             msg_parts = dealer.recv_multipart()
-            if len(msg_parts) >= 1:
-                msg = json.loads(msg_parts[-1].decode())
-                if "command" in msg:
-                    cmd = msg["command"]
-                    logging.info(f"Получена команда для выполнения: {cmd}")
-                    result = execute_command(cmd)
-                    res_msg = {"type": "command_result", "data": result, "command": cmd}
-                    dealer.send_json(res_msg)
-                    ack_parts = dealer.recv_multipart()
-                    if len(ack_parts) >= 1:
-                        ack = json.loads(ack_parts[-1].decode())
-                        logging.info(f"Подтверждение сервера: {ack}")
+            if len(msg_parts) >= 3:
+                # Порция раздаваемого файла: заголовок и сырые данные отдельными кадрами
+                msg = decode_message(msg_parts[-2])
+                receiver = receivers.get(msg.get("transfer_id"))
+                if receiver is not None:
+                    receive_file(receiver, receiver.write(msg.get("index"), msg_parts[-1]))
+            elif len(msg_parts) >= 1:
+                msg = decode_message(msg_parts[-1])
+                metrics.inc("fluxops_agent_messages_total", 1,
+                            (("direction", "in"), ("type", msg.get("type") or msg.get("status") or "command")))
+                if msg.get("type") == "cancel":
+                    request_id = msg.get("request_id")
+                    future = submitted.pop(request_id, None)
+                    if future is not None and future.cancel():
+                        res_msg = {"type": "command_result", "data": {"cancelled": True}, "request_id": request_id}
+                        send_message(dealer, res_msg)
+                        heartbeat.traffic(time.time())
+                    elif stop_command(request_id, "cancelled"):
+                        logging.info(f"Команда {request_id} отменена сервером")
+                elif msg.get("status") == "alive":
+                    heartbeat.set_interval(msg.get("heartbeat_interval"))
+                elif msg.get("status") == "unregistered":
+                    # Сервер перезапущен и не знает клиента — регистрируемся заново
+                    logging.info("Сервер не знает клиента, повторная регистрация")
+                    wire_format.update(encoding="json", compression="none")
+                    dealer.send_json(reg_msg)
+                    heartbeat.traffic(time.time())
+                elif msg.get("status") == "registered":
+                    apply_wire_format(msg)
+                    heartbeat.set_interval(msg.get("heartbeat_interval"))
+                    # Сервер мог быть перезапущен и не знать фактов — отправляем полный снимок
+                    facts.reset()
+                    if facts_interval > 0:
+                        facts_due = min(facts_due, time.time())
+                elif msg.get("type") == "facts_ack":
+                    facts.ack(msg.get("version"))
+                elif msg.get("type") == "facts_resync":
+                    facts.reset()
+                    if facts_interval > 0:
+                        facts_due = min(facts_due, time.time())
+                elif msg.get("type") == "command_batch":
+                    # Команды, накопленные сервером, пока клиент был недоступен: сначала в пул, потом подтверждение
+                    commands = msg.get("commands", [])
+                    for command_msg in commands:
+                        submit(command_msg)
+                    send_message(dealer, {"type": "batch_ack",
+                                          "request_ids": [command_msg.get("request_id") for command_msg in commands]})
+                    heartbeat.traffic(time.time())
+                    logging.info(f"Получена пачка команд из очереди сервера: {len(commands)}")
+                elif "command" in msg:
+                    submit(msg)
+                elif msg.get("type") == "fetch_output":
+                    # Чтение порции с диска ограничено OUTPUT_FETCH_LIMIT, поэтому идёт прямо в основном цикле
+                    chunk = read_spilled_output(msg.get("handle"), msg.get("stream", "stdout"),
+                                                msg.get("offset", 0), msg.get("length", OUTPUT_FETCH_LIMIT))
+                    send_message(dealer, {"type": "output_chunk", "request_id": msg.get("request_id"), "data": chunk})
+                    heartbeat.traffic(time.time())
+                elif msg.get("type") == "file_offer":
+                    # Новое или повторное (после обрыва) предложение файла: продолжаем с того, что уже принято
+                    previous = receivers.pop(msg.get("transfer_id"), None)
+                    if previous is not None:
+                        previous.close()
+                    try:
+                        receiver = FileReceiver(msg)
+                    except OSError as e:
+                        logging.error(f"Не удалось принять файл {msg.get('dest')}: {e}")
+                        send_message(dealer, {"type": "file_done", "transfer_id": msg.get("transfer_id"),
+                                              "ok": False, "error": str(e)})
                     else:
-                        logging.warning("Неверный формат подтверждения от сервера.")
+                        receivers[receiver.transfer_id] = receiver
+                        logging.info(f"Приём файла {receiver.dest}: {receiver.size} байт, "
+                                     f"с порции {receiver.next} из {receiver.chunks}")
+                        receive_file(receiver, receiver.credit(resync=True))
+                    heartbeat.traffic(time.time())
+                elif msg.get("status") == "received":
+                    # Подтверждение доставки результата — штатный ответ, в лог только выборочно
+                    if log_sampled():
+                        logging.debug(f"Сервер подтвердил результат {msg.get('request_id')}")
                 else:
                     logging.info(f"Сообщение от сервера: {msg}")
             else:
                 logging.warning("Получено некорректное сообщение от сервера.")
-        else:
-            # Если сообщений нет, отправляем пинг для поддержания связи
-            dealer.send_json({"type": "ping"})
-            ping_reply_parts = dealer.recv_multipart()
-            if len(ping_reply_parts) >= 1:
-                ping_reply = json.loads(ping_reply_parts[-1].decode())
-                logging.info(f"Ответ на пинг: {ping_reply}")
-            else:
-                logging.warning("Нет ответа на пинг.")
-        time.sleep(1)
+        now = time.time()
+        silent = now - last_heard > max(SERVER_SILENCE_LIMIT, 3 * heartbeat.interval)
+        if silent and not static_server:
+            rediscovery.start(now)
+        found = rediscovery.take()
+        if found is not None and silent:
+            new_endpoint = f"tcp://{found[0]}:{found[1]}"
+            if new_endpoint != endpoint:
+                logging.warning(f"Сервер {endpoint} не отвечает, переключаемся на {new_endpoint}")
+                dealer.disconnect(endpoint)
+                dealer.connect(new_endpoint)
+                endpoint = new_endpoint
+                wire_format.update(encoding="json", compression="none")
+                dealer.send_json(reg_msg)
+                heartbeat.traffic(now)
+            last_heard = now
+        if heartbeat.due(now):
+            # Давно ничего не отправляли — пинг для поддержания связи; ответ придёт в основной цикл
+            send_message(dealer, {"type": "ping"})
+            heartbeat.pinged(now)
+            metrics.inc("fluxops_agent_pings_total")
+        if now >= housekeeping_due:
+            if metrics_file:
+                try:
+                    metrics.write(metrics_file)
+                except OSError as e:
+                    logging.warning(f"Не удалось записать метрики в {metrics_file}: {e}")
+            purge_spilled_output(now)
+            # Сервер бросил раздачу (перезапуск, отмена): закрываем файл, dest.part остаётся для докачки
+            for receiver in [r for r in receivers.values() if r.idle(now)]:
+                logging.warning(f"Приём файла {receiver.dest} прерван: нет порций {FILE_IDLE_TIMEOUT} с")
+                del receivers[receiver.transfer_id]
+                receiver.close()
+            housekeeping_due = now + METRICS_FLUSH_INTERVAL
+        if now >= facts_due:
+            housekeeping.submit(send_facts, context, facts)
+            facts_due = now + facts_interval
 
 if __name__ == "__main__":
     try:
@@ -1,13 +1,548 @@
+import asyncio
+import bisect
+import zlib
+import itertools
 import logging
-import socket
+import os
 import json
+import time
+import uuid
+import zmq
+import zmq.asyncio
+from collections import defaultdict, OrderedDict
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi import Request, Response, Query
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 from fastapi.middleware.cors import CORSMiddleware
+try:
+    from .metrics import Metrics, merge_rendered  # uvicorn server.api:app из корня репозитория
+except ImportError:
+    from metrics import Metrics, merge_rendered  # uvicorn api:app из каталога server
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Путь к файлу: рядом с api.py, из какого бы каталога ни запускали
+CLIENTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "clients.json")
+# Задержка отложенной записи реестра на диск, секунд
+CLIENTS_FLUSH_DELAY = 2.0
+
+# Сколько удалённых клиентов помнить для ответа «изменения с версии N»; кто отстал сильнее — получает всё
+CLIENTS_TOMBSTONE_LIMIT = 10000
+# Максимальное ожидание изменений в режиме long-poll, секунд
+CLIENTS_LONG_POLL_MAX = 60
+# Поля клиента, которые можно запросить через fields
+CLIENT_FIELDS = ("id", "address", "status", "hostname", "group", "last_active")
+
+# Командный интерфейс ZeroMQ-сервера (server.py, TCP_COMMAND_PORT)
+COMMAND_SERVER_ENDPOINT = "tcp://localhost:9997"
+# Число DEALER-соединений с командным интерфейсом, запросы распределяются по кругу
+COMMAND_POOL_SIZE = 4
+# Запас к таймауту команды на доставку ответа через server.py, секунд
+COMMAND_TIMEOUT_MARGIN = 5
+# PUB-сокет событий ZeroMQ-сервера (server.py, EVENTS_PORT)
+EVENTS_ENDPOINT = "tcp://localhost:5556"
+# Сколько событий держать для одного WebSocket-подписчика
+WS_QUEUE_SIZE = 256
+# Что делать с подписчиком, не успевающим читать: "drop_oldest" или "disconnect"
+WS_SLOW_POLICY = "drop_oldest"
+# Локальный сокет метрик server.py (STATS_ENDPOINT), его ряды отдаются вместе с рядами API
+SERVER_STATS_ENDPOINT = "tcp://127.0.0.1:9995"
+SERVER_STATS_TIMEOUT = 2.0
+# Таймаут запроса одной порции полного вывода команды у клиента, секунд
+OUTPUT_FETCH_TIMEOUT = 30
+# Как часто сверять реестр с server.py (события живости по PUB/SUB могут теряться), секунд
+CLIENTS_SYNC_INTERVAL = 60
+
+zmq_context = zmq.asyncio.Context.instance()
+
+# Метрики API в текстовом формате Prometheus
+metrics = Metrics()
+
+# Реестр клиентов в памяти процесса
+class ClientRegistry:
+    """
+    Единственный источник правды о клиентах для API.
+    clients.json читается один раз при старте; изменения накапливаются
+    и пишутся на диск пачкой через CLIENTS_FLUSH_DELAY секунд атомарно
+    (временный файл + переименование). Чтения диск не трогают.
+    Каждое изменение увеличивает generation; снимок запоминает, какое поколение
+    он сохранил, поэтому изменение, сделанное во время записи, не теряется:
+    за ним идёт следующая запись.
+    Каждое изменение увеличивает version; changes хранит версию последнего
+    изменения каждого клиента (удалённые — до CLIENTS_TOMBSTONE_LIMIT),
+    поэтому ответ «что изменилось с версии N» не обходит весь реестр.
+    Наружу версия отдаётся вместе с epoch — случайным идентификатором
+    процесса, ведь после перезапуска API счётчик начинается заново.
+    """
+
+    def __init__(self, filename, flush_delay=CLIENTS_FLUSH_DELAY):
+        self.filename = filename
+        self.flush_delay = flush_delay
+        self.clients = {}
+        self.order = []  # client_id по возрастанию, для курсорной пагинации
+        self.by_status = defaultdict(set)
+        self.by_group = defaultdict(set)
+        self.by_hostname = []  # (hostname, client_id) по возрастанию, для отбора по префиксу имени
+        self.version = 0
+        self.epoch = uuid.uuid4().hex[:8]
+        self.changes = OrderedDict()  # client_id -> (версия последнего изменения, удалён ли), от старых к новым
+        self.tombstones = 0
+        self.horizon = 0  # изменения до этой версии забыты
+        self._changed = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.generation = 0  # номер последнего изменения
+        self.saved_generation = 0  # номер изменения, попавшего в файл
+        self._flush_task = None
+        self._flush_now = asyncio.Event()
+
+    def load(self):
+        try:
+            with open(self.filename, "r") as file:
+                clients_data = json.load(file)
+        except FileNotFoundError:
+            logger.warning(f"Clients file {self.filename} not found, starting with empty registry")
+            clients_data = {}
+        except json.JSONDecodeError as e:
+            # Отложенная запись заменила бы испорченный файл почти пустым реестром — убираем его в сторону
+            corrupt_filename = f"{self.filename}.corrupt-{int(time.time())}"
+            try:
+                os.replace(self.filename, corrupt_filename)
+            except OSError as move_error:
+                raise RuntimeError(f"Clients file {self.filename} is corrupt ({e}) "
+                                   f"and could not be moved aside: {move_error}") from e
+            logger.error(f"Error decoding clients file: {e}; moved to {corrupt_filename}, starting with empty registry")
+            clients_data = {}
+        self.clients = {}
+        self.order = []
+        self.by_status.clear()
+        self.by_group.clear()
+        self.by_hostname = []
+        for client_id, client_data in clients_data.items():
+            self._add(client_id, client_data)
+        self._touch(*self.clients)
+        logger.info(f"Загружено клиентов из {self.filename}: {len(self.clients)}")
+
+    def _add(self, client_id, client_data):
+        self.clients[client_id] = client_data
+        bisect.insort(self.order, client_id)
+        self.by_status[client_data.get("status")].add(client_id)
+        self.by_group[client_data.get("group")].add(client_id)
+        bisect.insort(self.by_hostname, (client_data.get("hostname") or "", client_id))
+
+    def _remove(self, client_id):
+        client_data = self.clients.pop(client_id)
+        del self.order[bisect.bisect_left(self.order, client_id)]
+        self.by_status[client_data.get("status")].discard(client_id)
+        del self.by_hostname[bisect.bisect_left(self.by_hostname, (client_data.get("hostname") or "", client_id))]
+        self.by_group[client_data.get("group")].discard(client_id)
+        return client_data
+
+    def _touch(self, *client_ids):
+        """Отмечает изменение клиентов новой версией реестра и будит ожидающих long-poll."""
+        self.version += 1
+        for client_id in client_ids:
+            previous = self.changes.pop(client_id, None)
+            if previous is not None and previous[1]:
+                self.tombstones -= 1
+            deleted = client_id not in self.clients
+            self.changes[client_id] = (self.version, deleted)
+            self.tombstones += deleted
+        # Забываем самые старые изменения, пока удалённых слишком много
+        while self.tombstones > CLIENTS_TOMBSTONE_LIMIT:
+            _, (version, deleted) = self.changes.popitem(last=False)
+            self.horizon = version
+            self.tombstones -= deleted
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    @property
+    def token(self):
+        """Версия для клиентов API: "<epoch>-<version>"."""
+        return f"{self.epoch}-{self.version}"
+
+    def parse_token(self, token):
+        """Версия из токена; None, если токен выдан другим процессом или из будущего."""
+        epoch, _, version = token.rpartition("-")
+        if epoch != self.epoch or not version.isdigit() or int(version) > self.version:
+            return None
+        return int(version)
+
+    def changed_since(self, version):
+        """(изменённые client_id, удалённые client_id) после версии version; None — нужна полная выгрузка."""
+        if version is None or version < self.horizon:
+            return None
+        changed, deleted = [], []
+        for client_id, (changed_at, removed) in reversed(self.changes.items()):
+            if changed_at <= version:
+                break
+            (deleted if removed else changed).append(client_id)
+        return changed, deleted
+
+    async def wait_changed(self, version, timeout):
+        """Ждёт, пока версия реестра станет больше version, не дольше timeout секунд."""
+        while self.version <= version:
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                return
+
+    def with_hostname_prefix(self, prefix):
+        """client_id клиентов, чьё имя начинается с prefix: двоичный поиск по by_hostname."""
+        ids = set()
+        for hostname, client_id in itertools.islice(self.by_hostname, bisect.bisect_left(self.by_hostname, (prefix,)), None):
+            if not hostname.startswith(prefix):
+                break
+            ids.add(client_id)
+        return ids
+
+    def select(self, status=None, group=None, hostname_prefix=None, cursor=None, limit=None):
+        """
+        Клиенты по возрастанию client_id после cursor, подходящие под фильтры.
+        Возвращает (список client_id, курсор следующей страницы или None).
+        """
+        if status is not None or group is not None or hostname_prefix:
+            candidates = None
+            for index, key in ((self.by_status, status), (self.by_group, group)):
+                if key is not None:
+                    ids = index.get(key, set())
+                    candidates = ids if candidates is None else candidates & ids
+            if hostname_prefix:
+                ids = self.with_hostname_prefix(hostname_prefix)
+                candidates = ids if candidates is None else candidates & ids
+            ordered = sorted(candidates)
+        else:
+            ordered = self.order
+        start = bisect.bisect_right(ordered, cursor) if cursor is not None else 0
+        selected = []
+        for client_id in itertools.islice(ordered, start, None):
+            if limit is not None and len(selected) == limit:
+                return selected, selected[-1]
+            selected.append(client_id)
+        return selected, None
+
+    def get(self, client_id):
+        return self.clients.get(client_id)
+
+    def items(self):
+        return self.clients.items()
+
+    async def put(self, client_id, client_data):
+        """Добавляет или заменяет запись клиента."""
+        async with self.lock:
+            if self.clients.get(client_id) == client_data:
+                return
+            if client_id in self.clients:
+                self._remove(client_id)
+            self._add(client_id, client_data)
+            self._touch(client_id)
+            self._schedule_flush()
+
+    async def rename(self, client_id, new_client_id, changes):
+        """Переносит клиента под новый идентификатор, применяя изменения полей."""
+        async with self.lock:
+            if client_id not in self.clients:
+                raise KeyError(client_id)
+            if new_client_id != client_id and new_client_id in self.clients:
+                raise ValueError(new_client_id)
+            client_data = dict(self._remove(client_id), **changes)
+            self._add(new_client_id, client_data)
+            self._touch(client_id, new_client_id)
+            self._schedule_flush()
+            return client_data
+
+    async def delete(self, client_id):
+        async with self.lock:
+            if client_id not in self.clients:
+                raise KeyError(client_id)
+            self._remove(client_id)
+            self._touch(client_id)
+            self._schedule_flush()
+
+    @property
+    def dirty(self):
+        return self.generation != self.saved_generation
+
+    def _schedule_flush(self):
+        self.generation += 1
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        # Пишем, пока есть несохранённые изменения: пока шла запись, могли прийти новые
+        while self.dirty:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), self.flush_delay)
+            except asyncio.TimeoutError:
+                pass
+            if not await self.flush():
+                break  # повторим при следующем изменении или при остановке
+
+    async def flush(self):
+        """Атомарно записывает снимок реестра в файл. Возвращает True при успехе."""
+        async with self.lock:
+            generation = self.generation
+            snapshot = json.dumps(self.clients, separators=(",", ":"))
+        try:
+            await asyncio.to_thread(self._write, snapshot)
+        except Exception as e:
+            logger.error(f"Error saving clients file: {e}")
+            return False
+        self.saved_generation = max(self.saved_generation, generation)
+        logger.info(f"Сохранены данные клиентов в {self.filename}")
+        return True
+
+    def _write(self, snapshot):
+        tmp_filename = f"{self.filename}.tmp"
+        with open(tmp_filename, "w") as file:
+            file.write(snapshot)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_filename, self.filename)
+
+    async def close(self):
+        """Дописывает отложенные изменения при остановке приложения."""
+        # Не отменяем запись на полпути: будим отложенную запись и ждём её
+        self._flush_now.set()
+        if self._flush_task is not None:
+            await self._flush_task
+        if self.dirty:
+            await self.flush()
+
+registry = ClientRegistry(CLIENTS_FILE)
+
+# Асинхронный транспорт к командному интерфейсу server.py
+class CommandTransport:
+    """
+    Пул долгоживущих zmq.asyncio DEALER-соединений с командным интерфейсом.
+    Каждый запрос помечается tag, который server.py возвращает в ответе;
+    отдельная задача на соединение раскладывает ответы по ожидающим,
+    поэтому по одному соединению одновременно идёт много запросов.
+    Ответ приходит одним ZeroMQ-кадром целиком, без усечения.
+    """
+
+    def __init__(self, endpoint, pool_size=COMMAND_POOL_SIZE):
+        self.endpoint = endpoint
+        self.pool_size = pool_size
+        self.sockets = []
+        self.readers = []
+        self.waiters = {}  # tag -> asyncio.Queue для ответов на запрос
+        self._next_socket = None
+
+    def _connect(self):
+        for _ in range(self.pool_size):
+            dealer = zmq_context.socket(zmq.DEALER)
+            dealer.setsockopt(zmq.LINGER, 0)
+            dealer.connect(self.endpoint)
+            self.sockets.append(dealer)
+            self.readers.append(asyncio.create_task(self._read(dealer)))
+        self._next_socket = itertools.cycle(self.sockets)
+
+    async def _read(self, dealer):
+        """Раскладывает ответы по ожидающим; испорченный кадр пропускается, чтение продолжается."""
+        while True:
+            try:
+                payload = (await dealer.recv_multipart())[-1]
+            except zmq.ZMQError as e:
+                if dealer.closed:
+                    return
+                logger.error(f"Error reading command server reply: {e}")
+                await asyncio.sleep(1)
+                continue
+            try:
+                started = time.perf_counter()
+                frame = json.loads(payload.decode())
+                metrics.observe("fluxops_api_json_decode_seconds", time.perf_counter() - started)
+                waiter = self.waiters.get(frame.get("tag"))
+            except Exception as e:
+                metrics.inc("fluxops_api_bad_replies_total")
+                logger.error(f"Malformed command server reply skipped: {e!r}")
+                continue
+            if waiter is not None:
+                waiter.put_nowait(frame)
+
+    async def _send(self, tag, msg):
+        if not self.sockets:
+            self._connect()
+        self.waiters[tag] = asyncio.Queue()
+        await next(self._next_socket).send_multipart([b'', json.dumps(dict(msg, tag=tag)).encode()])
+        return self.waiters[tag]
+
+    async def request(self, msg, timeout):
+        """Отправляет запрос и возвращает единственный ответ; по таймауту — asyncio.TimeoutError."""
+        tag = uuid.uuid4().hex
+        try:
+            replies = await self._send(tag, msg)
+            return await asyncio.wait_for(replies.get(), timeout)
+        finally:
+            self.waiters.pop(tag, None)
+
+    async def stream(self, msg, timeout, is_last):
+        """Отправляет запрос и отдаёт ответы по мере поступления, пока is_last(ответ) ложно."""
+        tag = uuid.uuid4().hex
+        try:
+            replies = await self._send(tag, msg)
+            while True:
+                frame = await asyncio.wait_for(replies.get(), timeout)
+                yield frame
+                if is_last(frame):
+                    break
+        finally:
+            self.waiters.pop(tag, None)
+
+    def close(self):
+        for reader in self.readers:
+            reader.cancel()
+        for dealer in self.sockets:
+            dealer.close()
+        self.sockets, self.readers = [], []
+
+transport = CommandTransport(COMMAND_SERVER_ENDPOINT)
+
+# Рассылка событий WebSocket-подписчикам
+class BroadcastHub:
+    """
+    У каждого WebSocket своя ограниченная очередь и своя задача-писатель,
+    поэтому медленный браузер не задерживает остальных. Сообщение
+    сериализуется один раз, во все очереди кладётся одна и та же строка.
+    При переполнении очереди действует WS_SLOW_POLICY: вытеснить самое
+    старое сообщение или отключить подписчика.
+    """
+
+    def __init__(self, queue_size=WS_QUEUE_SIZE, slow_policy=WS_SLOW_POLICY):
+        self.queue_size = queue_size
+        self.slow_policy = slow_policy
+        self.subscribers = {}  # WebSocket -> {"name", "queue", "writer", "dropped"}
+
+    def subscribe(self, websocket: WebSocket):
+        events = asyncio.Queue(maxsize=self.queue_size)
+        self.subscribers[websocket] = {
+            "name": None,
+            "queue": events,
+            "writer": asyncio.create_task(self._write(websocket, events)),
+            "dropped": 0,
+        }
+
+    def unsubscribe(self, websocket: WebSocket):
+        subscriber = self.subscribers.pop(websocket, None)
+        if subscriber is not None:
+            subscriber["writer"].cancel()
+
+    def set_name(self, websocket: WebSocket, name: str):
+        if websocket in self.subscribers:
+            self.subscribers[websocket]["name"] = name
+
+    async def _write(self, websocket: WebSocket, events: asyncio.Queue):
+        try:
+            while True:
+                await websocket.send_text(await events.get())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error sending message to connected client: {e}")
+            self.subscribers.pop(websocket, None)
+
+    def publish(self, message):
+        """Кладёт сообщение (строку или JSON-совместимый объект) во все очереди без ожидания."""
+        text = message if isinstance(message, str) else json.dumps(message)
+        for websocket, subscriber in list(self.subscribers.items()):
+            events = subscriber["queue"]
+            if events.full():
+                if self.slow_policy == "disconnect":
+                    logger.warning(f"Disconnecting slow WebSocket subscriber {subscriber['name']}")
+                    self.unsubscribe(websocket)
+                    asyncio.create_task(websocket.close(code=1013))
+                    continue
+                events.get_nowait()
+                subscriber["dropped"] += 1
+                metrics.inc("fluxops_api_ws_dropped_total")
+            events.put_nowait(text)
+
+    def describe(self):
+        return [{"id": subscriber["name"], "queued": subscriber["queue"].qsize(), "dropped": subscriber["dropped"]}
+                for subscriber in self.subscribers.values()]
+
+hub = BroadcastHub()
+
+async def apply_client_status(event):
+    """Переносит состояние живости клиента из server.py в реестр API."""
+    client_data = dict(registry.get(event["client_id"]) or {"address": [event.get("ip"), None]})
+    client_data["status"] = event["status"]
+    client_data["last_active"] = event["last_seen"]
+    if event.get("hostname"):
+        client_data["hostname"] = event["hostname"]
+    if event.get("group"):
+        client_data["group"] = event["group"]
+    await registry.put(event["client_id"], client_data)
+
+async def sync_client_statuses():
+    """
+    Сверяет реестр с текущим состоянием клиентов в server.py. Клиенты
+    реестра, о которых server.py не знает, отмечаются как offline — кроме
+    случая, когда ответили не все воркеры (partial).
+    """
+    try:
+        reply = await transport.request({"action": "clients"}, COMMAND_TIMEOUT_MARGIN)
+    except asyncio.TimeoutError:
+        logger.warning("Command server is not responding, client statuses are not synced")
+        return
+    if reply.get("status") != "success":
+        logger.warning(f"Client statuses are not synced: {reply.get('message')}")
+        return
+    reported = set()
+    for event in reply.get("clients", []):
+        reported.add(event["client_id"])
+        await apply_client_status(event)
+    if reply.get("partial"):
+        return
+    for client_id in [client_id for client_id, client_data in registry.items()
+                      if client_id not in reported and client_data.get("status") != "offline"]:
+        client_data = registry.get(client_id)
+        if client_data is not None:
+            await registry.put(client_id, dict(client_data, status="offline"))
+
+async def sync_client_statuses_periodically():
+    while True:
+        await asyncio.sleep(CLIENTS_SYNC_INTERVAL)
+        try:
+            await sync_client_statuses()
+        except Exception as e:
+            logger.error(f"Error syncing client statuses: {e}")
+
+async def relay_events():
+    """Пересылает события server.py: вывод команд — подписчикам, живость — в реестр и подписчикам."""
+    subscriber = zmq_context.socket(zmq.SUB)
+    subscriber.setsockopt(zmq.SUBSCRIBE, b"output")
+    subscriber.setsockopt(zmq.SUBSCRIBE, b"liveness")
+    subscriber.connect(EVENTS_ENDPOINT)
+    try:
+        while True:
+            topic, payload = await subscriber.recv_multipart()
+            metrics.inc("fluxops_api_events_total", 1, (("topic", topic.decode()),))
+            if topic == b"liveness":
+                await apply_client_status(json.loads(payload))
+            hub.publish(payload.decode())
+    finally:
+        subscriber.close()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    registry.load()
+    relay_task = asyncio.create_task(relay_events())
+    await sync_client_statuses()
+    sync_task = asyncio.create_task(sync_client_statuses_periodically())
+    yield
+    sync_task.cancel()
+    relay_task.cancel()
+    transport.close()
+    await registry.close()
 
 # Создаем экземпляр приложения FastAPI
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Разрешаем доступ с фронтенда (localhost:3000)
 app.add_middleware(
@@ -18,9 +553,43 @@ app.add_middleware(
     allow_headers=["*"],  # Разрешить все заголовки
 )
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+@app.middleware("http")
+async def measure_requests(request: Request, call_next):
+    """Время обработки HTTP-запросов по шаблону маршрута, а не по конкретному URL."""
+    started = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    path = route.path if route is not None else "unmatched"
+    metrics.observe("fluxops_api_request_seconds", time.perf_counter() - started,
+                    (("method", request.method), ("path", path)))
+    metrics.inc("fluxops_api_requests_total", 1, (("path", path), ("status", response.status_code)))
+    return response
+
+async def fetch_server_stats():
+    """Снимает метрики server.py с его локального сокета; None, если сервер не ответил."""
+    stats = zmq_context.socket(zmq.REQ)
+    stats.setsockopt(zmq.LINGER, 0)
+    stats.connect(SERVER_STATS_ENDPOINT)
+    try:
+        await stats.send(b"stats")
+        if not await stats.poll(SERVER_STATS_TIMEOUT * 1000):
+            return None
+        return (await stats.recv()).decode()
+    finally:
+        stats.close()
+
+@app.get("/metrics")
+async def get_metrics():
+    metrics.set("fluxops_api_registry_clients", len(registry.clients))
+    for status, client_ids in registry.by_status.items():
+        metrics.set("fluxops_api_registry_clients_by_status", len(client_ids), (("status", status),))
+    metrics.set("fluxops_api_ws_subscribers", len(hub.subscribers))
+    metrics.set("fluxops_api_ws_queued", sum(subscriber["queue"].qsize() for subscriber in hub.subscribers.values()))
+    metrics.set("fluxops_api_commands_in_flight", len(transport.waiters))
+    server_stats = await fetch_server_stats()
+    metrics.set("fluxops_api_server_stats_up", 0 if server_stats is None else 1)
+    return PlainTextResponse(merge_rendered(metrics.render(), server_stats or ""),
+                             media_type="text/plain; version=0.0.4")
 
 # Модель для обновления информации о клиенте
 class ClientUpdate(BaseModel):
@@ -28,84 +597,111 @@ class ClientUpdate(BaseModel):
     status: str
     hostname: str
 
-# Путь к файлу
-CLIENTS_FILE = "server/clients.json"
+# Уведомление всем подключенным клиентам через WebSocket
+async def notify_clients(message: str):
+    hub.publish(message)
 
-# Загружаем клиентов из clients.json
-def load_clients():
-    try:
-        with open(CLIENTS_FILE, "r") as file:
-            clients_data = json.load(file)
-        return clients_data
-    except FileNotFoundError:
-        logger.error("Clients file not found")
-        raise HTTPException(status_code=404, detail="Clients file not found")
-    except json.JSONDecodeError as e:
-        logger.error(f"Error decoding clients file: {e}")
-        raise HTTPException(status_code=500, detail=f"Error decoding clients file: {e}")
-
-# Сохраняем изменения в clients.json
-def save_clients(clients_data):
-    try:
-        with open(CLIENTS_FILE, "w") as file:
-            json.dump(clients_data, file, indent=4)
-        logger.info(f"Сохранены данные клиентов в {CLIENTS_FILE}")
-    except Exception as e:
-        logger.error(f"Error saving clients file: {e}")
-        raise HTTPException(status_code=500, detail=f"Error saving clients file: {e}")
+def parse_fields(fields):
+    """Список полей из параметра fields ("id,status,..."); по умолчанию — id и address."""
+    if not fields:
+        return ("id", "address")
+    selected = tuple(field.strip() for field in fields.split(",") if field.strip())
+    unknown = [field for field in selected if field not in CLIENT_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return selected
 
-# Список для хранения подключенных WebSocket-клиентов
-connected_clients: List[WebSocket] = []
+def project_client(client_id, client_data, fields):
+    record = {}
+    for field in fields:
+        if field == "id":
+            record["id"] = client_id
+        elif field == "address":
+            record["address"] = client_data["address"][0]
+        else:
+            record[field] = client_data.get(field)
+    return record
 
-# Уведомление всем подключенным клиентам через WebSocket
-async def notify_clients(message: str):
-    for connection in connected_clients:
-        try:
-            await connection.send_text(message)
-        except Exception as e:
-            logger.error(f"Error sending message to connected client: {e}")
-            connected_clients.remove(connection)
+def list_clients_response(request: Request, status, group, hostname_prefix, fields, cursor, limit):
+    """
+    Общая часть /api/clients и /api/active_clients. Тело — по-прежнему список;
+    версия реестра и курсор следующей страницы отдаются в заголовках.
+    ETag зависит от версии реестра и параметров запроса, поэтому при
+    совпадении If-None-Match ответ 304 отдаётся без обхода реестра.
+    """
+    fields = parse_fields(fields)
+    if limit is not None and limit <= 0:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+    query = str(sorted(request.query_params.multi_items())) + request.url.path
+    etag = f'"{registry.token}-{zlib.crc32(query.encode()):08x}"'
+    headers = {"ETag": etag, "X-Registry-Version": registry.token}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    client_ids, next_cursor = registry.select(status, group, hostname_prefix, cursor, limit)
+    if next_cursor is not None:
+        headers["X-Next-Cursor"] = next_cursor
+    clients = [project_client(client_id, registry.get(client_id), fields) for client_id in client_ids]
+    return JSONResponse(content=clients, headers=headers)
 
 @app.get("/api/clients")
-def get_clients():
-    clients_data = load_clients()
-    clients = [{"id": key, "address": value["address"][0]} for key, value in clients_data.items()]
-    return clients
+async def get_clients(request: Request, status: Optional[str] = None, group: Optional[str] = None,
+                      hostname_prefix: Optional[str] = None, fields: Optional[str] = None,
+                      cursor: Optional[str] = None, limit: Optional[int] = None):
+    return list_clients_response(request, status, group, hostname_prefix, fields, cursor, limit)
 
 @app.get("/api/active_clients")
-def get_active_clients():
-    clients_data = load_clients()
-    active_clients = [{"id": key, "address": value["address"][0]} for key, value in clients_data.items() if value["status"] == "active"]
-    return active_clients
+async def get_active_clients(request: Request, group: Optional[str] = None,
+                             hostname_prefix: Optional[str] = None, fields: Optional[str] = None,
+                             cursor: Optional[str] = None, limit: Optional[int] = None):
+    return list_clients_response(request, "active", group, hostname_prefix, fields, cursor, limit)
+
+@app.get("/api/clients/changes")
+async def get_client_changes(since: str, timeout: float = 30, fields: Optional[str] = None):
+    """
+    Long-poll: ждёт изменений реестра после версии since (не дольше timeout)
+    и возвращает изменённых клиентов и удалённые client_id. Если since старее,
+    чем помнит реестр, выдана до перезапуска API или больше текущей версии,
+    сразу возвращается полный список с full == true.
+    """
+    fields = parse_fields(fields)
+    version = registry.parse_token(since)
+    if version is not None:
+        await registry.wait_changed(version, min(max(timeout, 0), CLIENTS_LONG_POLL_MAX))
+    changes = registry.changed_since(version)
+    if changes is None:
+        changed, deleted, full = list(registry.order), [], True
+    else:
+        (changed, deleted), full = changes, False
+    return {"version": registry.token, "full": full, "deleted": deleted,
+            "changed": [project_client(client_id, registry.get(client_id), fields) for client_id in changed]}
 
 @app.get("/api/connected_clients")
-def get_connected_clients():
-    return connected_clients
+async def get_connected_clients():
+    return hub.describe()
 
 @app.post("/api/update_client/{client_id}")
 async def update_client(client_id: str, client_update: ClientUpdate):
     logger.info(f"Received update for client {client_id}: {client_update}")
-    clients_data = load_clients()
-    if client_id not in clients_data:
+    client_data = registry.get(client_id)
+    if client_data is None:
         raise HTTPException(status_code=404, detail="Client not found")
 
     # Создаем новый ключ для клиента (новое имя)
     new_client_id = client_update.hostname  # Мы используем новое имя как новый идентификатор
 
-    if new_client_id in clients_data:
+    # Обновляем данные клиента и сохраняем их с новым ключом
+    changes = {
+        "address": [client_update.address, client_data["address"][1]],
+        "status": client_update.status,
+        "hostname": client_update.hostname,
+    }
+    try:
+        await registry.rename(client_id, new_client_id, changes)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Client not found")
+    except ValueError:
         raise HTTPException(status_code=400, detail="Client with this hostname already exists")
 
-    # Обновляем данные клиента
-    client_data = clients_data.pop(client_id)
-    client_data["address"] = [client_update.address, client_data["address"][1]]
-    client_data["status"] = client_update.status
-    client_data["hostname"] = client_update.hostname
-
-    # Сохраняем данные с новым ключом
-    clients_data[new_client_id] = client_data
-
-    save_clients(clients_data)
-    
     # Уведомляем всех подключенных клиентов о изменении
     await notify_clients(f"Client {client_id} updated to {new_client_id} successfully")
 
@@ -113,14 +709,12 @@ async def update_client(client_id: str, client_update: ClientUpdate):
 
 @app.delete("/api/delete_client/{client_id}")
 async def delete_client(client_id: str):
-    clients_data = load_clients()
-    if client_id not in clients_data:
+    # Удаляем клиента
+    try:
+        await registry.delete(client_id)
+    except KeyError:
         raise HTTPException(status_code=404, detail="Client not found")
 
-    # Удаляем клиента
-    del clients_data[client_id]
-    save_clients(clients_data)
-    
     # Уведомляем всех подключенных клиентов о удалении
     await notify_clients(f"Client {client_id} deleted successfully")
 
@@ -130,36 +724,278 @@ async def delete_client(client_id: str):
 async def websocket_endpoint(websocket: WebSocket):
     client_id = None  # Определяем переменную client_id заранее, чтобы использовать ее в блоке except
     await websocket.accept()
-    connected_clients.append(websocket)
+    hub.subscribe(websocket)
     try:
         client_id = await websocket.receive_text()  # Получаем ID от клиента
+        hub.set_name(websocket, client_id)
         logger.info(f"Client {client_id} connected via WebSocket")
         while True:
             await websocket.receive_text()
     except WebSocketDisconnect:
-        if websocket in connected_clients:
-            connected_clients.remove(websocket)
         logger.info(f"Client {client_id} disconnected")
+    finally:
+        hub.unsubscribe(websocket)
 
 class CommandRequest(BaseModel):
     command: str
+    timeout: float = 30
+    # Кэширование результата (только для команд без побочных эффектов): cache — срок по умолчанию
+    # для команды на сервере, cache_ttl — свой срок в секундах
+    cache: bool = False
+    cache_ttl: Optional[float] = None
+    # Поставить команду в очередь, если клиент недоступен; уйдёт при его возвращении
+    queue: bool = False
+    # Класс приоритета: interactive, normal или bulk
+    priority: Optional[str] = None
+    # Ждать допуска при перегрузке; false — сразу 429 с позицией в очереди
+    wait: bool = True
 
 @app.post("/api/send_command/{client_id}")
-async def send_command(client_id: str, command_request: CommandRequest):
+async def send_command(client_id: str, command_request: CommandRequest, http_request: Request):
     command = command_request.command  # Теперь получаем команду через объект
-    registered_clients = load_clients()
 
-    if client_id not in registered_clients:
+    if registry.get(client_id) is None:
         raise HTTPException(status_code=404, detail="Client not found")
 
-    client_address = registered_clients[client_id]["address"][0]  # Получаем IP-адрес клиента
-
+    request = {"client_id": client_id, "command": command, "timeout": command_request.timeout,
+               "cache": command_request.cache, "cache_ttl": command_request.cache_ttl,
+               "queue": command_request.queue, "priority": command_request.priority,
+               "wait": command_request.wait,
+               # Лимит частоты на вызывающую сторону считается по адресу HTTP-клиента, а не по api.py
+               "caller": http_request.client.host if http_request.client else None}
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as command_socket:
-            command_socket.connect((client_address, 9997))  # Изменено на порт 9997
-            # Отправляем команду
-            command_socket.sendall(f"{client_id} {command}".encode())
-            response = command_socket.recv(1024).decode()
-            return {"message": "Command sent successfully", "response": response}
+        response = await transport.request(request, command_request.timeout + COMMAND_TIMEOUT_MARGIN)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail=f"Timeout waiting for command server reply for client {client_id}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error sending command to client {client_id}: {e}")
+    if response.get("status") == "queued":
+        return JSONResponse(status_code=202, content={"message": "Client is unavailable, command queued",
+                                                      "request_id": response["request_id"],
+                                                      "queue_depth": response["queue_depth"]})
+    if response.get("status") in ("busy", "rejected"):
+        # Перегрузка: 429 — можно повторить позже, 503 — очередь допуска переполнена
+        return JSONResponse(status_code=429 if response["status"] == "busy" else 503,
+                            headers={"Retry-After": str(max(1, round(response["retry_after"])))},
+                            content={"message": response["message"], "priority": response["priority"],
+                                     "queue_position": response["queue_position"],
+                                     "retry_after": response["retry_after"]})
+    if response.get("code") == "not_found":
+        # Клиент есть в реестре API, но server.py его не знает (перезапуск, другой шард)
+        raise HTTPException(status_code=404, detail=f"Client not found: {response.get('message')}")
+    if response.get("status") != "success":
+        raise HTTPException(status_code=500, detail=f"Error sending command to client {client_id}: {response.get('message')}")
+    return {"message": "Command sent successfully", "response": response["reply"]}
+
+@app.get("/api/queues")
+async def get_queues():
+    """Очереди команд для недоступных клиентов: глубина и возраст самой старой команды."""
+    try:
+        response = await transport.request({"action": "queues"}, COMMAND_TIMEOUT_MARGIN)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Timeout waiting for command server reply")
+    return response["queues"]
+
+class BroadcastRequest(BaseModel):
+    command: str
+    group: Optional[str] = None
+    client_ids: Optional[List[str]] = None
+    concurrency: int = 100
+    timeout: float = 30
+    queue: bool = False
+    priority: Optional[str] = None  # по умолчанию bulk
+
+@app.post("/api/broadcast")
+async def broadcast_command(broadcast_request: BroadcastRequest):
+    """
+    Рассылает команду группе клиентов (или списку client_ids) через server.py.
+    Результаты отдаются потоком в формате NDJSON по мере их поступления,
+    последняя строка — итог рассылки с type == "done".
+    """
+    if not broadcast_request.group and not broadcast_request.client_ids:
+        raise HTTPException(status_code=400, detail="group or client_ids is required")
+    request = {"action": "broadcast", "stream": True, **broadcast_request.model_dump(exclude_none=True)}
+
+    async def stream_results():
+        frames = transport.stream(request, broadcast_request.timeout + COMMAND_TIMEOUT_MARGIN,
+                                  lambda frame: frame.get("type") == "done" or "type" not in frame)
+        try:
+            async for frame in frames:
+                yield json.dumps(frame) + "\n"
+        except asyncio.TimeoutError:
+            yield json.dumps({"type": "done", "status": "error", "message": "Command server timeout"}) + "\n"
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+async def fetch_output_chunk(client_id, handle, stream, offset, length=None):
+    request = {"action": "fetch_output", "client_id": client_id, "handle": handle, "stream": stream,
+               "offset": offset, "timeout": OUTPUT_FETCH_TIMEOUT}
+    if length is not None:
+        request["length"] = length
+    try:
+        response = await transport.request(request, OUTPUT_FETCH_TIMEOUT + COMMAND_TIMEOUT_MARGIN)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail=f"Timeout waiting for output of client {client_id}")
+    if response.get("status") != "success":
+        raise HTTPException(status_code=404, detail=f"Output {handle} is not available: {response.get('message')}")
+    return response
+
+@app.get("/api/command_output/{client_id}/{handle}")
+async def get_command_output(client_id: str, handle: str, stream: str = "stdout",
+                             offset: int = 0, length: Optional[int] = None):
+    """
+    Порция полного вывода команды, сброшенного клиентом на диск (output_handle
+    в результате с truncated). Следующая порция запрашивается с next_offset.
+    """
+    if registry.get(client_id) is None:
+        raise HTTPException(status_code=404, detail="Client not found")
+    return await fetch_output_chunk(client_id, handle, stream, offset, length)
+
+@app.get("/api/command_output/{client_id}/{handle}/download")
+async def download_command_output(client_id: str, handle: str, stream: str = "stdout"):
+    """Полный вывод команды одним ответом; у клиента он читается порциями по мере отправки."""
+    if registry.get(client_id) is None:
+        raise HTTPException(status_code=404, detail="Client not found")
+    first = await fetch_output_chunk(client_id, handle, stream, 0)
+
+    async def stream_output():
+        chunk = first
+        yield chunk["data"]
+        while not chunk["eof"]:
+            chunk = await fetch_output_chunk(client_id, handle, stream, chunk["next_offset"])
+            yield chunk["data"]
+
+    return StreamingResponse(stream_output(), media_type="text/plain; charset=utf-8")
+
+class PushFileRequest(BaseModel):
+    path: str
+    dest: str
+    client_ids: Optional[List[str]] = None
+    group: Optional[str] = None
+    all: bool = False
+    timeout: float = 3600
+
+@app.post("/api/push_file")
+async def push_file(push_request: PushFileRequest):
+    """
+    Раздаёт файл с сервера (path) выбранным клиентам в dest. Файл передаётся
+    порциями с докачкой после обрыва; ответ — итог раздачи по всем клиентам.
+    """
+    if not push_request.group and not push_request.client_ids and not push_request.all:
+        raise HTTPException(status_code=400, detail="group, client_ids or all is required")
+    request = {"action": "push_file", **push_request.model_dump(exclude_none=True)}
+    try:
+        response = await transport.request(request, push_request.timeout + COMMAND_TIMEOUT_MARGIN)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Timeout waiting for file transfer to finish")
+    if response.get("status") != "success":
+        raise HTTPException(status_code=400, detail=f"Error pushing file: {response.get('message')}")
+    return response
+
+@app.get("/api/transfers")
+async def get_transfers():
+    """Ход незавершённых раздач файлов: сколько клиентов готово и сколько байт принял каждый активный."""
+    try:
+        response = await transport.request({"action": "transfers"}, COMMAND_TIMEOUT_MARGIN)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Timeout waiting for command server reply")
+    return response["transfers"]
+
+class ScheduleRequest(BaseModel):
+    command: str
+    interval: Optional[float] = None
+    cron: Optional[str] = None
+    client_ids: Optional[List[str]] = None
+    group: Optional[str] = None
+    all: bool = False
+    jitter: float = 0
+    timeout: float = 30
+    concurrency: int = 100
+    job_id: Optional[str] = None
+
+async def schedule_request(request):
+    try:
+        response = await transport.request(request, COMMAND_TIMEOUT_MARGIN)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Timeout waiting for command server reply")
+    return response
+
+@app.get("/api/schedules")
+async def get_schedules():
+    """Периодические задания: расписание, время следующего запуска и итог последнего."""
+    return (await schedule_request({"action": "schedules"}))["jobs"]
+
+@app.post("/api/schedules")
+async def create_schedule(schedule: ScheduleRequest):
+    """
+    Добавляет периодическое задание (interval в секундах или cron из пяти полей)
+    или заменяет задание с тем же job_id. Запуски выполняет server.py.
+    """
+    response = await schedule_request({"action": "schedule", **schedule.model_dump(exclude_none=True)})
+    if response.get("status") != "success":
+        raise HTTPException(status_code=400, detail=f"Error scheduling command: {response.get('message')}")
+    return response["job"]
+
+@app.delete("/api/schedules/{job_id}")
+async def delete_schedule(job_id: str):
+    response = await schedule_request({"action": "unschedule", "job_id": job_id})
+    if response.get("status") != "success":
+        raise HTTPException(status_code=404, detail="Schedule not found")
+    return {"message": "Schedule deleted successfully"}
+
+def parse_fact_filters(where):
+    """
+    where=key=value → {key: [допустимые значения]}. server.py сравнивает факты
+    с учётом типа, а из строки запроса тип не виден, поэтому значение
+    подходит и как строка, и как JSON-скаляр: "22.04" найдёт и версию-строку
+    "22.04", и число 22.04; "true" — и строку "true", и булево true (но не 1).
+    """
+    filters = {}
+    for item in where:
+        key, sep, value = item.partition("=")
+        if not sep or not key:
+            raise HTTPException(status_code=400, detail=f"Invalid filter {item!r}, expected key=value")
+        values = [value]
+        try:
+            parsed = json.loads(value)
+        except ValueError:
+            parsed = value
+        if parsed != value and (isinstance(parsed, (str, int, float, bool)) or parsed is None):
+            values.append(parsed)
+        filters[key] = values
+    return filters
+
+@app.get("/api/facts")
+async def get_facts(where: List[str] = Query(default=[]), keys: Optional[str] = None,
+                    group: Optional[str] = None, summary: Optional[str] = None):
+    """
+    Инвентаризация по фактам, которые клиенты присылают сами (ОС, процессор,
+    память, диски, адреса): where=os.distro=debian&where=cpu.count=8,
+    keys — какие факты вернуть, summary — распределение значений одного факта.
+    Отвечает server.py из своего индекса, клиенты не опрашиваются.
+    """
+    request = {"action": "facts", "where": parse_fact_filters(where)}
+    if keys:
+        request["keys"] = [key for key in keys.split(",") if key]
+    if group:
+        request["group"] = group
+    if summary:
+        request["summary"] = summary
+    try:
+        response = await transport.request(request, COMMAND_TIMEOUT_MARGIN)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Timeout waiting for command server reply")
+    if response.get("status") != "success":
+        raise HTTPException(status_code=400, detail=response.get("message"))
+    return {key: response[key] for key in ("facts", "summary") if key in response}
+
+@app.get("/api/facts/{client_id}")
+async def get_client_facts(client_id: str):
+    """Факты одного клиента и их версия."""
+    try:
+        response = await transport.request({"action": "facts", "client_ids": [client_id]}, COMMAND_TIMEOUT_MARGIN)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Timeout waiting for command server reply")
+    if client_id not in response.get("facts", {}):
+        raise HTTPException(status_code=404, detail="No facts for this client")
+    return response["facts"][client_id]
@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный стенд для server.py и api.py.
+
+Поднимает в одном процессе тысячи имитированных агентов (DEALER-сокеты,
+тот же протокол register/ping/command_result, что у client/client.py),
+прогоняет регистрацию, пинги, команды через командный порт, рассылку и,
+при указании --api, HTTP-эндпоинты и WebSocket-рассылку api.py.
+Результат — JSON (в stdout или в --output), удобный для сравнения прогонов.
+
+Пример:
+    python benchmark.py --agents 2000 --spawn-server --output bench_output.txt
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import uuid
+
+import zmq
+
+try:
+    import websockets
+except ImportError:  # без websockets замер WebSocket-рассылки пропускается
+    websockets = None
+
+logging.basicConfig(level=logging.INFO,
+                    format="%(asctime)s [%(levelname)s] %(message)s")
+
+ZMQ_PORT = 5555
+TCP_COMMAND_PORT = 9997
+
+def percentiles(samples):
+    """p50/p99/max в миллисекундах по списку длительностей в секундах."""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+
+    return {"count": len(ordered), "p50_ms": pick(0.50), "p99_ms": pick(0.99), "max_ms": round(ordered[-1] * 1000, 3)}
+
+def process_tree(pid):
+    """PID процесса и всех его потомков (в режиме шардирования — фронт и воркеры; Linux, /proc)."""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue  # процесс уже завершился
+        children.setdefault(ppid, []).append(int(entry))
+    tree, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        tree.append(current)
+        stack.extend(children.get(current, ()))
+    return tree
+
+def process_rss(pid):
+    """Резидентная память процесса и его потомков в килобайтах (Linux, /proc)."""
+    total = 0
+    for member in process_tree(pid):
+        try:
+            with open(f"/proc/{member}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+                        break
+        except OSError:
+            continue
+    return total
+
+def process_cpu(pid):
+    """Процессорное время процесса и его потомков (user + system) в секундах (Linux, /proc)."""
+    total = 0
+    for member in process_tree(pid):
+        try:
+            with open(f"/proc/{member}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        total += int(fields[11]) + int(fields[12])
+    return total / os.sysconf("SC_CLK_TCK")
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+class SimulatedFleet:
+    """
+    Имитированные агенты в одном потоке: один zmq.Poller на все сокеты.
+    После start() поток отвечает на команды мгновенным command_result,
+    предварительно отправляя command_output с отметкой времени (для замера
+    задержки доставки вывода в WebSocket).
+    """
+
+    def __init__(self, context, server_host, count, group):
+        self.sockets = []
+        self.client_ids = {}
+        self.poller = zmq.Poller()
+        for index in range(count):
+            client_id = f"bench-{index:06d}"
+            dealer = context.socket(zmq.DEALER)
+            dealer.setsockopt_string(zmq.IDENTITY, client_id)
+            dealer.setsockopt(zmq.LINGER, 0)
+            dealer.connect(f"tcp://{server_host}:{ZMQ_PORT}")
+            self.sockets.append(dealer)
+            self.client_ids[dealer] = client_id
+            self.poller.register(dealer, zmq.POLLIN)
+        self.group = group
+        self.commands_answered = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _collect(self, waiting, deadline):
+        """Собирает по одному ответу от каждого сокета из waiting; возвращает время прихода."""
+        arrived = {}
+        while waiting and time.time() < deadline:
+            for sock, _ in self.poller.poll(max(1, int((deadline - time.time()) * 1000))):
+                sock.recv_multipart()
+                if sock in waiting:
+                    waiting.discard(sock)
+                    arrived[sock] = time.time()
+        return arrived
+
+    def register_all(self, timeout):
+        started = time.time()
+        for dealer in self.sockets:
+            dealer.send_json({"type": "register", "data": {
+                "client_id": self.client_ids[dealer], "hostname": self.client_ids[dealer],
+                "group": self.group, "ip": "127.0.0.1"}})
+        arrived = self._collect(set(self.sockets), started + timeout)
+        elapsed = time.time() - started
+        return {"agents": len(self.sockets), "registered": len(arrived), "elapsed_s": round(elapsed, 3),
+                "registrations_per_s": round(len(arrived) / elapsed, 1) if elapsed else None}
+
+    def ping_all(self, rounds, timeout):
+        latencies = []
+        started = time.time()
+        for _ in range(rounds):
+            sent_at = time.time()
+            for dealer in self.sockets:
+                dealer.send_json({"type": "ping"})
+            arrived = self._collect(set(self.sockets), sent_at + timeout)
+            latencies.extend(t - sent_at for t in arrived.values())
+        elapsed = time.time() - started
+        return dict(percentiles(latencies), pings_per_s=round(len(latencies) / elapsed, 1) if elapsed else None)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _serve(self):
+        while not self._stop.is_set():
+            for sock, _ in self.poller.poll(100):
+                msg = json.loads(sock.recv_multipart()[-1].decode())
+                if "command" not in msg:
+                    continue
+                request_id = msg.get("request_id")
+                sock.send_json({"type": "command_output", "request_id": request_id, "seq": 0,
+                                "data": json.dumps({"sent_at": time.time()})})
+                sock.send_json({"type": "command_result", "request_id": request_id, "command": msg["command"],
+                                "data": {"stdout": self.client_ids[sock], "stderr": "", "returncode": 0}})
+                self.commands_answered += 1
+
+    def close(self):
+        for dealer in self.sockets:
+            dealer.close()
+
+def bench_commands(context, server_host, client_ids, total, concurrency, timeout):
+    """Команды через командный порт: окно из concurrency одновременных запросов."""
+    dealer = context.socket(zmq.DEALER)
+    dealer.setsockopt(zmq.LINGER, 0)
+    dealer.connect(f"tcp://{server_host}:{TCP_COMMAND_PORT}")
+    in_flight = {}
+    latencies = []
+    errors = 0
+    sent = 0
+    started = time.time()
+    deadline = started + timeout
+    while (sent < total or in_flight) and time.time() < deadline:
+        while sent < total and len(in_flight) < concurrency:
+            tag = uuid.uuid4().hex
+            msg = {"client_id": client_ids[sent % len(client_ids)], "command": "bench", "tag": tag}
+            in_flight[tag] = time.time()
+            dealer.send_multipart([b'', json.dumps(msg).encode()])
+            sent += 1
+        if dealer.poll(100):
+            reply = json.loads(dealer.recv_multipart()[-1].decode())
+            sent_at = in_flight.pop(reply.get("tag"), None)
+            if sent_at is not None:
+                latencies.append(time.time() - sent_at)
+                errors += reply.get("status") != "success"
+    elapsed = time.time() - started
+    dealer.close()
+    return dict(percentiles(latencies), errors=errors, lost=len(in_flight),
+                commands_per_s=round(len(latencies) / elapsed, 1) if elapsed else None)
+
+def bench_broadcast(context, server_host, group, timeout):
+    req = context.socket(zmq.REQ)
+    req.setsockopt(zmq.LINGER, 0)
+    req.connect(f"tcp://{server_host}:{TCP_COMMAND_PORT}")
+    started = time.time()
+    req.send_json({"action": "broadcast", "group": group, "command": "bench", "concurrency": 1000})
+    if not req.poll(timeout * 1000):
+        req.close()
+        return {"error": "timeout"}
+    reply = req.recv_json()
+    req.close()
+    return {"total": reply.get("total"), "failed": reply.get("failed"), "elapsed_s": round(time.time() - started, 3)}
+
+def http_json(url, method="GET", body=None):
+    data = json.dumps(body).encode() if body is not None else None
+    request = urllib.request.Request(url, data=data, method=method, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.loads(response.read())
+
+def bench_api(api_url, client_ids, requests):
+    """Задержки HTTP-эндпоинтов api.py (последовательные запросы)."""
+    results = {}
+    for name, method, path, body in [
+        ("clients", "GET", "/api/clients", None),
+        ("active_clients", "GET", "/api/active_clients", None),
+        ("send_command", "POST", f"/api/send_command/{client_ids[0]}", {"command": "bench"}),
+    ]:
+        latencies = []
+        errors = 0
+        for _ in range(requests):
+            started = time.time()
+            try:
+                http_json(api_url + path, method, body)
+                latencies.append(time.time() - started)
+            except Exception:
+                errors += 1
+        results[name] = dict(percentiles(latencies), errors=errors)
+    return results
+
+async def _websocket_fanout(ws_url, api_url, client_id, subscribers, timeout):
+    connections = [await websockets.connect(ws_url) for _ in range(subscribers)]
+    for index, connection in enumerate(connections):
+        await connection.send(f"bench-dashboard-{index}")
+    await asyncio.sleep(0.5)
+    # Вывод команды несёт время отправки агентом; считаем задержку до каждого подписчика
+    await asyncio.to_thread(http_json, f"{api_url}/api/send_command/{client_id}", "POST", {"command": "bench"})
+    latencies = []
+
+    async def receive(connection):
+        while True:
+            event = json.loads(await connection.recv())
+            if event.get("type") == "command_output" and event.get("client_id") == client_id:
+                latencies.append(time.time() - json.loads(event["data"])["sent_at"])
+                return
+
+    try:
+        await asyncio.wait_for(asyncio.gather(*(receive(c) for c in connections)), timeout)
+    except asyncio.TimeoutError:
+        pass
+    for connection in connections:
+        await connection.close()
+    return dict(percentiles(latencies), subscribers=subscribers, delivered=len(latencies))
+
+def bench_websocket(api_url, client_id, subscribers, timeout):
+    if websockets is None:
+        return {"skipped": "websockets package is not installed"}
+    ws_url = api_url.replace("http", "ws", 1) + "/ws/connect"
+    return asyncio.run(_websocket_fanout(ws_url, api_url, client_id, subscribers, timeout))
+
+def spawn_server(workers):
+    """Запускает server.py во временном каталоге (чтобы не трогать рабочую историю команд)."""
+    workdir = tempfile.mkdtemp(prefix="fluxops-bench-")
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")]
+    if workers > 1:
+        command += ["--workers", str(workers)]
+    proc = subprocess.Popen(command, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    time.sleep(1.5)
+    return proc, workdir
+
+def stop_server(proc, timeout=10):
+    """
+    Останавливает server.py по SIGTERM: фронт сам завершает и дожидается
+    своих воркеров. Если он не уложился в timeout, добиваем всё дерево.
+    """
+    tree = process_tree(proc.pid)
+    proc.terminate()
+    try:
+        proc.wait(timeout)
+    except subprocess.TimeoutExpired:
+        logging.warning(f"server.py не завершился за {timeout} с, принудительная остановка")
+        proc.kill()
+        proc.wait()
+    for pid in tree[1:]:
+        try:
+            os.kill(pid, signal.SIGKILL)  # воркер, переживший фронт
+        except ProcessLookupError:
+            pass
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд fluxops")
+    parser.add_argument("--agents", type=int, default=1000, help="число имитированных агентов")
+    parser.add_argument("--server-host", default="localhost")
+    parser.add_argument("--server-pid", type=int, help="PID server.py для замера памяти и CPU (вместе с воркерами)")
+    parser.add_argument("--spawn-server", action="store_true", help="запустить server.py самостоятельно")
+    parser.add_argument("--workers", type=int, default=1, help="воркеров для --spawn-server (режим шардирования)")
+    parser.add_argument("--ping-rounds", type=int, default=5)
+    parser.add_argument("--commands", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--api", help="адрес api.py, например http://localhost:8000")
+    parser.add_argument("--api-requests", type=int, default=200)
+    parser.add_argument("--ws-subscribers", type=int, default=100)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--output", help="файл для JSON-результата (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    server_proc = workdir = None
+    server_pid = args.server_pid
+    if args.spawn_server:
+        server_proc, workdir = spawn_server(args.workers)
+        server_pid = server_proc.pid
+
+    context = zmq.Context()
+    group = f"bench-{uuid.uuid4().hex[:8]}"
+    report = {"agents": args.agents, "workers": args.workers, "started_at": time.time()}
+    fleet = SimulatedFleet(context, args.server_host, args.agents, group)
+    try:
+        rss_before = process_rss(server_pid) if server_pid else None
+        logging.info(f"Регистрация {args.agents} агентов")
+        report["register"] = fleet.register_all(args.timeout)
+        if server_pid:
+            rss_after = process_rss(server_pid)
+            report["memory"] = {"server_rss_kb": rss_after,
+                                "per_agent_bytes": round((rss_after - rss_before) * 1024 / max(1, args.agents))}
+
+        logging.info("Пинги")
+        cpu_before = process_cpu(server_pid) if server_pid else None
+        report["ping"] = fleet.ping_all(args.ping_rounds, args.timeout)
+        if server_pid:
+            pings = args.ping_rounds * args.agents
+            report["ping"]["server_cpu_us_per_ping"] = round((process_cpu(server_pid) - cpu_before) * 1e6 / pings, 2)
+
+        fleet.start()
+        client_ids = list(fleet.client_ids.values())
+        logging.info("Команды через командный порт")
+        report["commands"] = bench_commands(context, args.server_host, client_ids,
+                                            args.commands, args.concurrency, args.timeout)
+        logging.info("Рассылка на всю группу")
+        report["broadcast"] = bench_broadcast(context, args.server_host, group, args.timeout)
+        if args.api:
+            logging.info("Эндпоинты api.py")
+            report["api"] = bench_api(args.api, client_ids, args.api_requests)
+            report["websocket_fanout"] = bench_websocket(args.api, client_ids[0], args.ws_subscribers, args.timeout)
+    finally:
+        fleet.stop()
+        fleet.close()
+        context.term()
+        if server_proc is not None:
+            stop_server(server_proc)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
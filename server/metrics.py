@@ -0,0 +1,101 @@
+"""
+Метрики процессов server.py и api.py: счётчики, показатели и гистограммы
+в памяти с выводом в текстовом формате Prometheus. Агент (client/client.py)
+разворачивается отдельно от сервера, поэтому держит свою копию.
+"""
+import bisect
+import threading
+from collections import defaultdict
+
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+
+class Metrics:
+    """Счётчики, показатели и гистограммы в памяти с выводом в текстовом формате Prometheus."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.histograms = {}  # (имя, метки) -> [счётчики по корзинам, сумма, количество]
+
+    def inc(self, name, value=1, labels=()):
+        with self.lock:
+            self.counters[(name, labels)] += value
+
+    def set(self, name, value, labels=()):
+        self.gauges[(name, labels)] = value
+
+    def observe(self, name, value, labels=()):
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[(name, labels)] = [[0] * len(LATENCY_BUCKETS), 0.0, 0]
+            index = bisect.bisect_left(LATENCY_BUCKETS, value)
+            if index < len(LATENCY_BUCKETS):
+                histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def remove(self, name, labels=()):
+        """Убирает ряд (например, по клиенту, который больше не отслеживается)."""
+        with self.lock:
+            self.counters.pop((name, labels), None)
+            self.gauges.pop((name, labels), None)
+            self.histograms.pop((name, labels), None)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = tuple(labels) + tuple(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+    def render(self, extra=()):
+        """extra — метки, добавляемые ко всем рядам (например, номер воркера)."""
+        lines = []
+        typed = set()
+
+        def family(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                family(name, "counter")
+                lines.append(f"{name}{self._labels(labels + extra)} {value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                family(name, "gauge")
+                lines.append(f"{name}{self._labels(labels + extra)} {value}")
+            for (name, labels), (buckets, total, count) in sorted(self.histograms.items()):
+                family(name, "histogram")
+                cumulative = 0
+                for bound, bucket in zip(LATENCY_BUCKETS, buckets):
+                    cumulative += bucket
+                    lines.append(f"{name}_bucket{self._labels(labels + extra, (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_bucket{self._labels(labels + extra, (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{self._labels(labels + extra)} {total}")
+                lines.append(f"{name}_count{self._labels(labels + extra)} {count}")
+        return "\n".join(lines) + "\n"
+
+def merge_rendered(*texts):
+    """
+    Склеивает выводы render() нескольких процессов (фронт и воркеры, API и
+    сервер): ряды одной метрики идут подряд под единственной строкой # TYPE,
+    как требует текстовый формат Prometheus.
+    """
+    families = {}  # имя -> [строка # TYPE, ряды], в порядке первого появления
+    for text in texts:
+        current = None
+        for line in text.splitlines():
+            if line.startswith("# TYPE "):
+                current = line.split()[2]
+                families.setdefault(current, [line, []])
+            elif line and not line.startswith("#"):
+                families.setdefault(current, [None, []])[1].append(line)
+    lines = []
+    for type_line, samples in families.values():
+        if type_line is not None:
+            lines.append(type_line)
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
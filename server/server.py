@@ -6,8 +6,32 @@ import json
 import os
 import threading
 import time
-from datetime import datetime
+import heapq
+import uuid
+import random
+import queue
+import bisect
+import zlib
+import hashlib
+import mmap
+import tempfile
+import shutil
+import signal
+import multiprocessing
+import itertools
+from collections import deque, defaultdict, OrderedDict
+from datetime import datetime, timedelta
 import sys
+from metrics import Metrics, merge_rendered
+
+try:
+    import msgpack
+except ImportError:  # msgpack не обязателен, без него используется JSON
+    msgpack = None
+try:
+    import zstandard
+except ImportError:  # zstandard не обязателен, без него сжатие zlib
+    zstandard = None
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO,
@@ -16,12 +40,163 @@ logging.basicConfig(level=logging.INFO,
 # Конфигурация портов и файлов
 ZMQ_PORT = 5555            # порт для связи с клиентами
 UDP_PORT = 9998            # порт для автообнаружения
+PROTOCOL_VERSION = 2       # версия протокола, сообщаемая клиентам в ответе автообнаружения
 TCP_COMMAND_PORT = 9997    # порт для внешнего командного интерфейса
+EVENTS_PORT = 5556         # PUB-сокет событий для api.py (потоковый вывод команд)
+EVENTS_HWM = 10000         # лимит очереди событий на подписчика, дальше события отбрасываются
 CLIENTS_FILE = "clients.json"
-COMMAND_HISTORY_FILE = "command_history.json"
+COMMAND_HISTORY_FILE = "command_history.json"  # старый формат, импортируется при первом запуске
+COMMAND_HISTORY_DIR = "command_history"        # сегменты журнала истории команд (JSON lines)
+HISTORY_SEGMENT_MAX_BYTES = 16 * 1024 * 1024   # ротация сегмента по размеру
+HISTORY_SEGMENT_MAX_AGE = 24 * 3600            # ротация сегмента по времени, секунд
+HISTORY_INDEX_PER_CLIENT = 1000                # сколько последних записей клиента держать в индексе
+HISTORY_BACKGROUND_WRITER = True               # писать историю из отдельного потока
+FILE_CHUNK_SIZE = 256 * 1024     # размер порции при раздаче файлов клиентам
+FILE_TRANSFER_CONCURRENCY = 50   # клиентов, получающих файл одновременно (остальные ждут очереди)
+FILE_STALL_TIMEOUT = 15          # нет подтверждений от клиента столько секунд — повторяем предложение
+FILE_MAX_RETRIES = 5             # сколько раз повторять предложение, прежде чем считать передачу неудачной
+OUTBOUND_QUEUE_FILE = "outbound_queue.jsonl"   # журнал очередей команд для недоступных клиентов
+OUTBOUND_QUEUE_MAX_PER_CLIENT = 1000           # сколько команд держать в очереди одного клиента
+OUTBOUND_QUEUE_MAX_AGE = 24 * 3600             # команда старше этого при доставке отбрасывается, секунд
+OUTBOUND_BATCH_SIZE = 50                       # команд в одной пачке доставки
+OUTBOUND_BATCH_ACK_TIMEOUT = 30                # пачка без batch_ack дольше этого отправляется заново, секунд
+OUTBOUND_COMPACT_MIN = 1000                    # сжимать журнал, когда в нём столько устаревших записей
+SCHEDULE_FILE = "schedule.json"  # периодические задания и их состояние
+SCHEDULE_SAVE_INTERVAL = 5       # состояние заданий сохраняется не чаще, секунд
+DEFAULT_COMMAND_TIMEOUT = 30  # таймаут ожидания результата команды, секунд
+DEFAULT_BROADCAST_CONCURRENCY = 100  # одновременных команд в одной рассылке
+PRIORITY_CLASSES = ("interactive", "normal", "bulk")  # классы приоритета команд в порядке обслуживания
+DEFAULT_PRIORITY = "normal"          # класс одиночной команды (рассылки и периодические задания — bulk)
+MAX_IN_FLIGHT = 10000                # команд, ожидающих ответа клиентов, на весь сервер (воркер)
+# Доля общего бюджета, доступная классу: остаток бережётся для более срочных команд
+IN_FLIGHT_SHARE = {"interactive": 1.0, "normal": 0.9, "bulk": 0.7}
+CLIENT_MAX_IN_FLIGHT = 8             # одновременных команд normal и bulk у одного клиента (interactive — сверх)
+CLIENT_RATE, CLIENT_BURST = 20, 40   # token bucket на клиента: команд в секунду и запас
+CALLER_RATE, CALLER_BURST = 2000, 4000  # token bucket на вызывающую сторону (0 — без ограничения)
+ADMISSION_QUEUE_LIMIT = 10000        # команд, ждущих допуска; сверх — немедленный отказ
+OUTPUT_FETCH_CHUNK = 256 * 1024  # порция полного вывода команды, запрашиваемая у клиента по умолчанию, байт
+RESULT_CACHE_MAX_BYTES = 32 * 1024 * 1024  # память под кэш результатов команд (по размеру JSON ответа)
+RESULT_CACHE_DEFAULT_TTL = 10              # срок жизни кэшированного результата, если для команды не задан свой
+# Сроки жизни результатов для типичных команд только для чтения, секунд
+RESULT_CACHE_TTLS = {
+    "hostname": 300,
+    "uname -a": 300,
+    "uptime": 5,
+    "df -h": 30,
+    "free -m": 5,
+}
+HEARTBEAT_INTERVAL = 5        # интервал пингов, сообщаемый клиентам при малой нагрузке, секунд
+HEARTBEAT_MAX_INTERVAL = 60   # верхняя граница интервала пингов при большой нагрузке
+HEARTBEAT_TARGET_RATE = 500   # сколько пингов в секунду сервер готов принимать от всего флота
+CLIENT_STALE_AFTER = 15    # клиент без сообщений столько секунд считается stale (не меньше 3 интервалов)
+CLIENT_OFFLINE_AFTER = 60  # ...а столько секунд — offline (не меньше 12 интервалов)
+LIVENESS_TICK = 1          # шаг колеса таймеров проверки живости, секунд
+COMPRESS_THRESHOLD = 4096  # сообщения клиентам больше стольких байт сжимаются
+SHARD_IPC_PREFIX = "fluxops-"  # префикс каталога ipc-сокетов между фронтом и воркерами (свой на каждый запуск)
+SHARD_RESTART_DELAY = 1    # пауза перед перезапуском упавшего воркера, секунд
+SHARD_VIRTUAL_NODES = 64   # виртуальных узлов на воркер в кольце консистентного хеширования
+STATS_ENDPOINT = "tcp://127.0.0.1:9995"  # локальный сокет метрик (текстовый формат Prometheus)
+LOG_SAMPLE_EVERY = 100     # в DEBUG логируется каждое N-е сообщение горячего пути
+CLIENT_LATENCY_SERIES_MAX = 1000  # по скольким недавно ответившим клиентам держать ряды задержки
 
-# Словарь зарегистрированных клиентов
+# Зарегистрированные клиенты: client_id -> ClientRecord
 registered_clients = {}
+# Обратное соответствие ZeroMQ identity -> client_id
+identities = {}
+# Индекс фактов о клиентах: факт -> значение в JSON -> множество client_id
+# (JSON различает типы: "12" и 12, true и 1 — разные значения)
+facts_index = defaultdict(lambda: defaultdict(set))
+# Индекс групп: группа -> множество client_id
+groups = defaultdict(set)
+
+# Команды, ожидающие ответа от клиентов: request_id -> описание запроса
+pending_commands = {}
+# Куча (deadline, request_id) для истечения таймаутов ожидающих команд
+pending_deadlines = []
+# Активные рассылки команд группам клиентов: broadcast_id -> состояние
+broadcasts = {}
+# Раздачи файлов клиентам: transfer_id -> состояние
+transfers = {}
+# Допуск команд к отправке: приоритеты, лимиты и бюджет (создаётся при запуске сервера)
+admission = None
+# Очереди команд для недоступных клиентов (создаются при запуске сервера)
+outbound = None
+# Пачки из очереди, отправленные клиенту и ещё не подтверждённые: client_id -> {"ids": [request_id], "sent_at": время}
+outbound_batches = {}
+# Результаты команд, запрошенных с кэшированием, и команды в работе для слияния одинаковых запросов
+result_cache = None
+inflight_results = {}  # (client_id, command) -> request_id
+# Периодические задания (создаётся при запуске сервера)
+scheduler = None
+# Журнал истории команд (создаётся при запуске сервера)
+command_history = None
+# Колесо таймеров для проверки живости клиентов (создаётся при запуске сервера)
+liveness_wheel = None
+# Номер воркера, число воркеров и каталог ipc-сокетов в режиме шардирования (см. server_sharded)
+shard_index = None
+shard_count = 1
+shard_ipc_dir = None
+
+##############################################
+# Метрики
+##############################################
+metrics = Metrics()
+_log_sequence = itertools.count()
+# Клиенты, по которым сейчас есть ряды задержки, от давно ответивших к недавним
+client_latency_series = OrderedDict()
+
+def log_sampled():
+    """Истина для каждого LOG_SAMPLE_EVERY-го сообщения горячего пути, если включён DEBUG."""
+    return logging.root.isEnabledFor(logging.DEBUG) and next(_log_sequence) % LOG_SAMPLE_EVERY == 0
+
+def observe_client_latency(client_id, latency):
+    """
+    Сумма и количество задержек по клиенту, без корзин. Рядов не больше
+    CLIENT_LATENCY_SERIES_MAX: ряды давно не отвечавшего клиента удаляются
+    (для Prometheus это сброс счётчика), поэтому число рядов ограничено при
+    любом размере флота. Распределение по всему флоту — в гистограмме
+    fluxops_command_latency_seconds.
+    """
+    labels = (("client_id", client_id),)
+    client_latency_series[client_id] = None
+    client_latency_series.move_to_end(client_id)
+    metrics.inc("fluxops_client_command_latency_seconds_sum", latency, labels)
+    metrics.inc("fluxops_client_command_latency_seconds_count", 1, labels)
+    if len(client_latency_series) > CLIENT_LATENCY_SERIES_MAX:
+        evicted, _ = client_latency_series.popitem(last=False)
+        metrics.remove("fluxops_client_command_latency_seconds_sum", (("client_id", evicted),))
+        metrics.remove("fluxops_client_command_latency_seconds_count", (("client_id", evicted),))
+
+def collect_gauges():
+    """Обновляет показатели, которые дешевле посчитать при снятии метрик, чем на каждом сообщении."""
+    metrics.set("fluxops_registered_clients", len(registered_clients))
+    statuses = defaultdict(int)
+    for info in registered_clients.values():
+        statuses[info.status] += 1
+    for status in ("active", "stale", "offline"):
+        metrics.set("fluxops_clients", statuses[status], (("status", status),))
+    metrics.set("fluxops_commands_in_flight", len(pending_commands))
+    metrics.set("fluxops_broadcasts_in_flight", len(broadcasts))
+    metrics.set("fluxops_pending_deadlines", len(pending_deadlines))
+    if outbound is not None:
+        metrics.set("fluxops_outbound_queued", len(outbound.owners))
+        metrics.set("fluxops_outbound_queue_clients", len(outbound.queues))
+    if admission is not None:
+        for priority in PRIORITY_CLASSES:
+            metrics.set("fluxops_admission_queue", len(admission.queues[priority]), (("priority", priority),))
+        metrics.set("fluxops_admission_waiting", admission.size)
+    if result_cache is not None:
+        metrics.set("fluxops_result_cache_entries", len(result_cache.entries))
+        metrics.set("fluxops_result_cache_bytes", result_cache.size)
+    if command_history is not None and command_history.queue is not None:
+        metrics.set("fluxops_history_queue_depth", command_history.queue.qsize())
+    if scheduler is not None:
+        metrics.set("fluxops_scheduled_jobs", len(scheduler.jobs))
+        metrics.set("fluxops_scheduled_jobs_running", sum(1 for job in scheduler.jobs.values() if job["running"]))
+
+def render_stats():
+    collect_gauges()
+    return metrics.render((("shard", shard_index),) if shard_index is not None else ())
 
 ##############################################
 # Работа с файлами и историей команд
@@ -36,31 +211,371 @@ def load_json_file(filename):
             logging.error(f"Ошибка загрузки {filename}: {e}")
     return {}
 
-def save_json_file(filename, data):
-    """Сохраняет данные в JSON файл."""
-    try:
-        with open(filename, "w") as f:
-            json.dump(data, f, indent=4)
-    except Exception as e:
-        logging.error(f"Ошибка сохранения {filename}: {e}")
+class CommandHistory:
+    """
+    Журнал истории команд: только дозапись в сегменты JSON lines.
+    Сегмент ротируется по размеру или возрасту. Для каждого клиента в памяти
+    хранится индекс последних записей (время, сегмент, смещение, длина),
+    поэтому выборка «последние N команд клиента» читает только нужные строки.
+    Более старые записи клиента находятся чтением сегментов по интервалу времени.
+    """
+
+    def __init__(self, directory, background=True, legacy_file=None):
+        self.directory = directory
+        self.legacy_file = legacy_file
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.index = defaultdict(lambda: deque(maxlen=HISTORY_INDEX_PER_CLIENT))
+        self.segments = []  # [(время начала, имя файла)] по возрастанию
+        self._file = None
+        self._size = 0
+        self._opened_at = 0
+        self._load_segments()
+        self.queue = None
+        if background:
+            self.queue = queue.Queue()
+            threading.Thread(target=self._writer_loop, daemon=True).start()
+
+    def _load_segments(self):
+        """Восстанавливает список сегментов и индекс по клиентам после перезапуска."""
+        for name in sorted(os.listdir(self.directory)):
+            if not (name.startswith("history-") and name.endswith(".jsonl")):
+                continue
+            started_at = int(name[len("history-"):].split("-")[0])
+            self.segments.append((started_at, name))
+            offset = 0
+            with open(os.path.join(self.directory, name), "rb") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self.index[entry["client_id"]].append((entry["ts"], name, offset, len(line)))
+                    except Exception:
+                        logging.warning(f"Повреждённая запись в {name} по смещению {offset}")
+                    offset += len(line)
+        if not self.segments and self.legacy_file and os.path.exists(self.legacy_file):
+            legacy = load_json_file(self.legacy_file)
+            # Время записи неизвестно — ставим время изменения файла: запись не новее его
+            stamp = os.path.getmtime(self.legacy_file)
+            legacy = legacy if isinstance(legacy, list) else []
+            imported = []
+            for entry in legacy:
+                if not isinstance(entry, dict) or "client_id" not in entry:
+                    continue
+                if "ts" not in entry:
+                    try:
+                        entry["ts"] = datetime.fromisoformat(entry["timestamp"]).timestamp()
+                    except (KeyError, TypeError, ValueError):
+                        entry["ts"] = stamp
+                imported.append(entry)
+            if imported:
+                self._write(imported)
+            logging.info(f"Импортирована история из {self.legacy_file}: {len(imported)} записей"
+                         f" (пропущено повреждённых: {len(legacy) - len(imported)})")
+
+    def append(self, entry):
+        """Добавляет запись; с фоновым писателем — просто кладёт её в очередь."""
+        if self.queue is not None:
+            self.queue.put(entry)
+        else:
+            self._write([entry])
+
+    def _writer_loop(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < 1000:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as e:
+                logging.error(f"Ошибка записи истории команд: {e}")
+
+    def _rotate_if_needed(self, now):
+        if (self._file is not None and self._size < HISTORY_SEGMENT_MAX_BYTES
+                and now - self._opened_at < HISTORY_SEGMENT_MAX_AGE):
+            return
+        if self._file is not None:
+            self._file.close()
+        started_at = int(now)
+        name = f"history-{started_at:012d}-{len(self.segments):06d}.jsonl"
+        self._file = open(os.path.join(self.directory, name), "ab")
+        self._size = self._file.tell()
+        self._opened_at = now
+        self.segments.append((started_at, name))
+
+    def _write(self, entries):
+        started = time.perf_counter()
+        written = []
+        with self.lock:
+            for entry in entries:
+                self._rotate_if_needed(entry["ts"])
+                line = (json.dumps(entry, ensure_ascii=False) + "\n").encode()
+                self._file.write(line)
+                written.append((entry["client_id"], entry["ts"], self.segments[-1][1], self._size, len(line)))
+                self._size += len(line)
+            self._file.flush()
+            for client_id, ts, name, offset, length in written:
+                self.index[client_id].append((ts, name, offset, length))
+        metrics.observe("fluxops_history_write_seconds", time.perf_counter() - started)
+        metrics.inc("fluxops_history_entries_total", len(entries))
+
+    def _read(self, locations):
+        entries = []
+        handles = {}
+        try:
+            for _, name, offset, length in locations:
+                if name not in handles:
+                    handles[name] = open(os.path.join(self.directory, name), "rb")
+                handles[name].seek(offset)
+                entries.append(json.loads(handles[name].read(length)))
+        finally:
+            for f in handles.values():
+                f.close()
+        return entries
+
+    def last(self, client_id, limit=10):
+        """Последние limit записей клиента, от старых к новым."""
+        with self.lock:
+            locations = list(self.index.get(client_id, ()))[-limit:]
+        return self._read(locations)
+
+    def since(self, timestamp, client_id=None, limit=1000):
+        """
+        Записи начиная с timestamp; читаются только сегменты, покрывающие интервал.
+        Записи клиента берутся из индекса, а если интервал начинается раньше
+        самой старой записи в индексе, начало дочитывается из сегментов.
+        """
+        stop = None
+        if client_id is not None:
+            with self.lock:
+                indexed = self.index.get(client_id, ())
+                locations = [loc for loc in indexed if loc[0] >= timestamp]
+                if len(indexed) >= HISTORY_INDEX_PER_CLIENT and indexed[0][0] >= timestamp:
+                    stop = indexed[0][1:3]  # (сегмент, смещение), с которых записи есть в индексе
+            if stop is None:
+                return self._read(locations[:limit])
+        entries = self._scan(timestamp, client_id, limit, stop)
+        if stop is not None:
+            entries += self._read(locations[:limit - len(entries)])
+        return entries
+
+    def _scan(self, timestamp, client_id, limit, stop):
+        """Последовательное чтение сегментов с timestamp до записи stop (сегмент, смещение)."""
+        with self.lock:
+            starts = [started_at for started_at, _ in self.segments]
+            names = [name for _, name in self.segments[max(0, bisect.bisect_right(starts, timestamp) - 1):]]
+        entries = []
+        for name in names:
+            offset = 0
+            with open(os.path.join(self.directory, name), "rb") as f:
+                for line in f:
+                    if (name, offset) == stop:
+                        return entries
+                    offset += len(line)
+                    entry = json.loads(line)
+                    if entry["ts"] >= timestamp and (client_id is None or entry["client_id"] == client_id):
+                        entries.append(entry)
+                        if len(entries) >= limit:
+                            return entries
+        return entries
 
 def save_command_history(command, client_id, result):
-    history = load_json_file(COMMAND_HISTORY_FILE)
-    if not isinstance(history, list):
-        history = []
-    history.append({
-        "timestamp": datetime.now().isoformat(),
+    now = time.time()
+    command_history.append({
+        "timestamp": datetime.fromtimestamp(now).isoformat(),
+        "ts": now,
         "client_id": client_id,
         "command": command,
         "result": result
     })
-    save_json_file(COMMAND_HISTORY_FILE, history)
+
+class OutboundQueue:
+    """
+    Очереди команд для клиентов, недоступных в момент запроса (queue: true).
+    Журнал — JSON lines: запись put на каждую поставленную команду и запись
+    done на пачку доставленных (или отменённых, просроченных). При запуске
+    журнал проигрывается; когда устаревших записей становится много,
+    он переписывается одними живыми записями (временный файл + переименование).
+    put пишется с fsync, done — без: потерянный done приводит лишь к повторной
+    доставке, а повтор клиент отбрасывает по request_id. Рассылка ставит
+    в очереди сразу многих клиентов: её put пишутся без fsync, а затем
+    вызывающий делает один sync() до ответа о постановке в очередь.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.queues = defaultdict(OrderedDict)  # client_id -> request_id -> запись
+        self.owners = {}  # request_id -> client_id
+        self.obsolete = 0
+        self._load()
+        self._file = open(filename, "a")
+
+    def _load(self):
+        try:
+            with open(self.filename, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logging.warning(f"Повреждённая запись в {self.filename}")
+                        continue
+                    if record["op"] == "put":
+                        self._add(record["entry"])
+                    else:
+                        self.obsolete += 1 + len(self._remove(record["ids"]))
+        except FileNotFoundError:
+            return
+        if self.owners:
+            logging.info(f"Восстановлены очереди команд: {len(self.owners)} команд для {len(self.queues)} клиентов")
+
+    def _add(self, entry):
+        self.queues[entry["client_id"]][entry["request_id"]] = entry
+        self.owners[entry["request_id"]] = entry["client_id"]
+
+    def _remove(self, request_ids):
+        removed = []
+        for request_id in request_ids:
+            client_id = self.owners.pop(request_id, None)
+            if client_id is None:
+                continue
+            removed.append(self.queues[client_id].pop(request_id))
+            if not self.queues[client_id]:
+                del self.queues[client_id]
+        return removed
+
+    def _append(self, record, sync=False):
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+
+    def put(self, client_id, command, timeout, sync=True):
+        """Ставит команду в очередь клиента; возвращает запись или None, если очередь полна."""
+        if len(self.queues.get(client_id, ())) >= OUTBOUND_QUEUE_MAX_PER_CLIENT:
+            return None
+        entry = {"request_id": new_request_id(), "client_id": client_id, "command": command,
+                 "timeout": timeout, "queued_at": time.time()}
+        self._append({"op": "put", "entry": entry}, sync=sync)
+        self._add(entry)
+        return entry
+
+    def sync(self):
+        """Сбрасывает на диск записи, сделанные put(sync=False)."""
+        os.fsync(self._file.fileno())
+
+    def done(self, request_ids):
+        """Убирает команды из очередей (доставлены, отменены или просрочены)."""
+        removed = self._remove(request_ids)
+        if removed:
+            self._append({"op": "done", "ids": [entry["request_id"] for entry in removed]})
+            self.obsolete += 1 + len(removed)
+            if self.obsolete >= OUTBOUND_COMPACT_MIN and self.obsolete > len(self.owners):
+                self._compact()
+        return removed
+
+    def batch(self, client_id, size=OUTBOUND_BATCH_SIZE):
+        return list(self.queues.get(client_id, {}).values())[:size]
+
+    def describe(self, now):
+        """Глубина и возраст очереди каждого клиента с непустой очередью."""
+        return {client_id: {"depth": len(entries),
+                            "oldest_queued_at": next(iter(entries.values()))["queued_at"],
+                            "age": round(now - next(iter(entries.values()))["queued_at"], 3)}
+                for client_id, entries in self.queues.items()}
+
+    def _compact(self):
+        temp_file = f"{self.filename}.tmp"
+        with open(temp_file, "w") as f:
+            for entries in self.queues.values():
+                for entry in entries.values():
+                    f.write(json.dumps({"op": "put", "entry": entry}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._file.close()
+        os.replace(temp_file, self.filename)
+        self._file = open(self.filename, "a")
+        self.obsolete = 0
+
+##############################################
+# Кодирование сообщений ROUTER/DEALER
+##############################################
+# Кадр в старом формате — просто JSON (начинается с '{'). Кадр в новом формате
+# начинается с байта заголовка 0b11EECC: EE — кодек тела, CC — сжатие.
+FRAME_MARKER = 0xC0
+ENCODINGS = {"json": 0, "msgpack": 1}
+COMPRESSIONS = {"none": 0, "zlib": 1, "zstd": 2}
+
+def supported_encodings():
+    return (["msgpack"] if msgpack is not None else []) + ["json"]
+
+def supported_compressions():
+    return (["zstd"] if zstandard is not None else []) + ["zlib", "none"]
+
+def encode_message(msg, encoding="json", compression="none"):
+    """Кодирует сообщение выбранным кодеком и учитывает время кодирования в метриках."""
+    started = time.perf_counter()
+    data = _encode_message(msg, encoding, compression)
+    metrics.observe("fluxops_codec_seconds", time.perf_counter() - started, (("op", "encode"), ("encoding", encoding)))
+    return data
+
+def _encode_message(msg, encoding, compression):
+    """Тело больше COMPRESS_THRESHOLD сжимается."""
+    if encoding == "json" and compression == "none":
+        return json.dumps(msg).encode()
+    body = msgpack.packb(msg, use_bin_type=True) if encoding == "msgpack" else json.dumps(msg).encode()
+    compressed = 0
+    if compression != "none" and len(body) >= COMPRESS_THRESHOLD:
+        if compression == "zstd":
+            body = zstandard.ZstdCompressor().compress(body)
+        else:
+            body = zlib.compress(body)
+        compressed = COMPRESSIONS[compression]
+    return bytes([FRAME_MARKER | ENCODINGS[encoding] << 2 | compressed]) + body
+
+def decode_message(data):
+    """Декодирует кадр любого поддерживаемого формата и учитывает время декодирования в метриках."""
+    started = time.perf_counter()
+    msg = _decode_message(data)
+    metrics.observe("fluxops_codec_seconds", time.perf_counter() - started, (("op", "decode"),))
+    return msg
+
+def _decode_message(data):
+    """Формат описан в самом кадре."""
+    if not data or data[0] & FRAME_MARKER != FRAME_MARKER:
+        return json.loads(data.decode())
+    header, body = data[0], data[1:]
+    compressed = header & 0x03
+    if compressed == COMPRESSIONS["zlib"]:
+        body = zlib.decompress(body)
+    elif compressed == COMPRESSIONS["zstd"]:
+        body = zstandard.ZstdDecompressor().decompress(body)
+    if (header >> 2) & 0x03 == ENCODINGS["msgpack"]:
+        return msgpack.unpackb(body, raw=False)
+    return json.loads(body.decode())
+
+def negotiate(offered, supported):
+    """Первый вариант из предложенных клиентом, который поддерживает и сервер."""
+    for option in offered or ():
+        if option in supported:
+            return option
+    return supported[-1]
 
 ##############################################
 # UDP автообнаружение
 ##############################################
-def udp_discovery():
-    """Запускает UDP-сервер автообнаружения, отвечающий на DISCOVER-запросы."""
+def server_load():
+    """Нагрузка для ответа автообнаружения: зарегистрированные клиенты плюс команды в работе."""
+    return len(registered_clients) + len(pending_commands)
+
+def udp_discovery(load=server_load):
+    """
+    Запускает UDP-сервер автообнаружения, отвечающий на DISCOVER-запросы.
+    На "DISCOVER v2" отвечает JSON с портом, нагрузкой (load()) и версией
+    протокола, чтобы клиент мог выбрать наименее загруженный сервер;
+    на старый "DISCOVER" — прежним "ACK".
+    """
     udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
     try:
@@ -69,8 +584,15 @@ def udp_discovery():
         while True:
             try:
                 data, addr = udp_socket.recvfrom(1024)
-                if data.decode().strip() == "DISCOVER":
-                    logging.info(f"Получен DISCOVER-запрос от {addr}, отправляем ACK")
+                request = data.decode().split()
+                if not request or request[0] != "DISCOVER":
+                    continue
+                if log_sampled():
+                    logging.debug(f"Получен DISCOVER-запрос от {addr}")
+                if len(request) > 1:
+                    offer = {"status": "ACK", "port": ZMQ_PORT, "load": load(), "version": PROTOCOL_VERSION}
+                    udp_socket.sendto(json.dumps(offer).encode(), addr)
+                else:
                     udp_socket.sendto(b"ACK", addr)
             except Exception as e:
                 logging.error(f"Ошибка в UDP сервере: {e}")
@@ -85,112 +607,2003 @@ def process_router_message(parts):
     if len(parts) < 2:
         logging.warning("Получено некорректное сообщение.")
         return None, None
+    identity = parts[0].decode()
     try:
-        identity = parts[0].decode()
-        msg_text = parts[-1].decode()
-        msg = json.loads(msg_text)
+        msg = decode_message(parts[-1])
     except Exception as e:
         logging.error(f"Ошибка обработки сообщения: {e}")
-        msg = {"text": msg_text}
+        msg = {"text": parts[-1].decode(errors="replace")}
     return identity, msg
 
+def send_to_agent(router_socket, identity, msg):
+    """Отправляет сообщение клиенту в согласованном при регистрации формате."""
+    info = registered_clients.get(identities.get(identity))
+    if info is None:
+        router_socket.send_multipart([identity.encode(), b'', encode_message(msg)])
+    else:
+        router_socket.send_multipart([info.identity_bytes, b'', encode_message(msg, info.encoding, info.compression)])
+
+##############################################
+# Регистрация и отслеживание живости клиентов
+##############################################
+class TimingWheel:
+    """
+    Колесо таймеров: слоты по tick секунд на горизонт horizon.
+    Постановка и срабатывание — O(1); ключ, срок которого наступил,
+    возвращается из advance() и при необходимости ставится заново.
+    """
+
+    def __init__(self, tick, horizon):
+        self.tick = tick
+        self.slots = [set() for _ in range(int(horizon / tick) + 2)]
+        self.current = int(time.time() / tick)
+
+    def schedule(self, key, when):
+        slot = min(max(int(when / self.tick), self.current + 1), self.current + len(self.slots) - 1)
+        self.slots[slot % len(self.slots)].add(key)
+
+    def advance(self, now):
+        """Продвигает колесо до now и возвращает ключи из пройденных слотов."""
+        target = int(now / self.tick)
+        if target - self.current > len(self.slots):
+            self.current = target - len(self.slots)  # долгий простой: пройти каждый слот один раз
+        expired = []
+        while self.current < target:
+            self.current += 1
+            slot = self.slots[self.current % len(self.slots)]
+            expired.extend(slot)
+            slot.clear()
+        return expired
+
+def heartbeat_interval():
+    """Интервал пингов для клиентов: растёт с размером флота, чтобы ограничить поток пингов."""
+    fleet_size = len(registered_clients) * shard_count
+    return min(HEARTBEAT_MAX_INTERVAL, max(HEARTBEAT_INTERVAL, fleet_size / HEARTBEAT_TARGET_RATE))
+
+def stale_after():
+    return max(CLIENT_STALE_AFTER, 3 * heartbeat_interval())
+
+def offline_after():
+    return max(CLIENT_OFFLINE_AFTER, 12 * heartbeat_interval())
+
+class ClientRecord:
+    """
+    Запись реестра о клиенте. __slots__ вместо словаря: на 100 тысячах
+    клиентов это в разы меньше памяти. identity хранится сразу в байтах,
+    чтобы не кодировать её на каждой отправке.
+    """
+    __slots__ = ("client_id", "identity", "identity_bytes", "group", "hostname", "ip", "certificates",
+                 "encoding", "compression", "status", "last_seen", "registered_at",
+                 "messages", "commands_sent", "commands_done", "facts", "facts_version", "facts_updated")
+
+    def __init__(self, client_id, identity, data, status, now):
+        self.client_id = client_id
+        self.identity = identity
+        self.identity_bytes = identity.encode()
+        self.group = data.get("group", "default")
+        self.hostname = data.get("hostname")
+        self.ip = data.get("ip")
+        self.certificates = data.get("certificates")
+        self.encoding = negotiate(data.get("encodings"), supported_encodings())
+        self.compression = negotiate(data.get("compressions"), supported_compressions())
+        self.status = status
+        self.last_seen = now
+        self.registered_at = now
+        self.messages = 0
+        self.commands_sent = 0
+        self.commands_done = 0
+        self.facts = {}
+        self.facts_version = 0
+        self.facts_updated = None
+
+def client_status_event(client_id):
+    info = registered_clients[client_id]
+    return {
+        "type": "client_status",
+        "client_id": client_id,
+        "status": info.status,
+        "last_seen": info.last_seen,
+        "hostname": info.hostname,
+        "group": info.group,
+        "ip": info.ip,
+        "shard": shard_index,
+    }
+
+def set_client_status(events_socket, client_id, status):
+    """Меняет состояние клиента и публикует переход для api.py."""
+    info = registered_clients[client_id]
+    if info.status == status:
+        return
+    logging.info(f"Клиент {client_id}: {info.status} -> {status}")
+    info.status = status
+    events_socket.send_multipart([b"liveness", json.dumps(client_status_event(client_id)).encode()])
+
+def touch_client(events_socket, identity, now):
+    """Отмечает, что от клиента пришло сообщение. Возвращает client_id или None."""
+    client_id = identities.get(identity)
+    if client_id is None:
+        return None
+    info = registered_clients[client_id]
+    info.last_seen = now
+    info.messages += 1
+    if info.status != "active":
+        if info.status == "offline":
+            liveness_wheel.schedule(client_id, now + stale_after())
+            # Пачка, отправленная до пропадания связи, скорее всего потеряна — уйдёт заново
+            outbound_batches.pop(client_id, None)
+        set_client_status(events_socket, client_id, "active")
+    return client_id
+
+def check_liveness(events_socket, now):
+    """Обрабатывает клиентов, чей срок проверки наступил: переводит в stale/offline."""
+    for client_id in liveness_wheel.advance(now):
+        info = registered_clients.get(client_id)
+        if info is None or info.status == "offline":
+            continue
+        silent = now - info.last_seen
+        if silent >= offline_after():
+            set_client_status(events_socket, client_id, "offline")
+        elif silent >= stale_after():
+            set_client_status(events_socket, client_id, "stale")
+            liveness_wheel.schedule(client_id, info.last_seen + offline_after())
+        else:
+            liveness_wheel.schedule(client_id, info.last_seen + stale_after())
+
+def register_client(router_socket, events_socket, identity, msg):
+    data = msg.get("data", {})
+    client_id = data.get("client_id", identity)
+    now = time.time()
+    previous = registered_clients.get(client_id)
+    info = ClientRecord(client_id, identity, data, previous.status if previous else "offline", now)
+    if previous is not None:
+        # Счётчики переживают повторную регистрацию, записи о прежнем подключении убираем из индексов
+        info.registered_at = previous.registered_at
+        info.messages, info.commands_sent, info.commands_done = \
+            previous.messages, previous.commands_sent, previous.commands_done
+        info.facts, info.facts_version, info.facts_updated = \
+            previous.facts, previous.facts_version, previous.facts_updated
+        groups[previous.group].discard(client_id)
+        if identities.get(previous.identity) == client_id:
+            del identities[previous.identity]
+    registered_clients[client_id] = info
+    identities[identity] = client_id
+    groups[info.group].add(client_id)
+    if previous is None or previous.status == "offline":
+        liveness_wheel.schedule(client_id, now + stale_after())
+    set_client_status(events_socket, client_id, "active")
+    # Ответ на регистрацию всегда в JSON: клиент узнаёт из него выбранный формат
+    reply = {"status": "registered",
+             "encoding": info.encoding,
+             "compression": info.compression,
+             "heartbeat_interval": heartbeat_interval()}
+    router_socket.send_multipart([info.identity_bytes, b'', json.dumps(reply).encode()])
+    logging.info(f"Клиент зарегистрирован: {client_id} ({identity})")
+    # Неподтверждённая пачка могла не дойти до прежнего подключения — отправляем заново
+    outbound_batches.pop(client_id, None)
+    deliver_queued(router_socket, client_id)
+    resume_transfers(router_socket, client_id)
+
+def list_clients():
+    """Снимок реестра для командного интерфейса (action == "clients")."""
+    clients = []
+    for client_id, info in registered_clients.items():
+        event = client_status_event(client_id)
+        event.update(registered_at=info.registered_at, messages=info.messages,
+                     commands_sent=info.commands_sent, commands_done=info.commands_done)
+        clients.append(event)
+    return {"status": "success", "clients": clients}
+
+##############################################
+# Факты о клиентах
+##############################################
+# Клиент присылает факты о системе (ОС, процессор, память, диски, адреса)
+# как разницу с версией, которая уже есть у сервера: {"base", "version",
+# "set", "unset"}; base 0 — полный снимок. Если base не совпадает с версией
+# на сервере, клиент получает facts_resync и присылает полный снимок.
+def _indexable(value):
+    """Значения факта для индекса: сам скаляр или элементы списка."""
+    values = value if isinstance(value, list) else [value]
+    return [v for v in values if isinstance(v, (str, int, float, bool)) or v is None]
+
+def index_facts(client_id, facts, add):
+    for key, value in facts.items():
+        for v in map(json.dumps, _indexable(value)):
+            if add:
+                facts_index[key][v].add(client_id)
+                continue
+            clients = facts_index[key][v]
+            clients.discard(client_id)
+            if not clients:
+                del facts_index[key][v]
+                if not facts_index[key]:
+                    del facts_index[key]
+
+def handle_facts(router_socket, client_id, msg):
+    info = registered_clients[client_id]
+    base = int(msg.get("base", 0))
+    if base and base != info.facts_version:
+        send_to_agent(router_socket, info.identity, {"type": "facts_resync", "version": info.facts_version})
+        return
+    changes = msg.get("set", {})
+    if base:
+        facts = dict(info.facts)
+        removed = {key: facts.pop(key) for key in msg.get("unset", []) if key in facts}
+        removed.update((key, facts[key]) for key in changes if key in facts)
+        facts.update(changes)
+    else:
+        removed, facts = info.facts, dict(changes)
+    index_facts(client_id, removed, add=False)
+    index_facts(client_id, changes, add=True)
+    info.facts = facts
+    info.facts_version = int(msg["version"])
+    info.facts_updated = time.time()
+    metrics.inc("fluxops_facts_updates_total", 1, (("kind", "delta" if base else "full"),))
+    send_to_agent(router_socket, info.identity, {"type": "facts_ack", "version": info.facts_version})
+
+def query_facts(cmd_msg):
+    """
+    Запрос к индексу фактов (action == "facts"): where — равенство фактов
+    (для списков — вхождение значения), client_ids или group — ограничение
+    по клиентам, keys — какие факты вернуть, summary — распределение
+    значений факта по найденным клиентам. Клиентов не опрашивает.
+    Сравнение учитывает тип: строка "12" не равна числу 12, true не равно 1.
+    Список в where — несколько допустимых значений (достаточно любого).
+    """
+    candidates = None
+    for key, value in (cmd_msg.get("where") or {}).items():
+        values = value if isinstance(value, list) else [value]
+        if not values or len(_indexable(values)) != len(values):
+            return {"status": "error", "message": f"Недопустимое значение для {key}: {value!r}"}
+        index = facts_index.get(key, {})
+        matched = set().union(*(index.get(json.dumps(v), ()) for v in values))
+        candidates = matched if candidates is None else candidates & matched
+    if cmd_msg.get("client_ids") or cmd_msg.get("group"):
+        selected = set(select_clients(cmd_msg))
+        candidates = selected if candidates is None else candidates & selected
+    if candidates is None:
+        candidates = registered_clients.keys()
+    keys = cmd_msg.get("keys")
+    reply = {"status": "success", "facts": {}}
+    for client_id in candidates:
+        info = registered_clients[client_id]
+        if not info.facts_version:
+            continue
+        facts = info.facts if not keys else {key: info.facts[key] for key in keys if key in info.facts}
+        reply["facts"][client_id] = {"version": info.facts_version, "updated": info.facts_updated, "facts": facts}
+    if cmd_msg.get("summary"):
+        summary = defaultdict(int)
+        for client_id in reply["facts"]:
+            for value in _indexable(registered_clients[client_id].facts.get(cmd_msg["summary"])):
+                summary[str(value)] += 1
+        reply["summary"] = dict(summary)
+    return reply
+
 ##############################################
 # Обработка внешних команд (через TCP_COMMAND_PORT)
 ##############################################
+def send_to_caller(command_socket, envelope, reply):
+    """Отправляет ответ вызывающей стороне командного интерфейса (REQ или DEALER)."""
+    command_socket.send_multipart(envelope + [json.dumps(reply).encode()])
+
+def dispatch_command(router_socket, envelope, client_id, command, timeout, tag=None, broadcast_id=None):
+    """
+    Отправляет команду клиенту и регистрирует её в таблице ожидающих ответа.
+    Ответ вызывающей стороне будет отправлен позже, по приходу command_result
+    с тем же request_id или по истечении таймаута.
+    """
+    request_id = new_request_id()
+    info = registered_clients[client_id]
+    identity = info.identity
+    info.commands_sent += 1
+    msg = {"type": "command", "command": command, "request_id": request_id, "timeout": timeout}
+    send_to_agent(router_socket, identity, msg)
+    track_pending(request_id, envelope, client_id, command, timeout, tag, broadcast_id)
+    metrics.inc("fluxops_commands_sent_total")
+    if log_sampled():
+        logging.debug(f"Отправлена команда клиенту {client_id} ({identity}) [{request_id}]: {command}")
+    return request_id
+
+def new_request_id():
+    # В режиме шардирования номер воркера в request_id позволяет фронту маршрутизировать отмену
+    return uuid.uuid4().hex if shard_index is None else f"w{shard_index}-{uuid.uuid4().hex}"
+
+def track_pending(request_id, envelope, client_id, command, timeout, tag=None, broadcast_id=None):
+    """Регистрирует запрос к клиенту в таблице ожидающих ответа с дедлайном."""
+    identity = registered_clients[client_id].identity
+    deadline = time.time() + timeout
+    pending_commands[request_id] = {
+        "envelope": envelope,
+        "client_id": client_id,
+        "identity": identity,
+        "command": command,
+        "tag": tag,
+        "broadcast_id": broadcast_id,
+        "sent_at": time.time(),
+        "deadline": deadline,
+        "followers": [],  # (envelope, tag) запросов, слитых с этим (см. dispatch_cached)
+    }
+    heapq.heappush(pending_deadlines, (deadline, request_id))
+
+def finish_pending(router_socket, command_socket, request_id, pending, reply):
+    """Доставляет ответ по завершённой команде: вызывающей стороне или в рассылку."""
+    if pending.get("admitted"):
+        admission.release(pending["client_id"])
+    if pending["broadcast_id"] is not None:
+        broadcast_result(router_socket, command_socket, pending["broadcast_id"], pending["client_id"], reply)
+        return
+    if pending.get("cache_key") is not None:
+        cache_result(request_id, pending, reply)
+    for envelope, tag in pending["followers"]:
+        send_to_caller(command_socket, envelope, reply if tag is None else dict(reply, tag=tag))
+    if pending["envelope"] is None:
+        return  # команда из очереди: вызывающий уже получил ответ queued, результат — в истории
+    if pending["tag"] is not None:
+        reply["tag"] = pending["tag"]
+    send_to_caller(command_socket, pending["envelope"], reply)
+
 def process_command_interface(command_socket, router_socket):
     """
     Обрабатывает внешнюю команду, поступившую через командный интерфейс.
+    Не ждёт ответа клиента: команда регистрируется в pending_commands,
+    а ответ отправляется из handle_command_result или expire_pending_commands.
     """
+    parts = command_socket.recv_multipart()
+    envelope, payload = parts[:-1], parts[-1]
+    tag = None
     try:
-        cmd_msg = command_socket.recv_json()
-        client_id = cmd_msg.get("client_id")
-        command = cmd_msg.get("command")
-        if not client_id or not command:
-            return {"status": "error", "message": "client_id and command are required"}
+        cmd_msg = json.loads(payload.decode())
+        tag = cmd_msg.get("tag")
+        action = cmd_msg.get("action")
+        if action == "broadcast":
+            reply = start_broadcast(router_socket, command_socket, envelope, cmd_msg)
+            if reply is None:
+                return
+        elif action == "history":
+            reply = query_history(cmd_msg)
+        elif action == "cancel":
+            reply = cancel_command(router_socket, command_socket, cmd_msg)
+        elif action == "clients":
+            reply = list_clients()
+        elif action == "queues":
+            reply = {"status": "success", "queues": outbound.describe(time.time())}
+        elif action == "fetch_output":
+            reply = fetch_output(router_socket, envelope, cmd_msg)
+            if reply is None:
+                return
+        elif action == "push_file":
+            reply = start_transfer(router_socket, command_socket, envelope, cmd_msg)
+            if reply is None:
+                return
+        elif action == "transfers":
+            reply = describe_transfers()
+        elif action == "schedule":
+            reply = schedule_command(cmd_msg)
+        elif action == "unschedule":
+            reply = unschedule_command(cmd_msg)
+        elif action == "schedules":
+            reply = {"status": "success", "jobs": list(scheduler.jobs.values())}
+        elif action == "facts":
+            reply = query_facts(cmd_msg)
+        else:
+            client_id = cmd_msg.get("client_id")
+            command = cmd_msg.get("command")
+            timeout = float(cmd_msg.get("timeout", DEFAULT_COMMAND_TIMEOUT))
+            if not client_id or not command:
+                reply = {"status": "error", "message": "client_id and command are required"}
+            elif cmd_msg.get("queue") and not is_reachable(client_id):
+                reply = enqueue_command(client_id, command, timeout)
+            else:
+                reply = check_client(client_id)
+                if reply is None:
+                    reply = admission.admit(router_socket, envelope, cmd_msg, client_id, command, timeout,
+                                            cache_ttl(cmd_msg))
+                    if reply is None:
+                        return
+    except Exception as e:
+        logging.error(f"Ошибка обработки команды: {e}")
+        reply = {"status": "error", "message": str(e)}
+    if tag is not None:
+        reply["tag"] = tag
+    send_to_caller(command_socket, envelope, reply)
+
+class ResultCache:
+    """
+    LRU-кэш ответов на команды по ключу (client_id, command). Память ограничена
+    суммарным размером ответов в JSON; при переполнении вытесняются давно не
+    использованные записи, просроченные удаляются при обращении.
+    """
+
+    def __init__(self, max_bytes=RESULT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # ключ -> (expires_at, stored_at, reply, size)
+        self.size = 0
+
+    def get(self, key, now):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= now:
+            self._remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, reply, ttl, now):
+        size = len(json.dumps(reply))
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (now + ttl, now, reply, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        self.size -= self.entries.pop(key)[3]
+
+def cache_ttl(cmd_msg):
+    """Срок кэширования результата по запросу: кэш включается полями cache или cache_ttl."""
+    if cmd_msg.get("cache_ttl") is not None:
+        return float(cmd_msg["cache_ttl"])
+    if cmd_msg.get("cache"):
+        return RESULT_CACHE_TTLS.get(cmd_msg["command"].strip(), RESULT_CACHE_DEFAULT_TTL)
+    return 0
+
+def dispatch_cached(router_socket, envelope, client_id, command, timeout, tag, ttl):
+    """
+    Команда с разрешённым кэшированием: свежий результат отдаётся из кэша,
+    а одинаковые одновременные запросы ждут одну отправленную клиенту команду.
+    Возвращает ответ из кэша или None, если ответ придёт позже.
+    """
+    key = (client_id, command)
+    now = time.time()
+    entry = result_cache.get(key, now)
+    if entry is not None:
+        metrics.inc("fluxops_result_cache_total", 1, (("result", "hit"),))
+        return dict(entry[2], cached=True, age=round(now - entry[1], 3))
+    request_id = inflight_results.get(key)
+    if request_id in pending_commands:
+        metrics.inc("fluxops_result_cache_total", 1, (("result", "coalesced"),))
+        pending_commands[request_id]["followers"].append((envelope, tag))
+        return None
+    metrics.inc("fluxops_result_cache_total", 1, (("result", "miss"),))
+    request_id = dispatch_command(router_socket, envelope, client_id, command, timeout, tag)
+    pending_commands[request_id].update(cache_key=key, cache_ttl=ttl)
+    inflight_results[key] = request_id
+    return None
+
+def cache_result(request_id, pending, reply):
+    """Запоминает успешный результат команды, запрошенной с кэшированием."""
+    key = pending["cache_key"]
+    if inflight_results.get(key) == request_id:
+        del inflight_results[key]
+    data = (reply.get("reply") or {}).get("data") or {}
+    if reply.get("status") == "success" and not any(data.get(flag) for flag in ("error", "timed_out", "cancelled")):
+        result_cache.put(key, dict(reply), pending["cache_ttl"], time.time())
+
+def is_reachable(client_id):
+    """Для постановки в очередь: stale-клиент уже пропустил несколько пингов, команду он скорее всего не получит."""
+    info = registered_clients.get(client_id)
+    return info is not None and info.status == "active"
+
+def enqueue_command(client_id, command, timeout, sync=True):
+    """Ставит команду в очередь недоступного клиента; она уйдёт при его возвращении."""
+    entry = outbound.put(client_id, command, timeout, sync)
+    if entry is None:
+        return {"status": "error", "message": f"Очередь команд клиента {client_id} переполнена"}
+    logging.info(f"Команда для недоступного клиента {client_id} поставлена в очередь [{entry['request_id']}]")
+    return {"status": "queued", "request_id": entry["request_id"], "client_id": client_id,
+            "queue_depth": len(outbound.queues[client_id])}
+
+def deliver_queued(router_socket, client_id):
+    """
+    Отправляет клиенту очередную пачку команд из его очереди. Следующая
+    пачка уходит только после подтверждения (batch_ack) предыдущей; пачка
+    без подтверждения дольше OUTBOUND_BATCH_ACK_TIMEOUT отправляется заново
+    (повтор клиент отбрасывает по request_id).
+    """
+    if client_id not in outbound.queues:
+        return
+    now = time.time()
+    batch = outbound_batches.get(client_id)
+    if batch is not None:
+        if now - batch["sent_at"] < OUTBOUND_BATCH_ACK_TIMEOUT:
+            return
+        logging.warning(f"Клиент {client_id} не подтвердил пачку из очереди, отправляем заново")
+        del outbound_batches[client_id]
+    entries = outbound.batch(client_id)
+    expired = [entry for entry in entries if now - entry["queued_at"] > OUTBOUND_QUEUE_MAX_AGE]
+    for entry in outbound.done([entry["request_id"] for entry in expired]):
+        logging.warning(f"Команда из очереди клиента {client_id} просрочена [{entry['request_id']}]")
+        save_command_history(entry["command"], client_id,
+                             {"request_id": entry["request_id"], "data": {"error": "Команда просрочена в очереди"}})
+    entries = [entry for entry in entries if entry not in expired]
+    if not entries:
+        deliver_queued(router_socket, client_id)
+        return
+    outbound_batches[client_id] = {"ids": [entry["request_id"] for entry in entries], "sent_at": now}
+    commands = [{"type": "command", "command": entry["command"], "request_id": entry["request_id"],
+                 "timeout": entry["timeout"]} for entry in entries]
+    send_to_agent(router_socket, registered_clients[client_id].identity,
+                  {"type": "command_batch", "commands": commands})
+    logging.info(f"Клиенту {client_id} отправлена пачка из очереди: {len(commands)} команд")
+
+def handle_batch_ack(router_socket, client_id, msg):
+    """Клиент принял пачку: команды переходят из очереди в ожидающие результата."""
+    acked = set(msg.get("request_ids", []))
+    sent = outbound_batches.pop(client_id, {"ids": []})["ids"]
+    for entry in outbound.done([request_id for request_id in sent if request_id in acked]):
+        track_pending(entry["request_id"], None, client_id, entry["command"], entry["timeout"])
+    deliver_queued(router_socket, client_id)
+
+def check_client(client_id):
+    """Ошибка для вызывающей стороны, если клиенту сейчас нельзя отправить запрос, иначе None."""
+    if client_id not in registered_clients:
+        return {"status": "error", "code": "not_found", "message": f"Клиент {client_id} не найден"}
+    if registered_clients[client_id].status == "offline":
+        return {"status": "error", "message": f"Клиент {client_id} недоступен (offline)"}
+    return None
+
+def fetch_output(router_socket, envelope, cmd_msg):
+    """
+    Запрашивает у клиента порцию полного вывода команды, сброшенного им на диск
+    (output_handle в результате). Ответ придёт в handle_output_chunk;
+    вызывающая сторона продолжает чтение с next_offset, пока не получит eof.
+    """
+    client_id = cmd_msg.get("client_id")
+    if not client_id or not cmd_msg.get("handle"):
+        return {"status": "error", "message": "client_id and handle are required"}
+    error = check_client(client_id)
+    if error is not None:
+        return error
+    request_id = new_request_id()
+    send_to_agent(router_socket, registered_clients[client_id].identity, {
+        "type": "fetch_output",
+        "request_id": request_id,
+        "handle": cmd_msg["handle"],
+        "stream": cmd_msg.get("stream", "stdout"),
+        "offset": int(cmd_msg.get("offset", 0)),
+        "length": int(cmd_msg.get("length", OUTPUT_FETCH_CHUNK)),
+    })
+    track_pending(request_id, envelope, client_id, None,
+                  float(cmd_msg.get("timeout", DEFAULT_COMMAND_TIMEOUT)), cmd_msg.get("tag"))
+    return None
+
+def handle_output_chunk(router_socket, command_socket, identity, msg):
+    """Передаёт вызывающей стороне порцию вывода, запрошенную fetch_output; в историю не пишется."""
+    request_id = msg.get("request_id")
+    pending = pending_commands.get(request_id)
+    if pending is None or pending["identity"] != identity:
+        return
+    del pending_commands[request_id]
+    chunk = msg.get("data") or {}
+    if "error" in chunk:
+        reply = {"status": "error", "request_id": request_id, "message": chunk["error"]}
+    else:
+        reply = dict(chunk, status="success", request_id=request_id)
+    finish_pending(router_socket, command_socket, request_id, pending, reply)
+
+def handle_command_result(router_socket, command_socket, identity, msg):
+    """Сопоставляет результат команды с ожидающим запросом по request_id."""
+    request_id = msg.get("request_id")
+    send_to_agent(router_socket, identity, {"status": "received", "request_id": request_id})
+    pending = pending_commands.get(request_id)
+    if pending is None or pending["identity"] != identity:
+        logging.warning(f"Результат без ожидающего запроса от {identity} [{request_id}]: {msg.get('data')}")
+        return
+    del pending_commands[request_id]
+    registered_clients[pending["client_id"]].commands_done += 1
+    save_command_history(pending["command"], pending["client_id"], msg)
+    latency = time.time() - pending["sent_at"]
+    metrics.observe("fluxops_command_latency_seconds", latency)
+    observe_client_latency(pending["client_id"], latency)
+    if log_sampled():
+        logging.debug(f"Результат команды от {pending['client_id']} [{request_id}] за {latency:.3f} с")
+    reply = {"status": "success", "request_id": request_id, "reply": msg}
+    finish_pending(router_socket, command_socket, request_id, pending, reply)
+
+def handle_command_output(events_socket, identity, msg):
+    """
+    Пересылает порцию потокового вывода команды подписчикам событий.
+    PUB-сокет не блокируется: медленному подписчику сверх EVENTS_HWM
+    сообщения не доставляются, поэтому память сервера ограничена.
+    """
+    request_id = msg.get("request_id")
+    pending = pending_commands.get(request_id)
+    if pending is None or pending["identity"] != identity:
+        return
+    frame = {
+        "type": "command_output",
+        "request_id": request_id,
+        "client_id": pending["client_id"],
+        "seq": msg.get("seq"),
+        "data": msg.get("data", ""),
+    }
+    events_socket.send_multipart([b"output", json.dumps(frame).encode()])
+
+def send_cancel(router_socket, identity, request_id):
+    """Просит клиента остановить выполнение команды."""
+    send_to_agent(router_socket, identity, {"type": "cancel", "request_id": request_id})
+
+def cancel_command(router_socket, command_socket, cmd_msg):
+    """Отменяет ожидающую команду: клиент завершает процесс, вызывающий получает ошибку."""
+    request_id = cmd_msg.get("request_id")
+    batch = outbound_batches.get(outbound.owners.get(request_id))
+    if request_id in outbound.owners and (batch is None or request_id not in batch["ids"]):
+        entry = outbound.done([request_id])[0]
+        logging.info(f"Команда из очереди клиента {entry['client_id']} [{request_id}] отменена")
+        return {"status": "success", "request_id": request_id}
+    pending = pending_commands.pop(request_id, None)
+    if pending is None:
+        return {"status": "error", "code": "not_found", "message": f"Команда {request_id} не найдена"}
+    send_cancel(router_socket, pending["identity"], request_id)
+    logging.info(f"Команда для клиента {pending['client_id']} [{request_id}] отменена")
+    finish_pending(router_socket, command_socket, request_id, pending,
+                   {"status": "error", "request_id": request_id, "message": "Команда отменена"})
+    return {"status": "success", "request_id": request_id}
+
+def expire_pending_commands(router_socket, command_socket):
+    """Отвечает ошибкой таймаута на команды, не получившие результата вовремя."""
+    now = time.time()
+    while pending_deadlines and pending_deadlines[0][0] <= now:
+        _, request_id = heapq.heappop(pending_deadlines)
+        pending = pending_commands.pop(request_id, None)
+        if pending is None:
+            continue  # результат уже получен
+        metrics.inc("fluxops_command_timeouts_total")
+        logging.warning(f"Таймаут команды для клиента {pending['client_id']} [{request_id}]")
+        send_cancel(router_socket, pending["identity"], request_id)
+        reply = {"status": "error", "request_id": request_id,
+                 "message": f"Таймаут ожидания ответа от клиента {pending['client_id']}"}
+        finish_pending(router_socket, command_socket, request_id, pending, reply)
+
+def next_poll_timeout(default=1000):
+    """
+    Таймаут опроса (мс) с учётом ближайшего дедлайна ожидающих команд, ближайшего
+    периодического задания и ближайшей команды, ждущей токенов допуска.
+    """
+    deadlines = [pending_deadlines[0][0]] if pending_deadlines else []
+    if scheduler is not None and scheduler.heap:
+        deadlines.append(scheduler.heap[0][0])
+    if admission is not None and admission.delayed:
+        deadlines.append(admission.delayed[0][0])
+    if not deadlines:
+        return default
+    delay = (min(deadlines) - time.time()) * 1000
+    return max(0, min(default, int(delay)))
+
+def query_history(cmd_msg):
+    """
+    Выборка из истории команд: {"client_id": ..., "limit": N} — последние N
+    команд клиента; {"since": timestamp} — записи начиная с момента времени.
+    """
+    client_id = cmd_msg.get("client_id")
+    limit = int(cmd_msg.get("limit", 10))
+    if "since" in cmd_msg:
+        entries = command_history.since(float(cmd_msg["since"]), client_id, limit)
+    elif client_id:
+        entries = command_history.last(client_id, limit)
+    else:
+        return {"status": "error", "message": "client_id or since is required"}
+    return {"status": "success", "history": entries}
+
+##############################################
+# Приоритеты и контроль нагрузки
+##############################################
+class RateLimiter:
+    """Token bucket на ключ (клиент или вызывающая сторона); rate 0 — без ограничения."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}  # ключ -> [токены, время обновления]; полные вёдра не хранятся
+
+    def _level(self, key, now):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            return self.burst
+        return min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+
+    def wait_time(self, key, now):
+        """Через сколько секунд будет токен (0 — уже есть)."""
+        if self.rate <= 0:
+            return 0
+        level = self._level(key, now)
+        return 0 if level >= 1 else (1 - level) / self.rate
+
+    def take(self, key, now):
+        if self.rate > 0:
+            self.buckets[key] = [self._level(key, now) - 1, now]
+
+    def purge(self, now):
+        for key in [key for key in self.buckets if self._level(key, now) >= self.burst]:
+            del self.buckets[key]
+
+def has_budget(priority):
+    return len(pending_commands) < MAX_IN_FLIGHT * IN_FLIGHT_SHARE[priority]
+
+class Admission:
+    """
+    Допуск одиночных команд к отправке клиентам. Команда уходит сразу, если
+    перед ней нет ожидающих того же или более срочного класса, есть общий
+    бюджет (менее срочным классам доступна только его доля), не превышен
+    лимит одновременных команд клиента и есть токены в вёдрах клиента и
+    вызывающей стороны. Иначе она ждёт в очереди своего класса; упёршиеся
+    в лимит клиента ждут в его очереди до завершения его команды, в токены —
+    в куче таймеров, поэтому основной цикл не перебирает очередь заново.
+    При переполнении, а также при wait=false, вызывающий сразу получает
+    отказ с позицией в очереди и рекомендуемой паузой. Впереди считаются
+    только ждущие в очередях классов и ждущие того же клиента: команды,
+    упёршиеся в лимит или токены другого клиента, ему не мешают.
+    """
+
+    def __init__(self):
+        self.queues = {priority: deque() for priority in PRIORITY_CLASSES}
+        self.parked = defaultdict(deque)  # client_id -> команды, ждущие завершения команды клиента
+        self.delayed = []  # куча (ready_at, seq, команда), ждущих токенов
+        self.size = 0
+        self.waiting = defaultdict(int)  # класс -> ждущих команд, включая ждущих клиента и токенов
+        self.held = defaultdict(int)  # (client_id, класс) -> команд, ждущих лимита клиента или токенов
+        self.seq = itertools.count()
+        self.in_flight = defaultdict(int)  # client_id -> команд normal и bulk в работе
+        self.client_rate = RateLimiter(CLIENT_RATE, CLIENT_BURST)
+        self.caller_rate = RateLimiter(CALLER_RATE, CALLER_BURST)
+
+    def admit(self, router_socket, envelope, cmd_msg, client_id, command, timeout, ttl):
+        """Отправляет команду или ставит её в очередь. Возвращает ответ вызывающей стороне или None."""
+        priority = cmd_msg.get("priority") or DEFAULT_PRIORITY
+        if priority not in PRIORITY_CLASSES:
+            return {"status": "error", "message": f"Неизвестный приоритет {priority!r}"}
+        now = time.time()
+        key = (client_id, command)
+        if ttl > 0 and (result_cache.get(key, now) is not None or inflight_results.get(key) in pending_commands):
+            # Ответ из кэша или слияние с уже отправленной командой: клиента не нагружает
+            return dispatch_cached(router_socket, envelope, client_id, command, timeout, cmd_msg.get("tag"), ttl)
+        entry = {"envelope": envelope, "tag": cmd_msg.get("tag"), "client_id": client_id, "command": command,
+                 "ttl": ttl, "priority": priority, "deadline": now + timeout,
+                 "caller": str(cmd_msg.get("caller") or envelope[0].hex())}
+        classes = PRIORITY_CLASSES[:PRIORITY_CLASSES.index(priority) + 1]
+        ahead = sum(len(self.queues[p]) + self.held.get((client_id, p), 0) for p in classes)
+        delay = self._delay(entry, now)
+        if ahead == 0 and delay == 0:
+            self._dispatch(router_socket, None, entry, now)
+            return None
+        retry_after = round(delay or 1.0, 3)
+        if not cmd_msg.get("wait", True) or self.size >= ADMISSION_QUEUE_LIMIT:
+            outcome = "busy" if self.size < ADMISSION_QUEUE_LIMIT else "rejected"
+            metrics.inc("fluxops_admission_total", 1, (("outcome", outcome), ("priority", priority)))
+            return {"status": outcome, "message": "Сервер перегружен" if outcome == "rejected"
+                    else "Команду нельзя отправить сейчас", "priority": priority,
+                    "queue_position": ahead + 1, "retry_after": retry_after}
+        self.queues[priority].append(entry)
+        self.size += 1
+        self.waiting[priority] += 1
+        metrics.inc("fluxops_admission_total", 1, (("outcome", "queued"), ("priority", priority)))
+        return None
+
+    def admit_broadcast(self, router_socket, job, broadcast_id, client_id, now):
+        """
+        Команда рассылки одному клиенту. Бюджет рассылка проверяет сама, а лимит
+        одновременных команд и вёдра клиента и вызывающей стороны у неё общие с
+        одиночными командами: не прошедшая ждёт так же, как одиночная.
+        """
+        entry = {"envelope": job["envelope"], "tag": None, "client_id": client_id, "command": job["command"],
+                 "ttl": 0, "priority": job["priority"], "deadline": now + job["timeout"],
+                 "caller": job["caller"], "broadcast_id": broadcast_id}
+        delay = self._delay(entry, now)
+        if delay == 0 and not self.held.get((client_id, entry["priority"])):
+            self._dispatch(router_socket, None, entry, now)
+            return
+        self.size += 1
+        self.waiting[entry["priority"]] += 1
+        self._hold(entry)
+        if delay is None:
+            self.parked[client_id].append(entry)
+        else:
+            heapq.heappush(self.delayed, (now + delay, next(self.seq), entry))
+
+    def _delay(self, entry, now):
+        """0 — можно отправить, секунды — ждать токенов, None — ждать бюджета или завершения команды клиента."""
+        priority = entry["priority"]
+        if not has_budget(priority):
+            return None
+        if priority != "interactive" and self.in_flight[entry["client_id"]] >= CLIENT_MAX_IN_FLIGHT:
+            return None
+        return max(self.client_rate.wait_time(entry["client_id"], now),
+                   self.caller_rate.wait_time(entry["caller"], now))
+
+    def _dispatch(self, router_socket, command_socket, entry, now):
+        client_id = entry["client_id"]
+        reply = check_client(client_id) if command_socket is not None else None
+        if reply is not None:
+            # Клиент пропал, пока команда ждала допуска
+            self._reply(router_socket, command_socket, entry, reply)
+            return
+        self.client_rate.take(client_id, now)
+        self.caller_rate.take(entry["caller"], now)
+        timeout = max(0.001, entry["deadline"] - now)  # ожидание в очереди входит в таймаут
+        if entry.get("broadcast_id") is not None:
+            request_id = dispatch_command(router_socket, entry["envelope"], client_id, entry["command"],
+                                          timeout, broadcast_id=entry["broadcast_id"])
+        elif entry["ttl"] > 0:
+            key = (client_id, entry["command"])
+            coalesced = inflight_results.get(key) in pending_commands
+            reply = dispatch_cached(router_socket, entry["envelope"], client_id, entry["command"], timeout,
+                                    entry["tag"], entry["ttl"])
+            if reply is not None:
+                send_to_caller(command_socket, entry["envelope"], self._frame(entry, reply))
+            if reply is not None or coalesced:
+                return  # результат появился, пока команда ждала допуска
+            request_id = inflight_results[key]
+        else:
+            request_id = dispatch_command(router_socket, entry["envelope"], client_id, entry["command"],
+                                          timeout, entry["tag"])
+        if entry["priority"] != "interactive":
+            self.in_flight[client_id] += 1
+            pending_commands[request_id]["admitted"] = True
+
+    def release(self, client_id):
+        """Команда клиента завершена: следующая из ждущих его лимита возвращается в очередь класса."""
+        self.in_flight[client_id] -= 1
+        if self.in_flight[client_id] <= 0:
+            del self.in_flight[client_id]
+        parked = self.parked.get(client_id)
+        if parked:
+            entry = min(parked, key=lambda e: PRIORITY_CLASSES.index(e["priority"]))
+            parked.remove(entry)
+            if not parked:
+                del self.parked[client_id]
+            self._unhold(entry)
+            self.queues[entry["priority"]].appendleft(entry)
+
+    def drain(self, router_socket, command_socket, now):
+        """Отправляет ждущие команды, пока позволяют бюджет и лимиты; вызывается из основного цикла."""
+        ready = []
+        while self.delayed and self.delayed[0][0] <= now:
+            ready.append(heapq.heappop(self.delayed)[2])
+        # В начало очереди своего класса, сохраняя порядок поступления
+        for entry in reversed(ready):
+            self._unhold(entry)
+            self.queues[entry["priority"]].appendleft(entry)
+        for priority in PRIORITY_CLASSES:
+            class_queue = self.queues[priority]
+            while class_queue and has_budget(priority):
+                entry = class_queue.popleft()
+                if entry["deadline"] <= now:
+                    self._expire(router_socket, command_socket, entry)
+                    continue
+                delay = self._delay(entry, now)
+                if delay is None:
+                    self._hold(entry)
+                    self.parked[entry["client_id"]].append(entry)
+                elif delay > 0:
+                    self._hold(entry)
+                    heapq.heappush(self.delayed, (now + delay, next(self.seq), entry))
+                else:
+                    self.size -= 1
+                    self.waiting[priority] -= 1
+                    self._dispatch(router_socket, command_socket, entry, now)
+        # Рассылки, остановленные исчерпанием бюджета, продолжают с его освобождением
+        for broadcast_id, job in list(broadcasts.items()):
+            if job["queue"] and job["in_flight"] < job["concurrency"] and has_budget(job["priority"]):
+                fill_broadcast(router_socket, command_socket, broadcast_id)
+
+    def expire(self, router_socket, command_socket, now):
+        """Отвечает таймаутом командам, так и не дождавшимся отправки; раз в секунду."""
+        # Сначала вынимаем просроченные из всех очередей, потом отвечаем: ответ
+        # в рассылку может поставить её следующую команду в те же очереди
+        expired = []
+        for priority, class_queue in self.queues.items():
+            self.queues[priority] = self._sweep(class_queue, now, expired)
+        for client_id in list(self.parked):
+            self.parked[client_id] = self._sweep(self.parked[client_id], now, expired)
+            if not self.parked[client_id]:
+                del self.parked[client_id]
+        if any(entry["deadline"] <= now for _, _, entry in self.delayed):
+            expired.extend(entry for _, _, entry in self.delayed if entry["deadline"] <= now)
+            self.delayed = [item for item in self.delayed if item[2]["deadline"] > now]
+            heapq.heapify(self.delayed)
+        for entry in expired:
+            self._expire(router_socket, command_socket, entry)
+        self.client_rate.purge(now)
+        self.caller_rate.purge(now)
+
+    @staticmethod
+    def _sweep(entries, now, expired):
+        kept = deque()
+        for entry in entries:
+            (expired if entry["deadline"] <= now else kept).append(entry)
+        return kept
+
+    def _hold(self, entry):
+        self.held[(entry["client_id"], entry["priority"])] += 1
+        entry["held"] = True
+
+    def _unhold(self, entry):
+        key = (entry["client_id"], entry["priority"])
+        self.held[key] -= 1
+        if self.held[key] <= 0:
+            del self.held[key]
+        entry["held"] = False
+
+    def _expire(self, router_socket, command_socket, entry):
+        self.size -= 1
+        self.waiting[entry["priority"]] -= 1
+        if entry.get("held"):
+            self._unhold(entry)
+        metrics.inc("fluxops_admission_total", 1, (("outcome", "expired"), ("priority", entry["priority"])))
+        self._reply(router_socket, command_socket, entry, {
+            "status": "error", "message": f"Команда для клиента {entry['client_id']} не дождалась отправки: "
+                                          f"сервер перегружен"})
+
+    def _reply(self, router_socket, command_socket, entry, reply):
+        """Ответ по команде, так и не отправленной клиенту: вызывающей стороне или в её рассылку."""
+        if entry.get("broadcast_id") is not None:
+            broadcast_result(router_socket, command_socket, entry["broadcast_id"], entry["client_id"], reply)
+        else:
+            send_to_caller(command_socket, entry["envelope"], self._frame(entry, reply))
+
+    @staticmethod
+    def _frame(entry, reply):
+        if entry["tag"] is not None:
+            reply["tag"] = entry["tag"]
+        return reply
+
+##############################################
+# Рассылка команды группе клиентов
+##############################################
+def select_clients(selector):
+    """
+    Возвращает список client_id, подходящих под селектор:
+    {"client_ids": [...]} — явный список, {"group": "..."} — группа,
+    {"all": true} — все зарегистрированные клиенты.
+    """
+    if selector.get("client_ids"):
+        return [cid for cid in dict.fromkeys(selector["client_ids"]) if cid in registered_clients]
+    if selector.get("group"):
+        return list(groups.get(selector["group"], ()))
+    if selector.get("all"):
+        return list(registered_clients)
+    return []
+
+def start_broadcast(router_socket, command_socket, envelope, cmd_msg):
+    """
+    Запускает рассылку команды всем клиентам, выбранным селектором.
+    Одновременно в работе не более concurrency команд; по мере завершения
+    отправляются следующие. При stream=true каждый результат сразу
+    пересылается вызывающей стороне (требуется DEALER), иначе в конце
+    отправляется один сводный ответ. Возвращает ответ об ошибке или None.
+    """
+    command = cmd_msg.get("command")
+    if not command:
+        return {"status": "error", "message": "command is required"}
+    targets = select_clients(cmd_msg)
+    if not targets:
+        return {"status": "error", "message": "Не найдено ни одного клиента для рассылки"}
+    broadcast_id = uuid.uuid4().hex
+    broadcasts[broadcast_id] = {
+        "envelope": envelope,
+        "tag": cmd_msg.get("tag"),
+        "command": command,
+        "stream": bool(cmd_msg.get("stream", False)),
+        "timeout": float(cmd_msg.get("timeout", DEFAULT_COMMAND_TIMEOUT)),
+        "concurrency": max(1, int(cmd_msg.get("concurrency", DEFAULT_BROADCAST_CONCURRENCY))),
+        "queue_offline": bool(cmd_msg.get("queue", False)),
+        "schedule_id": cmd_msg.get("schedule_id"),  # запуск периодического задания: итог уходит планировщику
+        "priority": cmd_msg.get("priority") if cmd_msg.get("priority") in PRIORITY_CLASSES else "bulk",
+        # Чьё ведро лимита частоты расходует рассылка: вызывающего или периодического задания
+        "caller": str(cmd_msg.get("caller") or (envelope[0].hex() if envelope
+                                                else f"schedule:{cmd_msg.get('schedule_id')}")),
+        "queue": deque(targets),
+        "in_flight": 0,
+        "total": len(targets),
+        "results": {},
+        "started_at": time.time(),
+    }
+    logging.info(f"Рассылка [{broadcast_id}] команды '{command}' на {len(targets)} клиентов")
+    if broadcasts[broadcast_id]["stream"]:
+        send_to_caller(command_socket, envelope, _broadcast_frame(broadcasts[broadcast_id], {
+            "type": "started", "broadcast_id": broadcast_id, "targets": targets}))
+    fill_broadcast(router_socket, command_socket, broadcast_id)
+    return None
+
+def fill_broadcast(router_socket, command_socket, broadcast_id):
+    """
+    Досылает команды из очереди рассылки до лимита одновременных. Каждая
+    проходит допуск наравне с одиночными (лимит и вёдра клиента, ведро
+    вызывающего); ждущая допуска занимает место в concurrency рассылки.
+    """
+    job = broadcasts[broadcast_id]
+    queued = []  # (client_id, ответ) — сообщаются после одного fsync журнала очередей
+    # Рассылка идёт в пределах доли общего бюджета своего класса (по умолчанию bulk)
+    while job["queue"] and job["in_flight"] < job["concurrency"] and has_budget(job["priority"]):
+        client_id = job["queue"].popleft()
         if client_id not in registered_clients:
-            return {"status": "error", "message": f"Клиент {client_id} не найден"}
+            record_broadcast_result(command_socket, broadcast_id, client_id,
+                                    {"status": "error", "code": "not_found", "message": f"Клиент {client_id} не найден"})
+            continue
+        if job["queue_offline"] and not is_reachable(client_id):
+            queued.append((client_id, enqueue_command(client_id, job["command"], job["timeout"], sync=False)))
+            continue
+        if registered_clients[client_id].status == "offline":
+            record_broadcast_result(command_socket, broadcast_id, client_id,
+                                    {"status": "error", "message": f"Клиент {client_id} недоступен (offline)"})
+            continue
+        job["in_flight"] += 1
+        admission.admit_broadcast(router_socket, job, broadcast_id, client_id, time.time())
+    if queued:
+        outbound.sync()
+        for client_id, reply in queued:
+            record_broadcast_result(command_socket, broadcast_id, client_id, reply)
+    finish_broadcast(command_socket, broadcast_id)
+
+def record_broadcast_result(command_socket, broadcast_id, client_id, reply):
+    """Сохраняет результат клиента в рассылке и при stream=true сразу пересылает его."""
+    job = broadcasts[broadcast_id]
+    job["results"][client_id] = reply
+    if job["stream"]:
+        send_to_caller(command_socket, job["envelope"], _broadcast_frame(job, {
+            "type": "result", "broadcast_id": broadcast_id, "client_id": client_id, **reply}))
+
+def broadcast_result(router_socket, command_socket, broadcast_id, client_id, reply):
+    """Учитывает результат отправленной в рамках рассылки команды."""
+    job = broadcasts.get(broadcast_id)
+    if job is None:
+        return
+    job["in_flight"] -= 1
+    record_broadcast_result(command_socket, broadcast_id, client_id, reply)
+    fill_broadcast(router_socket, command_socket, broadcast_id)
+
+def finish_broadcast(command_socket, broadcast_id):
+    """Отправляет итоговый ответ, когда получены результаты от всех клиентов."""
+    job = broadcasts[broadcast_id]
+    if len(job["results"]) < job["total"]:
+        return
+    del broadcasts[broadcast_id]
+    queued = sum(1 for r in job["results"].values() if r.get("status") == "queued")
+    failed = sum(1 for r in job["results"].values() if r.get("status") not in ("success", "queued"))
+    summary = {
+        "type": "done",
+        "status": "success",
+        "broadcast_id": broadcast_id,
+        "total": job["total"],
+        "failed": failed,
+        "queued": queued,
+        "elapsed": round(time.time() - job["started_at"], 3),
+    }
+    if job["schedule_id"] is not None:
+        scheduler.finished(job["schedule_id"], summary)
+    else:
+        if not job["stream"]:
+            summary["results"] = job["results"]
+        send_to_caller(command_socket, job["envelope"], _broadcast_frame(job, summary))
+    logging.info(f"Рассылка [{broadcast_id}] завершена: {job['total']} клиентов, ошибок {failed}, "
+                 f"{summary['elapsed']} с")
 
-        identity = registered_clients[client_id]["identity"]
-        msg = {"type": "command", "command": command}
-        router_socket.send_multipart([identity.encode(), b'', json.dumps(msg).encode()])
-        logging.info(f"Отправлена команда клиенту {client_id} ({identity}): {command}")
+def _broadcast_frame(job, frame):
+    if job["tag"] is not None:
+        frame["tag"] = job["tag"]
+    return frame
+
+##############################################
+# Раздача файлов клиентам
+##############################################
+# Протокол: сервер предлагает файл (file_offer: размер, sha256, размер порции),
+# клиент отвечает file_credit — с какой порции продолжать (после обрыва он
+# докачивает недостающее) и до какой можно слать. Порции (file_chunk) идут
+# двумя кадрами: заголовок в согласованном формате и сырые байты. Клиент
+# продлевает кредит по мере записи и в конце присылает file_done с итогом
+# проверки контрольной суммы.
+class FileSource:
+    """Файл-источник, отображённый в память: при раздаче многим клиентам он читается с диска один раз."""
+
+    def __init__(self, path, chunk_size=FILE_CHUNK_SIZE):
+        self.path = path
+        self.chunk_size = chunk_size
+        with open(path, "rb") as f:
+            self.size = os.fstat(f.fileno()).st_size
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b""
+        self.chunks = -(-self.size // chunk_size)
+        self.sha256 = hashlib.sha256(self.data).hexdigest()
+
+    def chunk(self, index):
+        return self.data[index * self.chunk_size:(index + 1) * self.chunk_size]
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+def start_transfer(router_socket, command_socket, envelope, cmd_msg):
+    """
+    Начинает раздачу файла с сервера (path) клиентам, выбранным селектором
+    (client_id, client_ids, group, all), в путь dest. Одновременно файл получают
+    не более FILE_TRANSFER_CONCURRENCY клиентов. Ответ вызывающей стороне —
+    один, когда закончатся все клиенты. Возвращает ответ об ошибке или None.
+    """
+    if not cmd_msg.get("path") or not cmd_msg.get("dest"):
+        return {"status": "error", "message": "path and dest are required"}
+    selector = dict(cmd_msg, client_ids=[cmd_msg["client_id"]]) if cmd_msg.get("client_id") else cmd_msg
+    targets = select_clients(selector)
+    if not targets:
+        return {"status": "error", "message": "Не найдено ни одного клиента для раздачи"}
+    try:
+        source = FileSource(cmd_msg["path"])
+    except OSError as e:
+        return {"status": "error", "message": f"Не удалось открыть {cmd_msg['path']}: {e}"}
+    transfer_id = uuid.uuid4().hex if shard_index is None else f"w{shard_index}-{uuid.uuid4().hex}"
+    transfers[transfer_id] = {
+        "id": transfer_id,
+        "source": source,
+        "dest": cmd_msg["dest"],
+        "envelope": envelope,
+        "tag": cmd_msg.get("tag"),
+        "queue": deque(targets),
+        "active": {},  # client_id -> {"next", "until", "retries", "activity", "started_at"}
+        "results": {},
+        "total": len(targets),
+        "started_at": time.time(),
+        "deadline": time.time() + float(cmd_msg.get("timeout", 3600)),
+    }
+    logging.info(f"Раздача [{transfer_id}] {cmd_msg['path']} ({source.size} байт) -> {cmd_msg['dest']} "
+                 f"на {len(targets)} клиентов")
+    fill_transfer(router_socket, command_socket, transfer_id)
+    return None
 
-        # Ожидаем ответ от клиента
-        reply_parts = router_socket.recv_multipart()
-        if len(reply_parts) >= 2:
-            reply = json.loads(reply_parts[-1].decode())
+def offer_file(router_socket, transfer, client_id):
+    state = transfer["active"][client_id]
+    state["activity"] = time.time()
+    source = transfer["source"]
+    send_to_agent(router_socket, registered_clients[client_id].identity, {
+        "type": "file_offer", "transfer_id": transfer["id"], "dest": transfer["dest"],
+        "size": source.size, "sha256": source.sha256, "chunk_size": source.chunk_size,
+    })
+
+def fill_transfer(router_socket, command_socket, transfer_id):
+    """Предлагает файл следующим клиентам из очереди раздачи до лимита одновременных."""
+    transfer = transfers[transfer_id]
+    while transfer["queue"] and len(transfer["active"]) < FILE_TRANSFER_CONCURRENCY:
+        client_id = transfer["queue"].popleft()
+        if registered_clients[client_id].status == "offline":
+            transfer["results"][client_id] = {"status": "error", "message": f"Клиент {client_id} недоступен (offline)"}
+            continue
+        transfer["active"][client_id] = {"next": 0, "until": 0, "retries": 0, "started_at": time.time()}
+        offer_file(router_socket, transfer, client_id)
+    finish_transfer(command_socket, transfer_id)
+
+def pump_transfer(router_socket, transfer, client_id):
+    """Отправляет клиенту порции файла в пределах выданного им кредита."""
+    state = transfer["active"][client_id]
+    info = registered_clients[client_id]
+    source = transfer["source"]
+    until = min(state["until"], source.chunks)
+    while state["next"] < until:
+        header = {"type": "file_chunk", "transfer_id": transfer["id"], "index": state["next"]}
+        chunk = source.chunk(state["next"])
+        router_socket.send_multipart([info.identity_bytes, b'', encode_message(header, info.encoding), chunk])
+        state["next"] += 1
+        metrics.inc("fluxops_file_bytes_sent_total", len(chunk))
+
+def handle_file_credit(router_socket, client_id, msg):
+    """Клиент сообщил, с какой порции продолжать и до какой можно слать."""
+    transfer = transfers.get(msg.get("transfer_id"))
+    if transfer is None or client_id not in transfer["active"]:
+        return
+    state = transfer["active"][client_id]
+    state["activity"] = time.time()
+    state["retries"] = 0
+    if msg.get("resync"):
+        state["next"] = int(msg["next"])  # ответ на предложение: продолжаем с того, что у клиента есть
+    state["until"] = max(state["until"], int(msg["until"]))
+    pump_transfer(router_socket, transfer, client_id)
+
+def handle_file_done(router_socket, command_socket, client_id, msg):
+    transfer = transfers.get(msg.get("transfer_id"))
+    if transfer is None or client_id not in transfer["active"]:
+        return
+    state = transfer["active"].pop(client_id)
+    result = {"status": "success" if msg.get("ok") else "error",
+              "elapsed": round(time.time() - state["started_at"], 3)}
+    if not msg.get("ok"):
+        result["message"] = msg.get("error", "Контрольная сумма не совпала")
+    transfer["results"][client_id] = result
+    fill_transfer(router_socket, command_socket, transfer["id"])
+
+def resume_transfers(router_socket, client_id):
+    """Клиент переподключился: повторяем предложения незаконченных раздач, он продолжит с места обрыва."""
+    for transfer in transfers.values():
+        if client_id in transfer["active"]:
+            offer_file(router_socket, transfer, client_id)
+
+def check_transfers(router_socket, command_socket, now):
+    """Повторяет предложение клиентам без подтверждений и завершает раздачи по таймауту."""
+    for transfer_id, transfer in list(transfers.items()):
+        for client_id, state in list(transfer["active"].items()):
+            failed = None
+            if now >= transfer["deadline"]:
+                failed = "Таймаут раздачи"
+            elif now - state["activity"] >= FILE_STALL_TIMEOUT:
+                if state["retries"] >= FILE_MAX_RETRIES:
+                    failed = "Клиент перестал подтверждать получение"
+                else:
+                    state["retries"] += 1
+                    offer_file(router_socket, transfer, client_id)
+            if failed:
+                del transfer["active"][client_id]
+                transfer["results"][client_id] = {"status": "error", "message": failed}
+        if now >= transfer["deadline"]:
+            for client_id in transfer["queue"]:
+                transfer["results"][client_id] = {"status": "error", "message": "Таймаут раздачи"}
+            transfer["queue"].clear()
+        fill_transfer(router_socket, command_socket, transfer_id)
+
+def finish_transfer(command_socket, transfer_id):
+    transfer = transfers[transfer_id]
+    if len(transfer["results"]) < transfer["total"]:
+        return
+    del transfers[transfer_id]
+    transfer["source"].close()
+    failed = sum(1 for r in transfer["results"].values() if r["status"] != "success")
+    reply = {"status": "success", "transfer_id": transfer_id, "total": transfer["total"], "failed": failed,
+             "size": transfer["source"].size, "sha256": transfer["source"].sha256,
+             "elapsed": round(time.time() - transfer["started_at"], 3), "results": transfer["results"]}
+    if transfer["tag"] is not None:
+        reply["tag"] = transfer["tag"]
+    send_to_caller(command_socket, transfer["envelope"], reply)
+    logging.info(f"Раздача [{transfer_id}] завершена: {transfer['total']} клиентов, ошибок {failed}")
+
+def describe_transfers():
+    """Ход незавершённых раздач (action == "transfers")."""
+    return {"status": "success", "transfers": {
+        transfer_id: {"dest": transfer["dest"], "size": transfer["source"].size, "total": transfer["total"],
+                      "done": len(transfer["results"]), "queued": len(transfer["queue"]),
+                      "active": {client_id: min(state["next"] * transfer["source"].chunk_size, transfer["source"].size)
+                                 for client_id, state in transfer["active"].items()}}
+        for transfer_id, transfer in transfers.items()}}
+
+##############################################
+# Периодические задания
+##############################################
+class CronSpec:
+    """
+    Расписание cron из пяти полей: минута, час, день месяца, месяц, день недели
+    (0 или 7 — воскресенье). Поддерживаются *, списки, диапазоны и шаг (*/5, 1-10/2).
+    Как и в cron, если заданы и день месяца, и день недели, подходит любой из них.
+    """
+
+    RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expr):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError(f"Ожидается пять полей cron: {expr!r}")
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            self._parse(field, lo, hi) for field, (lo, hi) in zip(fields, self.RANGES))
+        if 7 in self.weekdays:
+            self.weekdays.add(0)
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    @staticmethod
+    def _parse(field, lo, hi):
+        values = set()
+        for part in field.split(","):
+            spec, _, step = part.partition("/")
+            if spec == "*":
+                start, end = lo, hi
+            elif "-" in spec:
+                start, end = map(int, spec.split("-", 1))
+            else:
+                start = int(spec)
+                end = hi if step else start
+            step = int(step) if step else 1
+            if start < lo or end > hi or start > end or step < 1:
+                raise ValueError(f"Недопустимое поле cron: {field!r}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, t):
+        in_month = t.day in self.days
+        in_week = (t.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return in_month and in_week
+        return in_month or in_week
+
+    def next_after(self, ts):
+        """Ближайшее подходящее время (по местным часам) строго после ts."""
+        t = datetime.fromtimestamp(ts).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = t + timedelta(days=4 * 366)
+        while t < limit:
+            # Не подошедшую единицу пропускаем целиком, а не поминутно
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+            else:
+                return t.timestamp()
+        raise ValueError("Расписание cron никогда не срабатывает")
+
+class Scheduler:
+    """
+    Периодические задания: команда по расписанию (interval секунд или cron)
+    для клиентов, выбранных селектором (client_ids, group, all). Все задания
+    в одной куче таймеров (next_run, job_id), которую проверяет основной цикл;
+    опрос сокетов ждёт не дольше, чем до ближайшего задания. Запуск — обычная
+    рассылка без вызывающей стороны. Время запуска сдвигается на случайную
+    величину до jitter секунд, чтобы одинаковые расписания не срабатывали
+    разом; пока предыдущий запуск не завершён, следующий пропускается.
+    Состояние сохраняется в filename не чаще раза в SCHEDULE_SAVE_INTERVAL.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.jobs = load_json_file(filename)
+        self.heap = []
+        self.dirty = False
+        self.saved_at = 0
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            job["running"] = False
+            try:
+                if not isinstance(job.get("next_run"), (int, float)):
+                    self._schedule(job, now)
+                elif job["next_run"] < now:
+                    # Пропущенные за время остановки запуски не догоняем: один запуск с разбросом
+                    job["next_run"] = now + random.uniform(0, job["jitter"])
+                    heapq.heappush(self.heap, (job["next_run"], job_id))
+                else:
+                    heapq.heappush(self.heap, (job["next_run"], job_id))
+            except (KeyError, TypeError, ValueError) as e:
+                logging.error(f"Задание {job_id} в {filename} повреждено и пропущено: {e!r}")
+                del self.jobs[job_id]
+                self._changed()
+        if self.jobs:
+            logging.info(f"Восстановлено периодических заданий: {len(self.jobs)}")
+
+    def add(self, spec, now):
+        """Добавляет задание или заменяет задание с тем же id. Возвращает описание задания."""
+        if not spec.get("command"):
+            raise ValueError("command is required")
+        if bool(spec.get("interval")) == bool(spec.get("cron")):
+            raise ValueError("exactly one of interval and cron is required")
+        selector = {key: spec[key] for key in ("client_ids", "group", "all") if spec.get(key)}
+        if not selector:
+            raise ValueError("client_ids, group or all is required")
+        if spec.get("cron"):
+            # Ошибка в выражении или расписание, которое никогда не срабатывает, — сразу вызывающей стороне
+            CronSpec(spec["cron"]).next_after(now)
+        elif float(spec["interval"]) <= 0:
+            raise ValueError("interval must be positive")
+        job_id = spec.get("job_id") or uuid.uuid4().hex
+        previous = self.jobs.get(job_id, {})
+        job = {
+            "id": job_id,
+            "command": spec["command"],
+            "selector": selector,
+            "interval": float(spec["interval"]) if spec.get("interval") else None,
+            "cron": spec.get("cron"),
+            "jitter": max(0.0, float(spec.get("jitter", 0))),
+            "timeout": float(spec.get("timeout", DEFAULT_COMMAND_TIMEOUT)),
+            "concurrency": max(1, int(spec.get("concurrency", DEFAULT_BROADCAST_CONCURRENCY))),
+            "created_at": previous.get("created_at", now),
+            "last_run": previous.get("last_run"),
+            "last_result": previous.get("last_result"),
+            "runs": previous.get("runs", 0),
+            "skipped": previous.get("skipped", 0),
+            "running": previous.get("running", False),
+        }
+        self._schedule(job, now)  # до замены прежнего задания: при ошибке оно остаётся как было
+        self.jobs[job_id] = job
+        self._changed()
+        return job
+
+    def remove(self, job_id):
+        # Запись в куче остаётся и отбрасывается при извлечении
+        if self.jobs.pop(job_id, None) is None:
+            return False
+        self._changed()
+        return True
+
+    def _schedule(self, job, after):
+        if job["cron"]:
+            due = CronSpec(job["cron"]).next_after(after)
+        elif job.get("due") and job["due"] + job["interval"] > after:
+            due = job["due"] + job["interval"]  # от срока, а не от фактического запуска: разброс не копится
         else:
-            reply = {}
+            due = after + job["interval"]
+        job["due"] = due
+        job["next_run"] = due + random.uniform(0, job["jitter"])
+        heapq.heappush(self.heap, (job["next_run"], job["id"]))
 
-        save_command_history(command, client_id, reply)
-        return {"status": "success", "reply": reply}
-    except Exception as e:
-        logging.error(f"Ошибка обработки команды: {e}")
+    def _changed(self):
+        self.dirty = True
+
+    def run_due(self, router_socket, command_socket, now):
+        """Запускает наступившие задания и планирует их следующий запуск."""
+        while self.heap and self.heap[0][0] <= now:
+            next_run, job_id = heapq.heappop(self.heap)
+            job = self.jobs.get(job_id)
+            if job is None or job["next_run"] != next_run:
+                continue  # задание удалено или перепланировано
+            self._schedule(job, now)
+            self._changed()
+            if job["running"]:
+                job["skipped"] += 1
+                metrics.inc("fluxops_scheduled_runs_total", 1, (("outcome", "skipped"),))
+                logging.warning(f"Задание {job_id} пропущено: предыдущий запуск ещё не завершён")
+                continue
+            reply = start_broadcast(router_socket, command_socket, None, dict(
+                job["selector"], command=job["command"], timeout=job["timeout"],
+                concurrency=job["concurrency"], schedule_id=job_id))
+            job["last_run"] = now
+            if reply is not None:
+                # Подходящих клиентов нет (в режиме шардирования — обычное дело для воркера)
+                job["last_result"] = {"status": "error", "message": reply["message"], "at": now}
+                continue
+            job["running"] = True
+            job["runs"] += 1
+            metrics.inc("fluxops_scheduled_runs_total", 1, (("outcome", "started"),))
+        if self.dirty and now - self.saved_at >= SCHEDULE_SAVE_INTERVAL:
+            self.save(now)
+
+    def finished(self, job_id, summary):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return
+        job["running"] = False
+        job["last_result"] = {"status": "success", "total": summary["total"], "failed": summary["failed"],
+                              "queued": summary["queued"], "elapsed": summary["elapsed"], "at": time.time()}
+        self._changed()
+        if summary["failed"]:
+            logging.warning(f"Задание {job_id}: ошибок {summary['failed']} из {summary['total']}")
+
+    def save(self, now):
+        # Временный файл + переименование: при сбое остаётся прежнее состояние
+        tmp = self.filename + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(self.jobs, f)
+            os.replace(tmp, self.filename)
+        except OSError as e:
+            logging.error(f"Ошибка сохранения {self.filename}: {e}")
+        self.dirty = False
+        self.saved_at = now
+
+def schedule_command(cmd_msg):
+    """Добавляет или заменяет периодическое задание (action == "schedule")."""
+    try:
+        job = scheduler.add(cmd_msg, time.time())
+    except ValueError as e:
         return {"status": "error", "message": str(e)}
+    scheduler.save(time.time())
+    logging.info(f"Периодическое задание {job['id']}: '{job['command']}' "
+                 f"({job['cron'] or str(job['interval']) + ' с'})")
+    return {"status": "success", "job": job}
+
+def unschedule_command(cmd_msg):
+    """Удаляет периодическое задание (action == "unschedule")."""
+    job_id = cmd_msg.get("job_id")
+    if not scheduler.remove(job_id):
+        return {"status": "error", "code": "not_found", "message": f"Задание {job_id} не найдено"}
+    scheduler.save(time.time())
+    return {"status": "success", "job_id": job_id}
 
 def send_external_command(client_id, command):
-    """Отправка команды клиенту через REQ-сокет."""
+    """
+    Отправка команды клиенту через REQ-сокет.
+    Если вместо client_id указано @group, команда рассылается всей группе
+    (@all — всем клиентам), а результаты печатаются по мере поступления.
+    """
     context = zmq.Context()
-    socket_req = context.socket(zmq.REQ)
-    socket_req.connect(f"tcp://localhost:{TCP_COMMAND_PORT}")
-    msg = {"client_id": client_id, "command": command}
-    socket_req.send_json(msg)
-    reply = socket_req.recv_json()
-    print("Ответ от сервера:", reply)
-    socket_req.close()
+    if client_id.startswith("@"):
+        target = client_id[1:]
+        selector = {"all": True} if target == "all" else {"group": target}
+        socket_dealer = context.socket(zmq.DEALER)
+        socket_dealer.connect(f"tcp://localhost:{TCP_COMMAND_PORT}")
+        socket_dealer.send_multipart([b'', json.dumps({"action": "broadcast", "command": command,
+                                                       "stream": True, **selector}).encode()])
+        while True:
+            frame = json.loads(socket_dealer.recv_multipart()[-1].decode())
+            print("Ответ от сервера:", frame)
+            if frame.get("type") == "done" or (frame.get("status") == "error" and "type" not in frame):
+                break
+        socket_dealer.close()
+    else:
+        socket_req = context.socket(zmq.REQ)
+        socket_req.connect(f"tcp://localhost:{TCP_COMMAND_PORT}")
+        msg = {"client_id": client_id, "command": command}
+        socket_req.send_json(msg)
+        reply = socket_req.recv_json()
+        print("Ответ от сервера:", reply)
+        socket_req.close()
     context.term()
 
 ##############################################
 # Основной сервер
 ##############################################
-def server():
-    context = zmq.Context()
-    router = context.socket(zmq.ROUTER)
-    router.bind(f"tcp://*:{ZMQ_PORT}")
-    logging.info(f"ZeroMQ сервер (ROUTER) запущен на порту {ZMQ_PORT}")
-
-    command_socket = context.socket(zmq.REP)
-    command_socket.bind(f"tcp://*:{TCP_COMMAND_PORT}")
-    logging.info(f"Командный интерфейс запущен на порту {TCP_COMMAND_PORT}")
-
-    threading.Thread(target=udp_discovery, daemon=True).start()
-
+def serve(router, command_socket, events_socket, stats_socket=None):
+    """Основной цикл обработки сообщений клиентов и командного интерфейса."""
     poller = zmq.Poller()
     poller.register(router, zmq.POLLIN)
     poller.register(command_socket, zmq.POLLIN)
+    if stats_socket is not None:
+        poller.register(stats_socket, zmq.POLLIN)
+    transfers_checked_at = admission_checked_at = 0
 
     while True:
         try:
-            socks = dict(poller.poll(1000))  # Исправленный таймаут
+            socks = dict(poller.poll(next_poll_timeout()))
             if router in socks and socks[router] == zmq.POLLIN:
                 parts = router.recv_multipart()
                 identity, msg = process_router_message(parts)
                 if identity is None:
                     continue
                 msg_type = msg.get("type")
+                metrics.inc("fluxops_messages_total", 1, (("type", str(msg_type)),))
+                now = time.time()
+                client_id = None if msg_type == "register" else touch_client(events_socket, identity, now)
                 if msg_type == "register":
-                    client_id = msg.get("data", {}).get("client_id", identity)
-                    registered_clients[client_id] = {"identity": identity}
-                    reply = {"status": "registered"}
-                    router.send_multipart([identity.encode(), b'', json.dumps(reply).encode()])
-                    logging.info(f"Клиент зарегистрирован: {client_id} ({identity})")
+                    register_client(router, events_socket, identity, msg)
+                elif client_id is None:
+                    # Сервер не знает клиента (например, после перезапуска): просим зарегистрироваться заново
+                    send_to_agent(router, identity, {"status": "unregistered"})
+                elif msg_type == "batch_ack":
+                    handle_batch_ack(router, client_id, msg)
                 elif msg_type == "ping":
-                    router.send_multipart([identity.encode(), b'', json.dumps({"status": "alive"}).encode()])
+                    send_to_agent(router, identity, {"status": "alive", "heartbeat_interval": heartbeat_interval()})
+                elif msg_type == "command_output":
+                    handle_command_output(events_socket, identity, msg)
                 elif msg_type == "command_result":
-                    logging.info(f"Результат команды от {identity}: {msg.get('data')}")
+                    handle_command_result(router, command_socket, identity, msg)
+                elif msg_type == "output_chunk":
+                    handle_output_chunk(router, command_socket, identity, msg)
+                elif msg_type == "facts":
+                    handle_facts(router, client_id, msg)
+                elif msg_type == "file_credit":
+                    handle_file_credit(router, client_id, msg)
+                elif msg_type == "file_done":
+                    handle_file_done(router, command_socket, client_id, msg)
                 else:
                     logging.info(f"Неизвестное сообщение от {identity}: {msg}")
+                if client_id in outbound.queues:
+                    # Клиент вернулся из offline без повторной регистрации
+                    deliver_queued(router, client_id)
 
             if command_socket in socks and socks[command_socket] == zmq.POLLIN:
-                reply = process_command_interface(command_socket, router)
-                command_socket.send_json(reply)
+                process_command_interface(command_socket, router)
+
+            if stats_socket is not None and stats_socket in socks:
+                stats_socket.recv()
+                stats_socket.send_string(render_stats())
+
+            expire_pending_commands(router, command_socket)
+            now = time.time()
+            check_liveness(events_socket, now)
+            if transfers and now - transfers_checked_at >= 1:
+                transfers_checked_at = now
+                check_transfers(router, command_socket, now)
+            scheduler.run_due(router, command_socket, now)
+            admission.drain(router, command_socket, now)
+            if now - admission_checked_at >= 1:
+                admission_checked_at = now
+                admission.expire(router, command_socket, now)
         except Exception as e:
             logging.error(f"Ошибка в сервере: {e}")
             time.sleep(1)
 
+def init_state(history_dir, legacy_history=True, queue_file=OUTBOUND_QUEUE_FILE, schedule_file=SCHEDULE_FILE):
+    global command_history, liveness_wheel, result_cache, outbound, scheduler, admission
+    result_cache = ResultCache()
+    admission = Admission()
+    outbound = OutboundQueue(queue_file)
+    scheduler = Scheduler(schedule_file)
+    command_history = CommandHistory(history_dir, background=HISTORY_BACKGROUND_WRITER,
+                                     legacy_file=COMMAND_HISTORY_FILE if legacy_history else None)
+    liveness_wheel = TimingWheel(LIVENESS_TICK, max(CLIENT_OFFLINE_AFTER, 12 * HEARTBEAT_MAX_INTERVAL))
+
+def server():
+    init_state(COMMAND_HISTORY_DIR)
+
+    context = zmq.Context()
+    router = context.socket(zmq.ROUTER)
+    router.bind(f"tcp://*:{ZMQ_PORT}")
+    logging.info(f"ZeroMQ сервер (ROUTER) запущен на порту {ZMQ_PORT}")
+
+    # ROUTER вместо REP: несколько команд могут ожидать ответа одновременно
+    command_socket = context.socket(zmq.ROUTER)
+    command_socket.bind(f"tcp://*:{TCP_COMMAND_PORT}")
+    logging.info(f"Командный интерфейс запущен на порту {TCP_COMMAND_PORT}")
+
+    events_socket = context.socket(zmq.PUB)
+    events_socket.setsockopt(zmq.SNDHWM, EVENTS_HWM)
+    events_socket.bind(f"tcp://*:{EVENTS_PORT}")
+    logging.info(f"Публикация событий запущена на порту {EVENTS_PORT}")
+
+    stats_socket = context.socket(zmq.REP)
+    stats_socket.bind(STATS_ENDPOINT)
+    logging.info(f"Метрики доступны на {STATS_ENDPOINT}")
+
+    threading.Thread(target=udp_discovery, daemon=True).start()
+
+    serve(router, command_socket, events_socket, stats_socket)
+
+##############################################
+# Шардирование по процессам
+##############################################
+# Фронт держит публичные сокеты и только пересылает кадры: сообщения клиента
+# уходят воркеру, выбранному консистентным хешем identity, а ответы воркеров —
+# обратно через тот же ROUTER. Каждый воркер — обычный serve() со своей частью
+# реестра; вместо ROUTER-сокетов у него PAIR-сокеты к фронту по ipc.
+def shard_endpoint(kind, index):
+    return f"ipc://{shard_ipc_dir}/{kind}-{index}"
+
+class HashRing:
+    """Кольцо консистентного хеширования с виртуальными узлами."""
+
+    def __init__(self, shards, virtual_nodes=SHARD_VIRTUAL_NODES):
+        points = sorted((self._hash(f"{shard}:{node}".encode()), shard)
+                        for shard in range(shards) for node in range(virtual_nodes))
+        self.keys = [key for key, _ in points]
+        self.shards = [shard for _, shard in points]
+
+    @staticmethod
+    def _hash(data):
+        return int.from_bytes(hashlib.md5(data).digest()[:8], "big")
+
+    def lookup(self, key):
+        position = bisect.bisect(self.keys, self._hash(key)) % len(self.keys)
+        return self.shards[position]
+
+def watch_parent(parent_pid):
+    """Завершает воркер, если фронт умер, не успев его остановить (например, по SIGKILL)."""
+    while os.getppid() == parent_pid:
+        time.sleep(1)
+    logging.warning(f"Фронт (pid {parent_pid}) завершился, воркер {shard_index} останавливается")
+    shutil.rmtree(shard_ipc_dir, ignore_errors=True)  # фронт убит и сам каталог не уберёт
+    os._exit(0)
+
+def shard_worker(index, count, ipc_dir, parent_pid):
+    """Точка входа процесса-воркера."""
+    global shard_index, shard_count, shard_ipc_dir
+    shard_index, shard_count, shard_ipc_dir = index, count, ipc_dir
+    threading.Thread(target=watch_parent, args=(parent_pid,), daemon=True).start()
+    init_state(os.path.join(COMMAND_HISTORY_DIR, f"shard-{index}"), legacy_history=False,
+               queue_file=f"shard-{index}-{OUTBOUND_QUEUE_FILE}", schedule_file=f"shard-{index}-{SCHEDULE_FILE}")
+    context = zmq.Context()
+    router = context.socket(zmq.PAIR)
+    router.connect(shard_endpoint("agents", index))
+    command_socket = context.socket(zmq.PAIR)
+    command_socket.connect(shard_endpoint("commands", index))
+    events_socket = context.socket(zmq.PUB)
+    events_socket.setsockopt(zmq.SNDHWM, EVENTS_HWM)
+    events_socket.connect(shard_endpoint("events", "all"))
+    # У каждого воркера свой сокет метрик
+    stats_socket = context.socket(zmq.REP)
+    stats_socket.bind(shard_endpoint("stats", index))
+    logging.info(f"Воркер {index} запущен, метрики на {shard_endpoint('stats', index)}")
+    try:
+        serve(router, command_socket, events_socket, stats_socket)
+    except KeyboardInterrupt:
+        pass
+
+def merge_gathered(gather):
+    """Сводит ответы всех воркеров на общий для флота запрос в один ответ."""
+    replies = gather["replies"]
+    msg = gather["msg"]
+    action = msg.get("action")
+    if action == "clients":
+        # partial: не все воркеры ответили, отсутствие клиента в списке ничего не значит
+        return {"status": "success", "clients": [c for r in replies for c in r.get("clients", [])],
+                "partial": any(r.get("status") != "success" for r in replies)}
+    if action == "queues":
+        return {"status": "success", "queues": {cid: q for r in replies for cid, q in r.get("queues", {}).items()}}
+    if action == "history":
+        entries = sorted((e for r in replies for e in r.get("history", [])), key=lambda e: e["ts"])
+        return {"status": "success", "history": entries[:int(msg.get("limit", 10))]}
+    if action == "facts":
+        errors = [r for r in replies if r.get("status") != "success"]
+        if errors:
+            return errors[0]  # ошибка в запросе одинакова у всех воркеров
+        merged = {"status": "success", "facts": {cid: f for r in replies for cid, f in r.get("facts", {}).items()}}
+        if msg.get("summary"):
+            summary = defaultdict(int)
+            for r in replies:
+                for value, count in r.get("summary", {}).items():
+                    summary[value] += count
+            merged["summary"] = dict(summary)
+        return merged
+    if action in ("schedule", "unschedule"):
+        return replies[0]  # у всех воркеров одно и то же задание
+    if action == "schedules":
+        # Каждый воркер запускает задание для своих клиентов: счётчики складываем
+        jobs = {}
+        for job in (job for r in replies for job in r.get("jobs", [])):
+            merged = jobs.setdefault(job["id"], dict(job, runs=0, skipped=0, running=False))
+            merged["runs"] += job["runs"]
+            merged["skipped"] += job["skipped"]
+            merged["running"] = merged["running"] or job["running"]
+            merged["next_run"] = min(merged["next_run"], job["next_run"])
+            result = job["last_result"]
+            if result and result["status"] == "success" and \
+                    (not merged["last_result"] or merged["last_result"]["status"] != "success"):
+                merged["last_result"], merged["last_run"] = result, job["last_run"]
+        return {"status": "success", "jobs": list(jobs.values())}
+    if action == "transfers":
+        return {"status": "success", "transfers": {tid: t for r in replies for tid, t in r.get("transfers", {}).items()}}
+    if action == "push_file":
+        # воркеры без подходящих клиентов отвечают ошибкой — она не в счёт, если хоть один раздавал
+        done = [r for r in replies if r.get("transfer_id")]
+        if not done:
+            return replies[0]
+        return {"status": "success", "transfer_id": gather["id"],
+                "total": sum(r["total"] for r in done), "failed": sum(r["failed"] for r in done),
+                "size": done[0]["size"], "sha256": done[0]["sha256"],
+                "elapsed": max(r["elapsed"] for r in done),
+                "results": {cid: res for r in done for cid, res in r["results"].items()}}
+    # broadcast: итог по всем воркерам
+    done = [r for r in replies if r.get("type") == "done"]
+    if not done:
+        return {"status": "error", "message": "Не найдено ни одного клиента для рассылки"}
+    summary = {
+        "type": "done",
+        "status": "success",
+        "broadcast_id": gather["id"],
+        "total": sum(r["total"] for r in done),
+        "failed": sum(r["failed"] for r in done),
+        "queued": sum(r.get("queued", 0) for r in done),
+        "elapsed": max(r["elapsed"] for r in done),
+    }
+    if not msg.get("stream"):
+        summary["results"] = {cid: res for r in done for cid, res in r.get("results", {}).items()}
+    return summary
+
+def server_sharded(workers):
+    """
+    Запуск в режиме шардирования: фронт плюс workers процессов-воркеров.
+    Каталог client_id -> воркер собирается из событий живости, которые
+    публикуют воркеры, поэтому команду можно адресовать любому клиенту.
+    Запросы по всему флоту (broadcast, clients, push_file, history since) рассылаются
+    всем воркерам, а их ответы сводятся фронтом.
+    """
+    global shard_ipc_dir
+    context = zmq.Context()
+    # Сначала TCP-порты: если они заняты, запуск прерывается до создания воркеров
+    router = context.socket(zmq.ROUTER)
+    router.bind(f"tcp://*:{ZMQ_PORT}")
+    command_socket = context.socket(zmq.ROUTER)
+    command_socket.bind(f"tcp://*:{TCP_COMMAND_PORT}")
+    events_out = context.socket(zmq.XPUB)
+    events_out.bind(f"tcp://*:{EVENTS_PORT}")
+    # Метрики фронта: свои ряды плюс ответы всех воркеров
+    stats_socket = context.socket(zmq.ROUTER)
+    stats_socket.bind(STATS_ENDPOINT)
+
+    # Свой каталог на каждый запуск: воркеры прежнего запуска не подключатся к чужим сокетам
+    shard_ipc_dir = tempfile.mkdtemp(prefix=SHARD_IPC_PREFIX)
+    events_in = context.socket(zmq.XSUB)
+    events_in.bind(shard_endpoint("events", "all"))
+    agent_links, command_links, stats_links = [None] * workers, [None] * workers, [None] * workers
+
+    def open_links(index):
+        """Сокеты связи с воркером. PAIR не принимает нового собеседника, поэтому при перезапуске — новые."""
+        agent_links[index] = context.socket(zmq.PAIR)
+        agent_links[index].bind(shard_endpoint("agents", index))
+        command_links[index] = context.socket(zmq.PAIR)
+        command_links[index].bind(shard_endpoint("commands", index))
+        stats_links[index] = context.socket(zmq.DEALER)
+        stats_links[index].connect(shard_endpoint("stats", index))
+
+    for index in range(workers):
+        open_links(index)
+
+    # SIGTERM превращаем в SystemExit, чтобы finally остановил воркеров
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # spawn, а не fork: воркер не наследует контекст ZeroMQ, потоки и TCP-сокеты фронта
+    spawn = multiprocessing.get_context("spawn")
+
+    def start_worker(index):
+        process = spawn.Process(target=shard_worker, args=(index, workers, shard_ipc_dir, os.getpid()),
+                                          daemon=True)
+        process.start()
+        return process
+
+    processes = [start_worker(index) for index in range(workers)]
+    restart_at = {}  # номер упавшего воркера -> время перезапуска
+    health_checked_at = time.time()
+    stats_waiting = deque()  # запросы метрик в порядке поступления: воркеры отвечают по порядку
+    logging.info(f"Фронт запущен: {workers} воркеров, клиенты на порту {ZMQ_PORT}, "
+                 f"команды на порту {TCP_COMMAND_PORT}")
+
+    ring = HashRing(workers)
+    directory = {}  # client_id -> номер воркера
+    gathers = {}    # gather_id -> ответы воркеров на общий для флота запрос
+
+    threading.Thread(target=udp_discovery, args=(lambda: len(directory) + len(gathers),), daemon=True).start()
+
+    def shard_for_client(client_id):
+        return directory.get(client_id, ring.lookup(client_id.encode()))
+
+    def to_worker(links, index, parts):
+        """Неблокирующая отправка воркеру: пока упавший воркер не перезапущен, сообщения отбрасываются."""
+        try:
+            links[index].send_multipart(parts, flags=zmq.NOBLOCK)
+            return True
+        except zmq.Again:
+            metrics.inc("fluxops_front_dropped_total", 1, (("worker", str(index)),))
+            return False
+
+    def command_to_worker(index, parts, envelope, msg):
+        if not to_worker(command_links, index, parts):
+            reply = {"status": "error", "message": f"Воркер {index} недоступен, повторите запрос позже"}
+            if msg.get("tag") is not None:
+                reply["tag"] = msg["tag"]
+            send_to_caller(command_socket, envelope, reply)
+
+    def route_command(parts):
+        envelope, payload = parts[:-1], parts[-1]
+        try:
+            msg = json.loads(payload.decode())
+        except Exception as e:
+            send_to_caller(command_socket, envelope, {"status": "error", "message": str(e)})
+            return
+        action = msg.get("action")
+        if action == "cancel":
+            request_id = str(msg.get("request_id", ""))
+            shard = request_id[1:].split("-", 1)[0]
+            if request_id.startswith("w") and shard.isdigit() and int(shard) < workers:
+                command_to_worker(int(shard), parts, envelope, msg)
+            else:
+                send_to_caller(command_socket, envelope,
+                               {"status": "error", "code": "not_found", "message": f"Команда {request_id} не найдена"})
+        elif action in ("broadcast", "clients", "queues", "transfers", "schedule", "unschedule", "schedules", "facts") or \
+                (action in ("history", "push_file") and not msg.get("client_id") and (action != "history" or "since" in msg)):
+            gather_id = uuid.uuid4().hex
+            if action == "schedule" and not msg.get("job_id"):
+                msg = dict(msg, job_id=gather_id)  # у всех воркеров задание под одним id
+            gathers[gather_id] = {"id": gather_id, "envelope": envelope, "msg": msg,
+                                  "waiting": set(range(workers)), "replies": []}
+            if action == "broadcast":
+                # лимит одновременных команд делится между воркерами
+                concurrency = int(msg.get("concurrency", DEFAULT_BROADCAST_CONCURRENCY))
+                msg = dict(msg, concurrency=max(1, -(-concurrency // workers)))
+                if msg.get("stream"):
+                    started = {"type": "started", "broadcast_id": gather_id}
+                    if msg.get("tag") is not None:
+                        started["tag"] = msg["tag"]
+                    send_to_caller(command_socket, envelope, started)
+            frame = [gather_id.encode(), b'', json.dumps(msg).encode()]
+            unreachable = [index for index in range(workers) if not to_worker(command_links, index, frame)]
+            lost = json.dumps({"status": "error", "message": "Воркер недоступен"}).encode()
+            for index in unreachable:
+                gather_reply(index, [gather_id.encode(), b'', lost])
+        elif msg.get("client_id"):
+            command_to_worker(shard_for_client(msg["client_id"]), parts, envelope, msg)
+        else:
+            command_to_worker(0, parts, envelope, msg)
+
+    def gather_reply(index, parts):
+        gather = gathers.get(parts[0].decode(errors="replace"))
+        if gather is None:
+            command_socket.send_multipart(parts)  # прямой ответ вызывающей стороне
+            return
+        reply = json.loads(parts[-1].decode())
+        if reply.get("type") in ("started",):
+            return
+        if reply.get("type") == "result":
+            send_to_caller(command_socket, gather["envelope"], dict(reply, broadcast_id=gather["id"]))
+            return
+        gather["replies"].append(reply)
+        gather["waiting"].discard(index)
+        if not gather["waiting"]:
+            del gathers[gather["id"]]
+            merged = merge_gathered(gather)
+            if gather["msg"].get("tag") is not None:
+                merged["tag"] = gather["msg"]["tag"]
+            send_to_caller(command_socket, gather["envelope"], merged)
+
+    def stats_request(parts):
+        stats_waiting.append({"envelope": parts[:-1], "replies": [None] * workers})
+        for index in range(workers):
+            if not to_worker(stats_links, index, [b'', b'stats']):
+                stats_reply(index, "")
+
+    def stats_reply(index, text):
+        for waiting in stats_waiting:
+            if waiting["replies"][index] is None:
+                waiting["replies"][index] = text
+                break
+        while stats_waiting and all(reply is not None for reply in stats_waiting[0]["replies"]):
+            waiting = stats_waiting.popleft()
+            metrics.set("fluxops_front_directory_size", len(directory))
+            metrics.set("fluxops_front_gathers_in_flight", len(gathers))
+            text = merge_rendered(metrics.render((("shard", "front"),)), *waiting["replies"])
+            stats_socket.send_multipart(waiting["envelope"] + [text.encode()])
+
+    def lose_worker(index):
+        """Воркер упал: не ждём от него ответов на общие запросы и метрики."""
+        lost = json.dumps({"status": "error", "message": f"Воркер {index} перезапущен"}).encode()
+        for gather_id, gather in list(gathers.items()):
+            if index in gather["waiting"]:
+                gather_reply(index, [gather_id.encode(), b'', lost])
+        while any(waiting["replies"][index] is None for waiting in stats_waiting):
+            stats_reply(index, "")
+
+    poller = zmq.Poller()
+    for sock in [router, command_socket, events_in, events_out, stats_socket] + agent_links + command_links + stats_links:
+        poller.register(sock, zmq.POLLIN)
+
+    try:
+        while True:
+            socks = dict(poller.poll(1000))
+            if router in socks:
+                parts = router.recv_multipart()
+                metrics.inc("fluxops_front_messages_total", 1, (("direction", "in"),))
+                to_worker(agent_links, ring.lookup(parts[0]), parts)
+            for link in agent_links:
+                if link in socks:
+                    router.send_multipart(link.recv_multipart())
+                    metrics.inc("fluxops_front_messages_total", 1, (("direction", "out"),))
+            if command_socket in socks:
+                route_command(command_socket.recv_multipart())
+            for index, link in enumerate(command_links):
+                if link in socks:
+                    gather_reply(index, link.recv_multipart())
+            if events_in in socks:
+                event = events_in.recv_multipart()
+                if event[0] == b"liveness":
+                    status = json.loads(event[1].decode())
+                    directory[status["client_id"]] = status["shard"]
+                events_out.send_multipart(event)
+            if events_out in socks:
+                events_in.send_multipart(events_out.recv_multipart())  # подписки api.py
+            if stats_socket in socks:
+                stats_request(stats_socket.recv_multipart())
+            for index, link in enumerate(stats_links):
+                if link in socks:
+                    stats_reply(index, link.recv_multipart()[-1].decode())
+            now = time.time()
+            if now - health_checked_at < 1:
+                continue
+            health_checked_at = now
+            for index, process in enumerate(processes):
+                if index not in restart_at and not process.is_alive():
+                    # Клиенты шарда получат unregistered и зарегистрируются в новом воркере
+                    logging.error(f"Воркер {index} завершился (код {process.exitcode}), перезапуск")
+                    metrics.inc("fluxops_front_worker_restarts_total", 1, (("worker", str(index)),))
+                    restart_at[index] = now + SHARD_RESTART_DELAY
+                    lose_worker(index)
+                elif restart_at.get(index, now + 1) <= now:
+                    del restart_at[index]
+                    for link in (agent_links[index], command_links[index], stats_links[index]):
+                        poller.unregister(link)
+                        link.close(linger=0)
+                    open_links(index)
+                    for link in (agent_links[index], command_links[index], stats_links[index]):
+                        poller.register(link, zmq.POLLIN)
+                    processes[index] = start_worker(index)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(5)
+            if process.is_alive():
+                process.kill()
+                process.join()
+        shutil.rmtree(shard_ipc_dir, ignore_errors=True)
+
 if __name__ == "__main__":
     if len(sys.argv) > 1 and sys.argv[1].lower() == "fluxops":
         send_external_command(sys.argv[2], " ".join(sys.argv[3:]))
+    elif len(sys.argv) > 2 and sys.argv[1] == "--workers":
+        try:
+            server_sharded(int(sys.argv[2]))
+        except KeyboardInterrupt:
+            logging.info("Сервер завершил работу.")
     else:
         try:
             server()